@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+"""Benchmark of the builders on synthetic documents, gated against stored
+baselines.
+
+Every case generates a document scaling along pages, \\include'd files,
+citations, figures and cross-references, and times a clean build and a
+rebuild after editing one included file with each builder. The per-step
+breakdown comes from build.py --trace.
+
+    python benchmarks/bench_builders.py --cases small medium --save
+    python benchmarks/bench_builders.py --cases small medium
+
+The second run compares against the baseline written by the first one and
+exits with status 1 if any measurement is more than --threshold slower.
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from pdf_builders.system import which  # noqa: E402
+
+BUILD = os.path.join(ROOT, 'build.py')
+DEFAULT_BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+
+# pages, included files, citations, figures and cross-references
+CASES = {
+    'tiny': dict(pages=2, includes=1, citations=5, figures=1, references=5),
+    'small': dict(pages=10, includes=5, citations=40, figures=5, references=40),
+    'medium': dict(pages=60, includes=15, citations=200, figures=30, references=300),
+    'large': dict(pages=300, includes=40, citations=1000, figures=150, references=1500),
+}
+
+# the programs each builder needs
+BUILDERS = {
+    'basic': ['pdflatex', 'bibtex'],
+    'traditional': ['latexmk', 'pdflatex', 'bibtex'],
+    'edas': ['latex', 'bibtex', 'dvips', 'gs'],
+}
+
+PARAGRAPH = (
+    u"Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do "
+    u"eiusmod tempor incididunt ut labore et dolore magna aliqua. Ut enim ad "
+    u"minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip "
+    u"ex ea commodo consequat. Duis aute irure dolor in reprehenderit in "
+    u"voluptate velit esse cillum dolore eu fugiat nulla pariatur.\n"
+)
+
+# roughly one page of the article class
+PARAGRAPHS_PER_PAGE = 6
+
+
+def figure_pdf():
+    '''
+    Returns a minimal one page PDF with a filled rectangle
+    '''
+    content = b"0.5 g 10 10 180 100 re f"
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 200 120] /Contents 4 0 R >>",
+        b"<< /Length " + str(len(content)).encode('ascii') + b" >>\nstream\n" +
+        content + b"\nendstream",
+    ]
+    data = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(data))
+        data += str(number).encode('ascii') + b" 0 obj\n" + body + b"\nendobj\n"
+    xref = len(data)
+    data += b"xref\n0 " + str(len(objects) + 1).encode('ascii') + b"\n0000000000 65535 f \n"
+    for offset in offsets:
+        data += b"%010d 00000 n \n" % offset
+    data += (b"trailer\n<< /Size " + str(len(objects) + 1).encode('ascii') +
+             b" /Root 1 0 R >>\nstartxref\n" + str(xref).encode('ascii') + b"\n%%EOF\n")
+    return data
+
+
+FIGURE_EPS = (
+    b"%!PS-Adobe-3.0 EPSF-3.0\n"
+    b"%%BoundingBox: 0 0 200 120\n"
+    b"0.5 setgray 10 10 180 100 rectfill\n"
+    b"showpage\n"
+    b"%%EOF\n"
+)
+
+
+def generate(directory, pages, includes, citations, figures, references):
+    '''
+    Writes a synthetic document to directory and returns the path of its
+    root file. Pages, citations, figures and cross-references are spread
+    evenly over the included files
+    '''
+    figure_dir = os.path.join(directory, 'figures')
+    os.makedirs(figure_dir)
+    pdf = figure_pdf()
+    for number in range(figures):
+        with open(os.path.join(figure_dir, 'fig{0}.pdf'.format(number)), 'wb') as f:
+            f.write(pdf)
+        with open(os.path.join(figure_dir, 'fig{0}.eps'.format(number)), 'wb') as f:
+            f.write(FIGURE_EPS)
+
+    with open(os.path.join(directory, 'refs.bib'), 'w') as f:
+        for number in range(max(citations, 1)):
+            f.write(u'@article{{key{0},\n  author = {{Author, A{0} and Other, B}},\n'
+                    u'  title = {{Title of article {0}}},\n  journal = {{Journal}},\n'
+                    u'  year = {{{1}}},\n  volume = {{{0}}},\n  pages = {{1--10}}\n}}\n\n'
+                    .format(number, 1990 + number % 30))
+
+    def spread(total, part):
+        return range(part * total // includes, (part + 1) * total // includes)
+
+    for part in range(includes):
+        lines = [u'\\section{{Part {0}}}\\label{{sec:{0}}}\n'.format(part)]
+        paragraphs = list(spread(pages * PARAGRAPHS_PER_PAGE, part))
+        cites = list(spread(citations, part))
+        refs = list(spread(references, part))
+        figs = list(spread(figures, part))
+        for index, paragraph in enumerate(paragraphs):
+            lines.append(PARAGRAPH)
+            # citations and references are attached to the paragraphs
+            for cite in cites[index::len(paragraphs)]:
+                lines.append(u'See~\\cite{{key{0}}}.\n'.format(cite))
+            for ref in refs[index::len(paragraphs)]:
+                line = u'As in Section~\\ref{{sec:{0}}} on page~\\pageref{{sec:{0}}}'.format(ref % includes)
+                if figures:
+                    line += u' and Figure~\\ref{{fig:{0}}}'.format(ref % figures)
+                lines.append(line + u'.\n')
+            lines.append(u'\n')
+        for fig in figs:
+            lines.append(
+                u'\\begin{{figure}}[htbp]\n\\centering\n'
+                u'\\includegraphics[width=0.6\\linewidth]{{figures/fig{0}}}\n'
+                u'\\caption{{Figure {0}}}\\label{{fig:{0}}}\n\\end{{figure}}\n'.format(fig))
+        with open(os.path.join(directory, 'part{0}.tex'.format(part)), 'w') as f:
+            f.write(u''.join(lines))
+
+    root = os.path.join(directory, 'main.tex')
+    with open(root, 'w') as f:
+        f.write(u'\\documentclass{article}\n\\usepackage{graphicx}\n\\begin{document}\n')
+        for part in range(includes):
+            f.write(u'\\include{{part{0}}}\n'.format(part))
+        f.write(u'\\bibliographystyle{plain}\n\\bibliography{refs}\n\\end{document}\n')
+    return root
+
+
+def edit(directory):
+    '''
+    Appends a paragraph to the first included file
+    '''
+    with open(os.path.join(directory, 'part0.tex'), 'a') as f:
+        f.write(u'\n' + PARAGRAPH)
+
+
+def build(builder, root, trace, force, extra):
+    '''
+    Builds root with build.py and returns the wall time and the per-step
+    summary of the trace
+    '''
+    command = [sys.executable, BUILD, '--builder', builder, '--tex_root', root,
+               '--trace', trace] + (['--force'] if force else []) + extra
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        returncode = subprocess.call(command, stdout=devnull, stderr=subprocess.STDOUT,
+                                     cwd=os.path.dirname(root))
+    elapsed = time.time() - start
+
+    steps = {}
+    try:
+        with open(trace) as f:
+            events = json.load(f)['traceEvents']
+    except (IOError, OSError, ValueError):
+        events = []
+    for event in events:
+        if event.get('ph') != 'X' or event['cat'] == 'build':
+            continue
+        step = steps.setdefault(event['cat'], {'runs': 0, 'wall': 0.0, 'cpu': 0.0, 'peak_rss_mb': 0.0})
+        args = event['args']
+        step['runs'] += 1
+        step['wall'] += event['dur'] / 1e6
+        step['cpu'] += args.get('user_cpu_s', 0.0) + args.get('system_cpu_s', 0.0)
+        step['peak_rss_mb'] = max(step['peak_rss_mb'], args.get('peak_rss_mb', 0.0))
+    return returncode, elapsed, steps
+
+
+def run_case(builder, case, repeat, extra):
+    '''
+    Returns the best clean build and rebuild times of builder on case
+    '''
+    results = {}
+    for _ in range(repeat):
+        directory = tempfile.mkdtemp(prefix='pdfbuilder-bench')
+        try:
+            root = generate(directory, **CASES[case])
+            trace = os.path.join(directory, 'trace.json')
+            for scenario in ('clean', 'edit'):
+                if scenario == 'edit':
+                    edit(directory)
+                returncode, elapsed, steps = build(
+                    builder, root, trace, scenario == 'clean', extra)
+                best = results.get(scenario)
+                if best is None or elapsed < best['wall']:
+                    results[scenario] = {'wall': elapsed, 'returncode': returncode, 'steps': steps}
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, threshold):
+    '''
+    Returns the regressions of results against baseline as messages
+    '''
+    regressions = []
+    for key, scenarios in sorted(results.items()):
+        for scenario, result in sorted(scenarios.items()):
+            reference = baseline.get(key, {}).get(scenario)
+            if reference is None:
+                continue
+            if result['wall'] > reference['wall'] * (1 + threshold):
+                regressions.append(u'{0} {1}: {2:.2f} s, baseline {3:.2f} s (+{4:.0%})'.format(
+                    key, scenario, result['wall'], reference['wall'],
+                    result['wall'] / reference['wall'] - 1))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(u'--cases', nargs=u'+', default=['small'], choices=sorted(CASES),
+                        help=u'Document sizes to build')
+    parser.add_argument(u'--builders', nargs=u'+', default=sorted(BUILDERS), choices=sorted(BUILDERS),
+                        help=u'Builders to run')
+    parser.add_argument(u'--repeat', type=int, default=3, help=u'Runs per measurement, the best one is reported')
+    parser.add_argument(u'--baseline', type=str, default=DEFAULT_BASELINE,
+                        help=u'JSON file the results are compared with or saved to')
+    parser.add_argument(u'--save', action=u'store_true', default=False,
+                        help=u'Save the results as the new baseline instead of comparing')
+    parser.add_argument(u'--threshold', type=float, default=0.15,
+                        help=u'Slowdown relative to the baseline which counts as a regression')
+    parser.add_argument(u'--build_args', type=str, nargs=argparse.REMAINDER, default=[],
+                        help=u'Further arguments passed to build.py, e.g. --format_cache')
+    args = parser.parse_args()
+
+    results = {}
+    for builder in args.builders:
+        missing = [program for program in BUILDERS[builder] if which(program) is None]
+        if missing:
+            print(u'skipping {0}: {1} not found'.format(builder, u', '.join(missing)))
+            continue
+        for case in args.cases:
+            key = u'{0}/{1}'.format(builder, case)
+            results[key] = run_case(builder, case, args.repeat, args.build_args)
+            for scenario, result in sorted(results[key].items()):
+                steps = u', '.join(
+                    u'{0} {1:.2f} s'.format(name, step['wall'])
+                    for name, step in sorted(result['steps'].items(), key=lambda s: -s[1]['wall']))
+                print(u'{0:<24}{1:<7}{2:>8.2f} s{3}  {4}'.format(
+                    key, scenario, result['wall'],
+                    u'' if result['returncode'] == 0 else u' (failed)', steps))
+
+    if not results:
+        sys.exit(0)
+
+    if args.save:
+        data = {'machine': platform.node(), 'python': platform.python_version(),
+                'results': results}
+        with open(args.baseline, 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        print(u'baseline written to {0}'.format(args.baseline))
+        sys.exit(0)
+
+    if not os.path.exists(args.baseline):
+        print(u'no baseline at {0}, run with --save first'.format(args.baseline))
+        sys.exit(0)
+    with open(args.baseline) as f:
+        baseline = json.load(f)['results']
+    regressions = compare(results, baseline, args.threshold)
+    for regression in regressions:
+        print(u'REGRESSION ' + regression)
+    sys.exit(1 if regressions else 0)
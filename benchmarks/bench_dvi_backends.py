@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""Compares the routes of the edas builder from dvi to PDF: dvips piped into
+Ghostscript, dvips and Ghostscript with an intermediate PostScript file,
+and dvipdfmx.
+
+    python benchmarks/bench_dvi_backends.py --repeat 5
+
+The journal example is compiled with latex first; if latex is not
+installed, the dvi file committed with the example is used. Wall time and
+PDF size are reported for each route, as well as whether all fonts are
+embedded if pdffonts is available.
+"""
+from __future__ import print_function
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from pdf_builders.pdfBuilder import check_process, external_pipeline  # noqa: E402
+from pdf_builders.system import which  # noqa: E402
+
+EXAMPLE = os.path.join(ROOT, 'examples', 'journal', 'bare_jrnl_compsoc.tex')
+JOB_NAME = u'LaTeX'
+
+# the flags used by EdasBuilder
+GS = [u'gs', u'-dNOPAUSE', u'-dBATCH', u'-dPDFSETTINGS=/prepress', u'-dCompatibilityLevel=1.4',
+      u'-dSubsetFonts=true', u'-dEmbedAllFonts=true', u'-sDEVICE=pdfwrite',
+      u'-sOutputFile=' + JOB_NAME + u'.pdf', u'-c', u'save pop', u'-f']
+
+
+def dvips_pipe(directory):
+    pipeline = external_pipeline(
+        [[u'dvips', u'-q', u'-o', u'-', JOB_NAME + u'.dvi'], GS + [u'-']], cwd=directory)
+    check_process(pipeline, line_callback=lambda line: None)
+
+
+def dvips_file(directory):
+    for command in ([u'dvips', u'-q', u'-o', JOB_NAME + u'.ps', JOB_NAME + u'.dvi'],
+                    GS + [JOB_NAME + u'.ps']):
+        run(command, directory)
+
+
+def dvipdfmx(directory):
+    run([u'dvipdfmx', u'-q', u'-V', u'4', u'-o', JOB_NAME + u'.pdf', JOB_NAME + u'.dvi'], directory)
+
+
+ROUTES = (
+    (u'dvips | gs', (u'dvips', u'gs'), dvips_pipe),
+    (u'dvips, gs (.ps file)', (u'dvips', u'gs'), dvips_file),
+    (u'dvipdfmx', (u'dvipdfmx',), dvipdfmx),
+)
+
+
+def run(command, directory):
+    with open(os.devnull, 'r+') as devnull:
+        subprocess.check_call(command, cwd=directory, stdin=devnull, stdout=devnull, stderr=subprocess.STDOUT)
+
+
+def prepare(directory):
+    '''
+    Writes the dvi file of the example to directory
+    '''
+    shutil.copy(EXAMPLE, directory)
+    if which(u'latex') is None:
+        print(u'latex not found, using the committed dvi file')
+        shutil.copy(os.path.join(os.path.dirname(EXAMPLE), JOB_NAME + u'.dvi'), directory)
+        return
+    for _ in range(2):
+        run([u'latex', u'-interaction=nonstopmode', u'-jobname=' + JOB_NAME,
+             os.path.basename(EXAMPLE)], directory)
+
+
+def fonts_embedded(pdf):
+    '''
+    Returns whether pdffonts lists every font of pdf as embedded, or None
+    if pdffonts is not available
+    '''
+    if which(u'pdffonts') is None:
+        return None
+    output = subprocess.check_output([u'pdffonts', pdf]).decode('utf-8', 'ignore')
+    # emb is the fifth column from the end, after the two header lines
+    return all(row.split()[-5] == u'yes' for row in output.splitlines()[2:] if row.strip())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(u'--repeat', type=int, default=5, help=u'Runs per route, the best one is reported')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='pdfbuilder-bench')
+    try:
+        prepare(directory)
+        pdf = os.path.join(directory, JOB_NAME + u'.pdf')
+        # printed at the end, as the pipeline prints the commands it runs
+        table = [u'{0:<24}{1:>10}{2:>12}{3:>16}'.format(u'route', u'wall s', u'size KB', u'fonts embedded')]
+        for name, programs, convert in ROUTES:
+            missing = [program for program in programs if which(program) is None]
+            if missing:
+                table.append(u'{0:<24}skipped, {1} not found'.format(name, u', '.join(missing)))
+                continue
+            best = None
+            for _ in range(args.repeat):
+                if os.path.exists(pdf):
+                    os.remove(pdf)
+                start = time.time()
+                convert(directory)
+                elapsed = time.time() - start
+                best = elapsed if best is None else min(best, elapsed)
+            embedded = fonts_embedded(pdf)
+            table.append(u'{0:<24}{1:>10.3f}{2:>12.1f}{3:>16}'.format(
+                name, best, os.path.getsize(pdf) / 1024.0,
+                u'n/a' if embedded is None else (u'yes' if embedded else u'NO')))
+        print(u'\n'.join(table))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""Micro-benchmark of the single pass log index against the regular
+expression scans the builders and texliveonfly used to run on every output.
+
+    python benchmarks/bench_log_parser.py --size 100
+
+The builders only attribute events to source files when bad boxes are
+displayed, which the previous scans could not do at all; the "with files"
+row is that opt-in work on top of the default index.
+"""
+from __future__ import print_function
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pdf_builders.logParser import LogIndex, MISSING_FILE, UNDEFINED_CITATION  # noqa: E402
+
+# the scans done by BasicBuilder.commands() on the output of a pass
+FILE_WRITE_ERROR_REGEX = re.compile(r"! I can't write on file `(.*)/([^/']*)'")
+FILE_NOT_FOUND_ERROR_REGEX = re.compile(
+    r"! LaTeX Error: File `(.*)/([^/']*)'", re.MULTILINE)
+CITATIONS_REGEX = re.compile(
+    r"Warning: Citation [`|'].+' (?:on page \d+ )?undefined")
+BIBLATEX_REGEX = re.compile(
+    r"Package biblatex Warning: Please \(re\)run (\S*)")
+RERUN_REGEX = re.compile(
+    r"(?:Rerun to get |Rerun LaTeX|Please rerun LaTeX|\(rerunfilecheck\) +Rerun)")
+
+# one page of output of a figure heavy document
+PAGE = [
+    u"<figures/fig{page}.pdf, id={page}, 345.0pt x 200.0pt>",
+    u"File: figures/fig{page}.pdf Graphic file (type pdf)",
+    u"<use figures/fig{page}.pdf>",
+    u"Package pdftex.def Info: figures/fig{page}.pdf  used on input line {line}.",
+    u"(pdftex.def)             Requested size: 345.0pt x 200.0pt.",
+    u"LaTeX Font Info:    Font shape `T1/cmr/bx/it' in size <10> not available",
+    u"(Font)              Font shape `T1/cmr/b/it' tried instead on input line {line}.",
+    u" [{page} <./figures/fig{page}.pdf>]",
+]
+
+# warnings added to every --warnings'th page
+WARNINGS = [
+    u"Overfull \\hbox (1.{page}pt too wide) in paragraph at lines {line}--{next}",
+    u"[]\\T1/cmr/m/n/10 Some text of the paragraph which is too wide for the line",
+    u"",
+    u"Underfull \\vbox (badness 10000) has occurred while \\output is active []",
+    u"",
+    u"LaTeX Warning: Reference `sec:{page}' on page {page} undefined on input line {line}.",
+    u"",
+    u"LaTeX Warning: Citation `key{page}' on page {page} undefined on input line {next}.",
+    u"",
+]
+
+TAIL = [
+    u"Package natbib Warning: There were undefined citations.",
+    u"",
+    u"LaTeX Warning: Label(s) may have changed. Rerun to get cross-references right.",
+    u"",
+    u"! LaTeX Error: File `missing.sty' not found.",
+    u"",
+    u"Type X to quit or <RETURN> to proceed,",
+    u"or enter new name. (Default extension: sty)",
+    u"",
+    u"! Emergency stop.",
+    u"<read *> ",
+    u"l.12 \\usepackage",
+    u"",
+]
+
+
+def synthetic_log(size, warnings=10):
+    """
+    Returns a synthetic log of roughly size characters, made of chapters
+    which each open a file. Every warnings'th page produces bad boxes and
+    warnings.
+    """
+    chunks = [u"This is pdfTeX, Version 3.14159265-2.6-1.40.20 (TeX Live 2019)",
+              u"(./document.tex", u"LaTeX2e <2018-12-01>"]
+    length = 0
+    page = 0
+    while length < size:
+        chapter = [u"(./chapters/chapter{0}.tex".format(page)]
+        for _ in range(10):
+            page += 1
+            lines = PAGE + WARNINGS if page % warnings == 0 else PAGE
+            chapter.extend(
+                line.format(page=page, line=page * 10, next=page * 10 + 5)
+                for line in lines)
+        chapter.append(u")")
+        length += sum(len(line) + 1 for line in chapter)
+        chunks.extend(chapter)
+    chunks.extend(TAIL)
+    chunks.append(u")")
+    return u"\n".join(chunks)
+
+
+def multi_regex(text):
+    """
+    The scans previously run on every output, see BasicBuilder.commands()
+    and the main loop of texliveonfly.py.
+    """
+    start = 0
+    while True:
+        match = FILE_WRITE_ERROR_REGEX.search(text, start)
+        if not match:
+            break
+        start = match.end(1)
+    FILE_NOT_FOUND_ERROR_REGEX.search(text)
+    missing_citations = bool(CITATIONS_REGEX.search(text))
+    BIBLATEX_REGEX.search(text)
+    'Package natbib Warning: There were undefined citations' in text
+    RERUN_REGEX.search(text)
+
+    files = re.findall(r"! LaTeX Error: File `([^`']*)' not found", text) + \
+        re.findall(r"! I can't find file `([^`']*)'.", text)
+    re.findall(r"! Font \\[^=]*=([^\s]*)\s", text)
+    re.findall(r"! Font [^\n]*file\:([^\:\n]*)\:", text) + \
+        re.findall(r"! Font \\[^/]*/([^/]*)/", text)
+    return files, missing_citations
+
+
+def single_pass(text, track_files):
+    index = LogIndex.parse(text, track_files)
+    files = [e.data for e in index.events(MISSING_FILE)]
+    return files, index.has(UNDEFINED_CITATION)
+
+
+def best_of(repeat, func, *args):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.time()
+        result = func(*args)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(u'--size', type=float, default=100, help=u'Size of the synthetic log in MB')
+    parser.add_argument(u'--warnings', type=int, default=10,
+                        help=u'Every how many pages bad boxes and warnings are produced')
+    parser.add_argument(u'--repeat', type=int, default=3, help=u'Runs per approach, the best one is reported')
+    args = parser.parse_args()
+
+    text = synthetic_log(int(args.size * 1024 * 1024), args.warnings)
+    print(u'synthetic log: {0:.1f} MB, {1} lines'.format(
+        len(text) / 1024.0 / 1024.0, text.count(u'\n') + 1))
+
+    baseline, expected = best_of(args.repeat, multi_regex, text)
+    print(u'{0:<32}{1:>10.3f} s'.format(u'multiple regular expressions', baseline))
+    for track_files in (False, True):
+        elapsed, result = best_of(args.repeat, single_pass, text, track_files)
+        assert result == expected, (result, expected)
+        print(u'{0:<32}{1:>10.3f} s {2:>6.2f}x'.format(
+            u'log index' + (u' (with files)' if track_files else u''),
+            elapsed, baseline / elapsed))
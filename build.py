@@ -3,76 +3,481 @@ from __future__ import print_function
 from pdf_builders.basicBuilder import BasicBuilder
 from pdf_builders.traditionalBuilder import TraditionalBuilder
 from pdf_builders.edasBuilder import EdasBuilder
-from pdf_builders.pdfBuilder import check_output
+from pdf_builders.buildDaemon import BuildDaemon, default_socket_path, request_builds
+from pdf_builders.buildRunner import build_steps
+from pdf_builders.pdfBuilder import check_process
+from pdf_builders.system import available_memory, default_jobs
+from pdf_builders.trace import Tracer
+from pdf_builders.watcher import make_watcher
+from multiprocessing.pool import ThreadPool
 import argparse
+import glob
 import os
-from subprocess import CalledProcessError
-from six import string_types, reraise
+import threading
+import time
 
 
-def run(pdf_builder, local_cwd=os.getcwd()):
+def run(pdf_builder, local_cwd=os.getcwd(), force=False, tracer=None):
     """
+    Runs all commands of pdf_builder, unless the build manifest of the
+    previous successful build shows that nothing changed since.
 
-    :param pdf_builder:
-    :param local_cwd:
-    :return:
+    :param pdf_builder: the builder to run
+    :param local_cwd: directory the commands are run in
+    :param force: build even if the previous build is up to date
+    :param tracer: optional Tracer recording every command and the build
+    :return: True if the build succeeded
     """
     if pdf_builder is None:
-        return
-    print(local_cwd)
-    for cmd in pdf_builder.commands():
+        return False
+    steps = build_steps(pdf_builder, local_cwd, force, tracer)
+    step = next(steps)
+    while not isinstance(step, bool):
         try:
-            if isinstance(cmd, tuple):
-                print(cmd[1])
-                out = check_output(cmd[0], cwd=local_cwd)
-                builder.set_output(out)
-            elif isinstance(cmd, string_types):
-                print(cmd)
-        except CalledProcessError as e:
-            print(e.output)
-            print(e.stderr)
+            out = check_process(step, line_callback=pdf_builder.feed_output)
+        except Exception as e:
+            step = steps.throw(e)
+        else:
+            step = steps.send(out)
+    return step
+
+
+BUILDERS = {
+    'traditional': (TraditionalBuilder, u'pdftex'),
+    'basic': (BasicBuilder, u'pdftex'),
+    'edas': (EdasBuilder, u'latex')
+}
+
+
+def expand_roots(patterns, root_list=None):
+    """
+    Expands glob patterns and the entries of a list file into root files.
+
+    :param patterns: root files or glob patterns
+    :param root_list: optional file with one root file or pattern per line
+    :return: list of root files without duplicates, in order
+    """
+    patterns = list(patterns)
+    if root_list is not None:
+        with open(root_list) as f:
+            patterns.extend(
+                line.strip() for line in f
+                if line.strip() and not line.startswith('#')
+            )
+
+    roots = []
+    for pattern in patterns:
+        for tex_root in sorted(glob.glob(pattern)) or [pattern]:
+            tex_root = os.path.normpath(os.path.abspath(tex_root))
+            if tex_root not in roots:
+                roots.append(tex_root)
+    return roots
+
+
+def make_builder(args, tex_root, builder_settings, job_name=None):
+    """
+    Creates a new builder for tex_root as configured on the command line.
+
+    :param args: parsed command line arguments
+    :param tex_root: path to the LaTeX root file
+    :param builder_settings: builder settings, copied for the builder
+    :param job_name: job name, defaults to --jobname
+    :return: the builder or None if the builder is unknown
+    """
+    if args.builder not in BUILDERS:
+        return None
+    builder_class, engine = BUILDERS[args.builder]
+    return builder_class(tex_root, None, engine, None, args.aux_directory,
+                         args.aux_directory, job_name or args.jobname, None,
+                         dict(builder_settings), {})
+
+
+def root_job_name(args, tex_root, single):
+    """
+    Returns the job name of tex_root. With several roots every job needs
+    its own job name, as roots may share a directory.
+    """
+    if single:
+        return None
+    return args.jobname or os.path.splitext(os.path.basename(tex_root))[0]
+
+
+def build_root(args, tex_root, builder_settings, job_name=None, tracer=None):
+    """
+    Builds a single root file in its own directory.
+
+    :return: True if the build succeeded
+    """
+    builder = make_builder(args, tex_root, builder_settings, job_name)
+    local_cwd = os.path.normpath(os.path.abspath(os.path.dirname(tex_root)))
+    return run(builder, local_cwd, args.force, tracer)
+
+
+def build_all(args, roots, builder_settings, tracer=None):
+    """
+    Builds all roots on a pool of args.jobs workers, each with its own
+    builder. A job is only started when enough memory is available for it,
+    unless no other job is running.
+
+    :return: list of roots whose build failed
+    """
+    job_memory = args.job_memory * 1024 * 1024
+    jobs = min(args.jobs or default_jobs(job_memory), len(roots))
+    single = len(roots) == 1
+
+    lock = threading.Lock()
+    running = [0]
+
+    def job(tex_root):
+        while True:
+            with lock:
+                memory = available_memory()
+                if running[0] == 0 or memory is None or memory >= job_memory:
+                    running[0] += 1
+                    break
+            time.sleep(0.5)
+        try:
+            job_name = root_job_name(args, tex_root, single)
+            return build_root(args, tex_root, builder_settings, job_name, tracer)
+        except Exception as e:
+            print(u'Building {0} failed: {1}'.format(tex_root, e))
+            return False
+        finally:
+            with lock:
+                running[0] -= 1
+
+    if jobs <= 1:
+        results = [job(tex_root) for tex_root in roots]
+    else:
+        pool = ThreadPool(jobs)
+        try:
+            results = pool.map(job, roots)
+        finally:
+            pool.close()
+            pool.join()
+
+    return [tex_root for tex_root, ok in zip(roots, results) if not ok]
+
+
+def build_all_asyncio(args, roots, builder_settings, tracer=None):
+    """
+    Builds all roots concurrently from one asyncio event loop, up to
+    args.jobs at a time. Every command is killed after
+    args.command_timeout seconds, if given. Requires Python 3.7.
+
+    :return: list of roots whose build failed
+    """
+    from pdf_builders.asyncRunner import build_all as run_all
+
+    job_memory = args.job_memory * 1024 * 1024
+    jobs = min(args.jobs or default_jobs(job_memory), len(roots))
+    single = len(roots) == 1
+    builds = [
+        (make_builder(args, tex_root, builder_settings,
+                      root_job_name(args, tex_root, single)),
+         os.path.normpath(os.path.abspath(os.path.dirname(tex_root))))
+        for tex_root in roots
+    ]
+    results = run_all(builds, jobs, args.force, tracer, args.command_timeout)
+    return [tex_root for tex_root, ok in zip(roots, results) if not ok]
+
+
+def daemon_request(args, tex_root, builder_settings, job_name=None):
+    """
+    Describes the build of tex_root for the build daemon.
+
+    :return: request understood by request_builder()
+    """
+    settings = dict(builder_settings)
+    # the working directory of the daemon differs from ours
+    for name, value in list(settings.items()):
+        if name.endswith(('_directory', '_root')) and value:
+            settings[name] = os.path.abspath(value)
+    return {
+        'tex_root': tex_root,
+        'job_name': job_name or args.jobname,
+        'builder': args.builder,
+        'aux_directory': args.aux_directory,
+        'force': args.force,
+        'settings': settings
+    }
+
+
+def request_builder(request):
+    """
+    Creates the builder of a request sent to the build daemon, see
+    daemon_request().
+    """
+    args = argparse.Namespace(builder=request['builder'], jobname=None,
+                              aux_directory=request['aux_directory'])
+    return make_builder(args, request['tex_root'], request['settings'],
+                        request['job_name'])
+
+
+def build_with_daemon(args, roots, builder_settings):
+    """
+    Has the build daemon listening on args.daemon_socket build all roots.
+
+    :return: list of roots whose build failed, or None if no daemon is
+        running
+    """
+    single = len(roots) == 1
+    builds = [
+        daemon_request(args, tex_root, builder_settings,
+                       root_job_name(args, tex_root, single))
+        for tex_root in roots
+    ]
+    return request_builds(args.daemon_socket, builds)
+
+
+def serve(args):
+    """
+    Runs the build daemon until interrupted, building the roots requested
+    by clients up to args.jobs at a time.
+    """
+    jobs = args.jobs or default_jobs(args.job_memory * 1024 * 1024)
+    daemon = BuildDaemon(
+        args.daemon_socket, jobs, request_builder,
+        lambda builder, local_cwd, force: run(builder, local_cwd, force))
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def watch(args, roots, builder_settings, tracer=None):
+    """
+    Builds all roots and rebuilds a root whenever one of the files its last
+    build read changes, until interrupted. Bursts of changes are debounced
+    and a build superseded by a change is cancelled rather than finished.
+    """
+    watcher = make_watcher()
+    debounce = args.debounce / 1000.0
+    single = len(roots) == 1
+    dependencies = dict((tex_root, set([tex_root])) for tex_root in roots)
+    # tex_root -> (builder, thread) of the current build
+    running = {}
+    # (tex_root, builder, dependencies) of completed builds, appended by
+    # the build threads
+    finished = []
+
+    def job(tex_root, builder, force):
+        try:
+            run(builder, os.path.dirname(tex_root), force, tracer)
+        except Exception as e:
+            print(u'Building {0} failed: {1}'.format(tex_root, e))
+        finished.append((tex_root, builder, builder.dependencies()))
+
+    def start(tex_root, force=False):
+        if tex_root in running:
+            builder, thread = running.pop(tex_root)
+            builder.cancel()
+            thread.join()
+        job_name = root_job_name(args, tex_root, single)
+        builder = make_builder(args, tex_root, builder_settings, job_name)
+        thread = threading.Thread(target=job, args=(tex_root, builder, force))
+        thread.daemon = True
+        running[tex_root] = (builder, thread)
+        thread.start()
+
+    for tex_root in roots:
+        start(tex_root, args.force)
+        # files recorded by a previous run are watched from the start
+        dependencies[tex_root].update(running[tex_root][0].dependencies())
+
+    try:
+        while True:
+            while finished:
+                tex_root, builder, paths = finished.pop(0)
+                if running.get(tex_root, (None,))[0] is builder:
+                    del running[tex_root]
+                # a build which failed early or was cancelled may not have
+                # recorded everything
+                if builder.cancelled:
+                    dependencies[tex_root].update(paths)
+                elif len(paths) > 1:
+                    dependencies[tex_root] = set(paths)
+
+            watcher.watch(set().union(*dependencies.values()))
+            # wake up regularly while builds run to pick up their results
+            changed = watcher.wait(0.5 if running else None)
+            if not changed:
+                continue
+            # wait until no file changed for the debounce interval
+            while True:
+                more = watcher.wait(debounce)
+                if not more:
+                    break
+                changed |= more
+
+            for tex_root in roots:
+                if changed & dependencies[tex_root]:
+                    print(u'{0} changed, building {1}'.format(
+                        u', '.join(sorted(os.path.basename(path) for path in changed)),
+                        tex_root))
+                    start(tex_root)
+    except KeyboardInterrupt:
+        for builder, thread in running.values():
+            builder.cancel()
+            thread.join()
+    finally:
+        watcher.close()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument(u'--texpath', type=str, default=u'', help=u'Path used when invoking tex & friends')
-    parser.add_argument(u'--tex_root', type=str, default=os.getcwd(), help=u'Path to LaTeX root file')
+    parser.add_argument(u'--tex_root', type=str, nargs=u'+', default=None,
+                        help=u'Paths or glob patterns of LaTeX root files')
+    parser.add_argument(u'--root_list', type=str, default=None,
+                        help=u'File listing one LaTeX root file or glob pattern per line')
+    parser.add_argument(u'--jobs', type=int, default=0,
+                        help=u'Number of roots built concurrently, defaults to what cores and memory allow')
+    parser.add_argument(u'--job_memory', type=int, default=512,
+                        help=u'Memory in MB reserved for each concurrent build')
     parser.add_argument(u'--output_directory', type=str, default=None, help=u'Output directory')
     parser.add_argument(u'--aux_directory', type=str, default=None, help=u'Aux directory')
-    parser.add_argument(u'--jobname', type=str, default=u'LaTeX', help=u'Job name')
+    parser.add_argument(u'--jobname', type=str, default=None,
+                        help=u'Job name, defaults to LaTeX for a single root and to the root file name otherwise')
     parser.add_argument(u'--builder', type=str, default='traditional', help=u'Which builder to use')
     parser.add_argument(u'--builder_path', type=str, default=u'', help=u'Path to builder')
+    parser.add_argument(u'--watch', action=u'store_true', default=False,
+                        help=u'Rebuild whenever a file read by the last build changes')
+    parser.add_argument(u'--debounce', type=int, default=200,
+                        help=u'Time in ms without changes after which --watch starts a build')
+    parser.add_argument(u'--trace', type=str, default=None,
+                        help=u'Write a Chrome trace (chrome://tracing, Perfetto) of all build steps with their '
+                             u'CPU time and peak memory to this file, and print a summary')
+    parser.add_argument(u'--asyncio', action=u'store_true', default=False,
+                        help=u'Run the builds from one asyncio event loop instead of a thread each (Python 3.7+)')
+    parser.add_argument(u'--command_timeout', type=float, default=None,
+                        help=u'With --asyncio, kill any command running longer than this many seconds')
+    parser.add_argument(u'--force', action=u'store_true', default=False,
+                        help=u'Build even if nothing changed since the last successful build')
+    parser.add_argument(u'--daemon', action=u'store_true', default=False,
+                        help=u'Serve build requests of later invocations on a Unix socket until interrupted, '
+                             u'keeping warm engines and workers between builds')
+    parser.add_argument(u'--daemon_socket', type=str, default=None,
+                        help=u'Socket of the build daemon, defaults to ~/.cache/pdfbuilder/daemon.sock')
+    parser.add_argument(u'--no_daemon', action=u'store_true', default=False,
+                        help=u'Build in this process even if a build daemon is running')
     group = parser.add_argument_group('builder_settings')
     group.add_argument(u'--display_log', action="store_true", default=True, help=u'Whether to display log')
     group.add_argument(u'--display_bad_boxes', action='store_true', default=False, help=u'Whether to display bad boxes')
+    group.add_argument(u'--stream_output', action=u'store_true', default=False,
+                       help=u'Print the output of every command while it runs')
+    group.add_argument(u'--no_build_cache', dest=u'build_cache', action=u'store_false', default=True,
+                       help=u'Do not record or use the build manifest')
+    group.add_argument(u'--max_passes', type=int, default=5,
+                       help=u'Maximum number of engine passes run to resolve references')
+    group.add_argument(u'--format_cache', action=u'store_true', default=False,
+                       help=u'Load the preamble from a cached precompiled format (needs mylatexformat)')
+    group.add_argument(u'--format_cache_directory', type=str, default=None,
+                       help=u'Directory of the format cache, defaults to ~/.cache/pdfbuilder/formats')
+    group.add_argument(u'--format_cache_size', type=int, default=512,
+                       help=u'Size limit of the format cache in MB')
+    group.add_argument(u'--warm_engines', type=int, default=0,
+                       help=u'Number of engines kept running with the preamble loaded, waiting for the next pass')
+    group.add_argument(u'--dvi_backend', type=str, default=u'dvips', choices=[u'dvips', u'dvipdfmx'],
+                       help=u'How the edas builder converts the dvi file: dvips and Ghostscript, or dvipdfmx')
+    group.add_argument(u'--keep_ps', action=u'store_true', default=False,
+                       help=u'Write the intermediate PostScript file of the edas builder instead of piping '
+                            u'dvips into Ghostscript')
+    group.add_argument(u'--gs_worker', action=u'store_true', default=False,
+                       help=u'Convert the PostScript files of the edas builder with Ghostscript processes kept '
+                            u'running for all builds of the session')
+    group.add_argument(u'--aux_tools', type=str, nargs=u'*', default=None,
+                       help=u'Auxiliary tools run between passes when their input changed, of makeindex, '
+                            u'nomencl and glossaries; all of them by default')
+    group.add_argument(u'--draft_includeonly', action=u'store_true', default=False,
+                       help=u'Compile only the \\include\'d files changed since the last build, reusing the .aux '
+                            u'files of the others (basic builder)')
+    group.add_argument(u'--shard_jobs', type=int, default=0,
+                       help=u'Compile the \\include\'d files of the basic builder as separate jobs, this many at '
+                            u'the same time, and merge their PDFs (needs pypdf)')
+    group.add_argument(u'--tikz_cache', action=u'store_true', default=False,
+                       help=u'Externalize TikZ figures through a shared cache, compiling missing ones concurrently '
+                            u'(basic builder, needs the external library of TikZ)')
+    group.add_argument(u'--tikz_cache_directory', type=str, default=None,
+                       help=u'Directory of the figure cache, defaults to ~/.cache/pdfbuilder/figures')
+    group.add_argument(u'--tikz_cache_size', type=int, default=512,
+                       help=u'Size limit of the figure cache in MB')
+    group.add_argument(u'--tikz_jobs', type=int, default=0,
+                       help=u'Number of figures compiled at the same time, defaults to the number of cores')
+    group.add_argument(u'--scratch_aux', action=u'store_true', default=False,
+                       help=u'Run all passes in a scratch directory on a RAM-backed file system, copying back only '
+                            u'the PDF, synctex and auxiliary files which changed')
+    group.add_argument(u'--scratch_root', type=str, default=None,
+                       help=u'Directory scratch directories are made in, defaults to /dev/shm or the temporary '
+                            u'directory')
     group.add_argument(u'--open_pdf_on_build', action=u'store_true', default=True, help=u'Whether to open PDF after '
                                                                                         u'build')
     args = parser.parse_args()
+    args.daemon_socket = args.daemon_socket or default_socket_path()
 
     builder_settings = {
         'builder_path': args.builder_path,
         'display_log': args.display_log,
         'display_bad_boxes': args.display_bad_boxes,
-        'open_pdf_on_build': args.open_pdf_on_build
+        'open_pdf_on_build': args.open_pdf_on_build,
+        'build_cache': args.build_cache,
+        'max_passes': args.max_passes,
+        'stream_output': args.stream_output,
+        'format_cache': args.format_cache,
+        'format_cache_directory': args.format_cache_directory,
+        'format_cache_size': args.format_cache_size,
+        'warm_engines': args.warm_engines,
+        'dvi_backend': args.dvi_backend,
+        'keep_ps': args.keep_ps,
+        'gs_worker': args.gs_worker,
+        'aux_tools': args.aux_tools,
+        'draft_includeonly': args.draft_includeonly,
+        'shard_jobs': args.shard_jobs,
+        'tikz_cache': args.tikz_cache,
+        'tikz_cache_directory': args.tikz_cache_directory,
+        'tikz_cache_size': args.tikz_cache_size,
+        'tikz_jobs': args.tikz_jobs,
+        'scratch_aux': args.scratch_aux,
+        'scratch_root': args.scratch_root
     }
 
-    cur_working_dir = os.path.normpath(os.path.abspath(os.path.dirname(args.tex_root)))
-
-    builder = None
-    if args.builder == 'traditional':
-        builder = TraditionalBuilder(args.tex_root, None, u'pdftex', None, args.aux_directory,
-                                     args.aux_directory, args.jobname, None, builder_settings, {})
-    elif args.builder == 'basic':
-        builder = BasicBuilder(args.tex_root, None, u'pdftex', None, args.aux_directory,
-                                     args.aux_directory, args.jobname, None, builder_settings, {})
-    elif args.builder == 'edas':
-        builder = EdasBuilder(args.tex_root, None, u'latex', None, args.aux_directory,
-                                     args.aux_directory, args.jobname, None, builder_settings, {})
-    else:
+    if args.builder not in BUILDERS:
         print('Unknown builder: {}'.format(args.builder))
         parser.print_usage()
         exit(1)
 
-    run(builder, cur_working_dir)
+    if args.daemon:
+        serve(args)
+        exit(0)
+
+    roots = expand_roots(args.tex_root or ([] if args.root_list else [os.getcwd()]), args.root_list)
+    if len(roots) == 1:
+        args.jobname = args.jobname or u'LaTeX'
+
+    tracer = Tracer() if args.trace else None
+
+    def write_trace():
+        if tracer is not None:
+            tracer.write_chrome_trace(args.trace)
+            print(tracer.summary())
+            print(u'Trace written to {0}'.format(args.trace))
 
+    if args.watch:
+        watch(args, roots, builder_settings, tracer)
+        write_trace()
+        exit(0)
 
+    # a running build daemon saves starting the builders here
+    failed = None
+    if not (args.no_daemon or args.asyncio or tracer is not None):
+        failed = build_with_daemon(args, roots, builder_settings)
+    if failed is None and args.asyncio:
+        failed = build_all_asyncio(args, roots, builder_settings, tracer)
+    elif failed is None:
+        failed = build_all(args, roots, builder_settings, tracer)
+    if len(roots) > 1:
+        print(u'{0} of {1} builds succeeded.'.format(len(roots) - len(failed), len(roots)))
+        for tex_root in failed:
+            print(u'failed: {0}'.format(tex_root))
+    write_trace()
+    exit(1 if failed else 0)
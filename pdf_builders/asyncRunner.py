@@ -0,0 +1,148 @@
+# asyncio driver for the builders, Python 3.7+ only.
+#
+# The commands are started like in build.run(), so that they run in a
+# session of their own and are reaped with wait4 (see trace) rather than
+# by the child watcher of asyncio; the output of processes with a single
+# output pipe is read on the event loop. Everything which blocks, i.e. the
+# logic of the builders between commands and any other process, runs in
+# the default executor.
+import asyncio
+import os
+import subprocess
+from functools import partial
+from pdf_builders.buildRunner import build_steps
+from pdf_builders.pdfBuilder import check_process, kill_process, start_command
+from pdf_builders.trace import wait_process
+
+# TeX wraps its output, but other tools may write long lines
+LINE_LIMIT = 16 * 1024 * 1024
+
+
+def _can_stream(process):
+    # pipes of Popen objects can only be added to the event loop on POSIX
+    return (
+        os.name == 'posix' and process.stderr is None and
+        getattr(process.stdout, 'fileno', None) is not None
+    )
+
+
+async def _stream(process, line_callback):
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=LINE_LIMIT)
+    transport, _ = await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), process.stdout)
+    lines = []
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            line = line.decode('utf-8', 'ignore').rstrip(u'\r\n')
+            lines.append(line)
+            if line_callback is not None:
+                line_callback(line)
+    finally:
+        transport.close()
+
+    await loop.run_in_executor(None, wait_process, process)
+    stdout = u'\n'.join(lines).rstrip()
+    if process.returncode:
+        e = subprocess.CalledProcessError(
+            process.returncode, getattr(process, 'args', None))
+        e.output = stdout
+        e.stderr = u''
+        raise e
+    return stdout
+
+
+async def run_process(process, line_callback=None, timeout=None):
+    '''
+    Awaitable check_process(): waits for process, a Popen-like object,
+    passing its output to line_callback line by line.
+    Returns its output if the process was successful.
+    Raises CalledProcessError if it failed and subprocess.TimeoutExpired
+    if it took longer than timeout seconds. The process is killed on a
+    timeout and when the awaiting task is cancelled
+    '''
+    loop = asyncio.get_running_loop()
+    if _can_stream(process):
+        waiter = _stream(process, line_callback)
+    else:
+        waiter = loop.run_in_executor(
+            None, partial(check_process, process, line_callback=line_callback))
+    try:
+        return await asyncio.wait_for(waiter, timeout)
+    except asyncio.TimeoutError:
+        kill_process(process)
+        await loop.run_in_executor(None, wait_process, process)
+        raise subprocess.TimeoutExpired(
+            getattr(process, 'args', None), timeout)
+    except asyncio.CancelledError:
+        kill_process(process)
+        await asyncio.shield(loop.run_in_executor(None, wait_process, process))
+        raise
+
+
+async def run_command(command, cwd=None, line_callback=None, timeout=None):
+    '''
+    Starts command, a list of arguments, like build.run() starts the
+    commands of the builders and awaits it, see run_process()
+    '''
+    return await run_process(
+        start_command(command, cwd), line_callback, timeout)
+
+
+async def run_builder(pdf_builder, local_cwd, force=False, tracer=None,
+                      timeout=None):
+    '''
+    Awaitable build.run(): runs all commands of pdf_builder, each of which
+    is killed if it takes longer than timeout seconds. Cancelling the task
+    cancels the build.
+    Returns True if the build succeeded
+    '''
+    if pdf_builder is None:
+        return False
+    loop = asyncio.get_running_loop()
+    steps = build_steps(pdf_builder, local_cwd, force, tracer)
+    # the builder reads and hashes files between commands
+    step = await loop.run_in_executor(None, next, steps)
+    while not isinstance(step, bool):
+        try:
+            out = await run_process(step, pdf_builder.feed_output, timeout)
+        except asyncio.CancelledError:
+            pdf_builder.cancel()
+            steps.close()
+            raise
+        except Exception as e:
+            step = await loop.run_in_executor(None, steps.throw, e)
+        else:
+            step = await loop.run_in_executor(None, steps.send, out)
+    return step
+
+
+async def run_builders(builds, jobs, force=False, tracer=None, timeout=None):
+    '''
+    Runs the (builder, cwd) pairs of builds with up to jobs of them at the
+    same time. Returns whether each of them succeeded
+    '''
+    semaphore = asyncio.Semaphore(max(jobs, 1))
+
+    async def build(pdf_builder, local_cwd):
+        async with semaphore:
+            try:
+                return await run_builder(
+                    pdf_builder, local_cwd, force, tracer, timeout)
+            except Exception as e:
+                print(u'Building {0} failed: {1}'.format(
+                    getattr(pdf_builder, 'tex_root', local_cwd), e))
+                return False
+
+    return await asyncio.gather(
+        *[build(pdf_builder, local_cwd) for pdf_builder, local_cwd in builds])
+
+
+def build_all(builds, jobs, force=False, tracer=None, timeout=None):
+    '''
+    Blocking entry point of run_builders(), running its own event loop
+    '''
+    return asyncio.run(run_builders(builds, jobs, force, tracer, timeout))
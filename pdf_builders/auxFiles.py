@@ -0,0 +1,171 @@
+import hashlib
+import os
+import re
+
+# \@input{chapter.aux} lines written for \include'd files
+AUX_INPUT_REGEX = re.compile(r"^\\@input\{([^}]*)\}")
+BIBDATA_REGEX = re.compile(r"^\\bibdata\{([^}]*)\}")
+BIBSTYLE_REGEX = re.compile(r"^\\bibstyle\{([^}]*)\}")
+# biblatex control file data sources
+BCF_DATASOURCE_REGEX = re.compile(
+    r"<bcf:datasource[^>]*>([^<]*)</bcf:datasource>")
+
+
+def read_lines(path):
+    '''
+    Returns the lines of a text file or an empty list if it cannot be read
+    '''
+    try:
+        with open(path, 'rb') as f:
+            return f.read().decode('utf-8', 'ignore').splitlines()
+    except (IOError, OSError):
+        return []
+
+
+def aux_lines(aux_directory, job_name):
+    '''
+    Returns all lines of the main .aux file of job_name, following the
+    \\@input{...} lines written for \\include'd files
+    '''
+    lines = []
+    pending = [job_name + u'.aux']
+    seen = set()
+    while pending:
+        name = pending.pop(0)
+        if name in seen:
+            continue
+        seen.add(name)
+        for line in read_lines(os.path.join(aux_directory, name)):
+            lines.append(line)
+            m = AUX_INPUT_REGEX.match(line)
+            if m:
+                pending.append(m.group(1))
+    return lines
+
+
+def included_parts(aux_directory, job_name):
+    '''
+    Returns the names of the files \\include'd by the root file of
+    job_name, as found in its main .aux file
+    '''
+    parts = []
+    for line in read_lines(os.path.join(aux_directory, job_name + u'.aux')):
+        m = AUX_INPUT_REGEX.match(line)
+        if m and m.group(1).endswith(u'.aux'):
+            parts.append(m.group(1)[:-len(u'.aux')])
+    return parts
+
+
+def resolve_local(tex_dir, name, ext):
+    '''
+    Resolves a bibliography or style name relative to the tex directory.
+    Returns None for files which are only found through kpathsea
+    '''
+    name = name.strip()
+    if not name:
+        return None
+    if not name.endswith(ext):
+        name += ext
+    path = os.path.normpath(os.path.join(tex_dir, name))
+    if os.path.isfile(path):
+        return path
+    return None
+
+
+def bibliography_sources(aux_directory, tex_dir, job_name):
+    '''
+    Returns the local .bib and .bst files used by the job, as referenced by
+    the \\bibdata and \\bibstyle lines of the .aux or the data sources of the
+    biblatex .bcf file
+    '''
+    sources = []
+    for line in aux_lines(aux_directory, job_name):
+        for regex, ext in ((BIBDATA_REGEX, u'.bib'), (BIBSTYLE_REGEX, u'.bst')):
+            m = regex.match(line)
+            if m:
+                for name in m.group(1).split(u','):
+                    path = resolve_local(tex_dir, name, ext)
+                    if path is not None and path not in sources:
+                        sources.append(path)
+
+    bcf = os.path.join(aux_directory, job_name + u'.bcf')
+    for line in read_lines(bcf):
+        for name in BCF_DATASOURCE_REGEX.findall(line):
+            path = resolve_local(tex_dir, name, u'.bib')
+            if path is not None and path not in sources:
+                sources.append(path)
+
+    return sources
+
+
+# Files written by LaTeX and friends which are read back on the next pass
+RERUN_EXTENSIONS = (
+    u'.aux', u'.toc', u'.lof', u'.lot', u'.loa', u'.out', u'.bbl', u'.bcf',
+    u'.nav', u'.snm', u'.vrb', u'.thm', u'.ind', u'.gls', u'.acr', u'.nls', u'.brf'
+)
+
+
+def aux_fingerprint(aux_directory, job_name):
+    '''
+    Returns a digest over the contents of all files of the job which are
+    read back by the next engine pass, including the .aux files of
+    \\include'd files. The digest only stays the same if a further pass
+    would see exactly the same auxiliary data
+    '''
+    digest = hashlib.sha1()
+    names = [job_name + ext for ext in RERUN_EXTENSIONS]
+    for line in read_lines(os.path.join(aux_directory, job_name + u'.aux')):
+        m = AUX_INPUT_REGEX.match(line)
+        if m:
+            names.append(m.group(1))
+
+    for name in names:
+        path = os.path.join(aux_directory, name)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            continue
+        digest.update(name.encode('utf-8'))
+        digest.update(hashlib.sha1(data).digest())
+    return digest.hexdigest()
+
+
+# Lines of the .aux which determine the output of bibtex
+CITATION_LINE_PREFIXES = (u'\\citation{', u'\\bibdata{', u'\\bibstyle{')
+
+
+def citation_fingerprint(aux_directory, tex_dir, job_name):
+    '''
+    Returns a digest over everything bibtex or biber reads: the \\citation,
+    \\bibdata and \\bibstyle lines of the .aux files (or the biblatex .bcf
+    file) together with the contents of the local .bib and .bst files.
+    Returns None if the job has no bibliography data
+    '''
+    digest = hashlib.sha1()
+    found = False
+    for line in aux_lines(aux_directory, job_name):
+        if line.startswith(CITATION_LINE_PREFIXES):
+            digest.update(line.encode('utf-8'))
+            digest.update(b'\n')
+            found = True
+
+    bcf = os.path.join(aux_directory, job_name + u'.bcf')
+    try:
+        with open(bcf, 'rb') as f:
+            digest.update(f.read())
+        found = True
+    except (IOError, OSError):
+        pass
+
+    if not found:
+        return None
+
+    for path in bibliography_sources(aux_directory, tex_dir, job_name):
+        digest.update(path.encode('utf-8'))
+        try:
+            with open(path, 'rb') as f:
+                digest.update(hashlib.sha1(f.read()).digest())
+        except (IOError, OSError):
+            pass
+    return digest.hexdigest()
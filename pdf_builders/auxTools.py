@@ -0,0 +1,171 @@
+import hashlib
+import os
+import re
+from pdf_builders.auxFiles import read_lines
+
+# Placeholder for the job name in the commands of tools
+JOB_PLACEHOLDER = u'{job}'
+
+
+# ----------------------------------------------------------------
+# AuxTool class
+#
+# An auxiliary tool run between engine passes, such as makeindex. It
+# consumes files written by the engine (or by other tools) and produces
+# files read back by the next pass, all named after the job and kept in
+# the aux directory, where the tool is run.
+#
+# outputs maps a consumed suffix to the suffixes produced from it, by
+# default all of produces. style is a regular expression matching the
+# line of the .aux of the job which names a style file the tool reads.
+#
+class AuxTool(object):
+
+    def __init__(self, name, command, consumes, produces, outputs=None,
+                 style=None):
+        self.name = name
+        self.command = list(command)
+        self.consumes = tuple(consumes)
+        self.produces = tuple(produces)
+        self.outputs = dict(
+            (suffix, tuple((outputs or {}).get(suffix, self.produces)))
+            for suffix in self.consumes)
+        self.style = re.compile(style) if style else None
+
+    @classmethod
+    def from_setting(cls, setting):
+        '''
+        Creates a tool from a dict with name, command (a list of arguments
+        in which {job} is replaced by the job name), consumes and produces
+        (lists of suffixes of the job name) and optionally outputs and
+        style, see above
+        '''
+        return cls(setting['name'], setting['command'],
+                   setting.get('consumes', ()), setting.get('produces', ()),
+                   setting.get('outputs'), setting.get('style'))
+
+    def job_command(self, job_name):
+        return [argument.replace(JOB_PLACEHOLDER, job_name)
+                for argument in self.command]
+
+    def fingerprint(self, aux_path, job_name):
+        '''
+        Returns a digest over the command, the files the tool consumes and
+        its style file, or None if none of the consumed files exists, i.e.
+        the job does not use the tool
+        '''
+        digest = hashlib.sha1()
+        digest.update(u'\0'.join(self.command).encode('utf-8'))
+        found = False
+        for suffix in self.consumes:
+            data = _read(os.path.join(aux_path, job_name + suffix))
+            if data is None:
+                continue
+            found = True
+            digest.update(suffix.encode('utf-8'))
+            digest.update(hashlib.sha1(data).digest())
+        if not found:
+            return None
+
+        if self.style is not None:
+            for line in read_lines(os.path.join(aux_path, job_name + u'.aux')):
+                m = self.style.match(line)
+                if m:
+                    # a style which cannot be found is still named
+                    digest.update(line.encode('utf-8'))
+                    data = _read(os.path.join(aux_path, m.group(1)))
+                    if data is not None:
+                        digest.update(hashlib.sha1(data).digest())
+        return digest.hexdigest()
+
+    def outputs_exist(self, aux_path, job_name):
+        '''
+        Returns True if for every consumed file which exists, any of the
+        files produced from it exists as well
+        '''
+        return all(
+            any(os.path.exists(os.path.join(aux_path, job_name + output))
+                for output in outputs)
+            for suffix, outputs in self.outputs.items()
+            if os.path.exists(os.path.join(aux_path, job_name + suffix))
+        )
+
+
+AUX_TOOLS = (
+    AuxTool(u'makeindex', [u'makeindex', u'{job}.idx'],
+            [u'.idx'], [u'.ind']),
+    AuxTool(u'nomencl', [u'makeindex', u'{job}.nlo', u'-s', u'nomencl.ist', u'-o', u'{job}.nls'],
+            [u'.nlo'], [u'.nls']),
+    # makeglossaries also reads the .aux for the style file written by
+    # \makeglossaries, an .ist or .xdy, and handles the acronym list
+    AuxTool(u'glossaries', [u'makeglossaries', u'{job}'],
+            [u'.glo', u'.acn'], [u'.gls', u'.acr'],
+            {u'.glo': [u'.gls'], u'.acn': [u'.acr']},
+            r'\\@istfilename\{([^}]*)\}'),
+)
+
+# Consumed and produced by bibtex and biber, which the builders run
+# themselves, see PdfBuilder.run_aux_tools()
+BIBLIOGRAPHY_CONSUMES = (u'.aux', u'.bcf')
+BIBLIOGRAPHY_PRODUCES = (u'.bbl',)
+
+
+def configured_tools(settings):
+    '''
+    Returns the tools selected by the aux_tools builder setting, a list of
+    names of AUX_TOOLS and of dicts defining further tools (see
+    AuxTool.from_setting). All of AUX_TOOLS are used by default
+    '''
+    if settings is None:
+        return list(AUX_TOOLS)
+    builtin = dict((tool.name, tool) for tool in AUX_TOOLS)
+    tools = []
+    for entry in settings:
+        if isinstance(entry, dict):
+            tools.append(AuxTool.from_setting(entry))
+        elif entry in builtin:
+            tools.append(builtin[entry])
+        else:
+            raise ValueError(u'unknown auxiliary tool: {0}'.format(entry))
+    return tools
+
+
+def plan(tools):
+    '''
+    Orders tools, objects with name, consumes and produces, into layers:
+    each tool comes after every tool producing a file it consumes, so the
+    tools of one layer can run at the same time.
+    Raises ValueError if the tools depend on each other in a cycle
+    '''
+    producers = {}
+    for tool in tools:
+        for suffix in tool.produces:
+            producers.setdefault(suffix, []).append(tool)
+    depends = dict(
+        (tool.name, set(
+            producer.name for suffix in tool.consumes
+            for producer in producers.get(suffix, ())
+            if producer is not tool))
+        for tool in tools
+    )
+
+    layers = []
+    done = set()
+    remaining = list(tools)
+    while remaining:
+        layer = [tool for tool in remaining if depends[tool.name] <= done]
+        if not layer:
+            raise ValueError(u'auxiliary tools depend on each other: {0}'.format(
+                u', '.join(tool.name for tool in remaining)))
+        layers.append(layer)
+        done.update(tool.name for tool in layer)
+        remaining = [tool for tool in remaining if tool not in layer]
+    return layers
+
+
+def _read(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
@@ -1,27 +1,24 @@
 #! Copied from https://github.com/SublimeText/LaTeXTools
 import os
-import re
 import subprocess
 import sys
+from functools import partial
 from six import string_types, reraise
 # This will work because makePDF.py puts the appropriate
 # builders directory in sys.path
 from pdf_builders.pdfBuilder import PdfBuilder, external_command, get_texpath, get_platform
-from pdf_builders.pdfBuilder import FILE_NOT_FOUND_ERROR_REGEX, TEXLIVEONFLY
+from pdf_builders.pdfBuilder import ConcurrentProcesses, start_command
+from pdf_builders.logParser import FILE_WRITE_ERROR, MISSING_FILE, RERUN
+from pdf_builders.logParser import BAD_BOX
+from pdf_builders.auxFiles import aux_fingerprint, included_parts
+from pdf_builders.buildCache import FileCache, user_cache_directory
+from pdf_builders.figureCache import EXTERNAL_MODE_HOOK, FIGURE_EXTENSIONS, FigureCache
+from pdf_builders.figureCache import figure_names
+from pdf_builders.pdfMerge import MERGE_ERRORS, merge, merge_available
+from pdf_builders.shardBuild import collect, read_markers, seed, shard_line
+from pdf_builders.system import default_jobs
 from pdf_builders.traditionalBuilder import DEFAULT_COMMAND_WINDOWS_MIKTEX
 
-# Standard LaTeX warning
-CITATIONS_REGEX = re.compile(
-    r"Warning: Citation [`|'].+' (?:on page \d+ )?undefined")
-# Capture which program to run for BibLaTeX
-BIBLATEX_REGEX = re.compile(
-    r"Package biblatex Warning: Please \(re\)run (\S*)")
-# Used to indicate a subdirectory that needs to be made for a file input using
-# \include
-FILE_WRITE_ERROR_REGEX = re.compile(
-    r"! I can't write on file `(.*)/([^/']*)'")
-
-
 # ----------------------------------------------------------------
 # BasicBuilder class
 #
@@ -36,6 +33,18 @@ class BasicBuilder(PdfBuilder):
         self.name = "Basic Builder"
         self.bibtex = self.builder_settings.get('bibtex', 'bibtex')
         self.display_log = self.builder_settings.get("display_log", False)
+        # upper bound for the passes run to reach a fixed point
+        self.max_passes = self.builder_settings.get('max_passes', 5)
+        # number of parts compiled at the same time in sharded builds, see
+        # sharded_build(); 0 disables them
+        self.shard_jobs = self.builder_settings.get('shard_jobs', 0)
+        self.sharded = False
+        # cache of externalized TikZ figures and whether the last call of
+        # externalize_figures() replaced any, see use_figure_cache()
+        self.figure_cache = None
+        self.figures_updated = False
+        # files read by the externalized figures
+        self.figure_inputs = []
 
     def commands(self):
         # Print greeting
@@ -53,8 +62,8 @@ class BasicBuilder(PdfBuilder):
         if engine not in ['pdflatex', 'xelatex', 'lualatex']:
             engine = 'pdflatex'
 
-        latex = [engine, u"-interaction=nonstopmode", u"-synctex=1"]
-        texliveonfly = [TEXLIVEONFLY, u"-interaction=nonstopmode", u"-synctex=1"]
+        latex = [engine, u"-interaction=nonstopmode", u"-synctex=1",
+                 u"-recorder"]
         biber = [u"biber"]
 
         if self.aux_directory is not None:
@@ -80,6 +89,13 @@ class BasicBuilder(PdfBuilder):
 
         latex.append(self.tex_name)
 
+        # Load the preamble from a precompiled format, if enabled
+        for cmd in self.load_preamble_format(engine, latex):
+            yield cmd
+
+        # Compile only the changed chapters in draft mode
+        self.include_changed_parts(latex)
+
         # Check if any subfolders need to be created
         # this adds a number of potential runs as LaTeX treats being unable
         # to open output files as fatal errors
@@ -93,98 +109,302 @@ class BasicBuilder(PdfBuilder):
         ):
             self.make_directory(output_directory)
 
-        yield (latex, "running {0}...".format(engine))
+        # Compile the \include'd parts in parallel if enabled
+        if self.shard_jobs and self.draft_parts is None:
+            for cmd in self.sharded_build(engine, latex, biber):
+                yield cmd
+            if self.sharded:
+                return
+
+        # Externalize TikZ figures through the figure cache if enabled,
+        # starting with those of the last build missing in aux_path
+        self.use_figure_cache(engine, latex)
+        for cmd in self.externalize_figures(latex, make=False):
+            yield cmd
+
+        aux_path = self.aux_path()
+        fingerprint = aux_fingerprint(aux_path, self.job_name)
+        yield (self.engine_command(latex), "running {0}...".format(engine))
         self.display("done.\n")
         self.log_output()
 
         if output_directory is not None:
             while True:
-                start = 0
                 added_directory = False
-                while True:
-                    match = FILE_WRITE_ERROR_REGEX.search(self.out, start)
-                    if match:
-                        self.make_directory(
-                            os.path.normpath(
-                                os.path.join(
-                                    output_directory,
-                                    match.group(1)
-                                )
+                for event in self.log_index.events(FILE_WRITE_ERROR):
+                    self.make_directory(
+                        os.path.normpath(
+                            os.path.join(
+                                output_directory,
+                                event.data
                             )
                         )
-                        start = match.end(1)
-                        added_directory = True
-                    else:
-                        break
+                    )
+                    added_directory = True
                 if added_directory:
-                    yield (latex, "running {0}...".format(engine))
+                    fingerprint = aux_fingerprint(aux_path, self.job_name)
+                    yield (self.engine_command(latex), "running {0}...".format(engine))
                     self.display("done.\n")
                     self.log_output()
                 else:
                     break
 
-        if FILE_NOT_FOUND_ERROR_REGEX.search(self.out):
+        if self.log_index.has(MISSING_FILE):
             if get_platform() != u'windows':
-                texliveonfly.append(u'--jobname=' + self.job_name)
-                texliveonfly.append(self.tex_name)
-                yield(texliveonfly, 'running {0}'.format(u'texliveonfly'))
+                fingerprint = aux_fingerprint(aux_path, self.job_name)
+                yield (self.texliveonfly_command(engine, latex[1:-1]),
+                       'running {0}'.format(u'texliveonfly'))
             else:
                 windows_cmd = DEFAULT_COMMAND_WINDOWS_MIKTEX
                 for i, c in enumerate(windows_cmd):
                     windows_cmd[i] = c.replace(
                         "-%E", "-" + engine if engine != 'pdflatex' else '-pdf'
                     ).replace("%E", engine)
+                fingerprint = aux_fingerprint(aux_path, self.job_name)
                 yield (windows_cmd + [self.tex_name], "Invoking " + windows_cmd[0] + "... ")
 
-        # Check for citations
-        # We need to run pdflatex twice after bibtex
-        run_bibtex = False
-        use_bibtex = True
-        bibtex = None
-        if CITATIONS_REGEX.search(self.out):
-            run_bibtex = True
-            # are we using biblatex?
-            m = BIBLATEX_REGEX.search(self.out)
-            if m:
-                bibtex = m.group(1).lower()
-                if bibtex == 'biber':
-                    use_bibtex = False
-        # check for natbib as well
-        elif (
-            'Package natbib Warning: There were undefined citations'
-                in self.out):
-            run_bibtex = True
-
-        if run_bibtex:
-            if use_bibtex:
-                yield (
-                    self.run_bibtex(bibtex),
-                    "running {0}...".format(bibtex or 'bibtex')
-                )
-            else:
-                yield (biber + [self.job_name], 'running biber...')
+        # remember this before the output is replaced by bibtex's
+        rerun_requested = self.log_index.has(RERUN)
 
-            self.display('done.\n')
+        for cmd in self.run_bibliography(biber):
+            yield cmd
+
+        # figures listed by the pass are included by the next one
+        for cmd in self.externalize_figures(latex):
+            yield cmd
+        rerun_requested = rerun_requested or self.figures_updated
+
+        # Rerun until the files read back by the engine reach a fixed point
+        # This covers changed labels as well as a new .bbl, which makes any
+        # rerun request of LaTeX or a package redundant in most cases, but
+        # those are still honored for anything we do not fingerprint
+        passes = 0
+        while passes < self.max_passes:
+            current = aux_fingerprint(aux_path, self.job_name)
+            if current == fingerprint and not rerun_requested:
+                break
+            fingerprint = current
+            yield (self.engine_command(latex), "running {0}...".format(engine))
+            self.display("done.\n")
             self.log_output()
+            rerun_requested = self.log_index.has(RERUN)
+            # e.g. page numbers in the index may have changed
+            for cmd in self.run_aux_tools():
+                yield cmd
+            for cmd in self.externalize_figures(latex):
+                yield cmd
+            rerun_requested = rerun_requested or self.figures_updated
+            passes += 1
+
+    # Makes the latex command list the figures externalized by the TikZ
+    # library, see figureCache, instead of compiling them one after the
+    # other, if the tikz_cache setting is on. externalize_figures() then
+    # takes them from the shared cache or compiles them concurrently
+    def use_figure_cache(self, engine, latex):
+        if not self.builder_settings.get('tikz_cache', False):
+            return
+        cache = FileCache(
+            self.builder_settings.get('tikz_cache_directory') or
+            user_cache_directory(u'figures'),
+            self.builder_settings.get('tikz_cache_size', 512) * 1024 * 1024)
+        self.figure_cache = FigureCache(
+            cache, engine, os.path.abspath(self.tex_dir), self.tex_name)
+        if latex[-1] == self.tex_name:
+            latex[-1] = u'\\input{{{0}}}'.format(self.tex_name)
+        latex[-1] = EXTERNAL_MODE_HOOK + latex[-1]
+        # the job would be named after the first file read otherwise
+        if not any(c.startswith(u'--jobname=') for c in latex):
+            latex.insert(-1, u'--jobname=' + self.job_name)
+
+    # Brings the figures listed by the last pass up to date: figures which
+    # changed since they were last made, or whose inputs did, are copied
+    # from the figure cache, or, if make is True, compiled up to tikz_jobs
+    # at the same time and stored in the cache
+    # Sets self.figures_updated if any figure was replaced
+    # Usage: for cmd in self.externalize_figures(latex): yield cmd
+    def externalize_figures(self, latex, make=True):
+        self.figures_updated = False
+        if self.figure_cache is None:
+            return
+        aux_path = self.aux_path()
+        previous = self.build_state().get('figures') or {}
+        # the cache entry of every figure in aux_path
+        state = {}
+        inputs = set()
+        missing = []
+        for name in figure_names(aux_path, self.job_name):
+            key = self.figure_cache.figure_key(aux_path, name)
+            if key is None:
+                continue
+            figure = self.figure_cache.lookup(key)
+            if figure is None:
+                missing.append((name, key))
+                continue
+            inputs.update(figure.inputs)
+            if figure.entry == previous.get(name) and os.path.exists(
+                    os.path.join(aux_path, name + u'.pdf')):
+                state[name] = figure.entry
+            elif self.figure_cache.fetch(figure, aux_path, name):
+                state[name] = figure.entry
+                self.figures_updated = True
+            else:
+                missing.append((name, key))
 
-            for i in range(2):
-                yield (latex, "running {0}...".format(engine))
+        if make and missing:
+            for name, _ in missing:
+                self.figure_cache.prepare(aux_path, name)
+            yield (
+                ConcurrentProcesses(
+                    [partial(start_command,
+                             self.figure_cache.figure_command(
+                                 latex, aux_path, self.job_name, name),
+                             self.tex_dir)
+                     for name, _ in missing],
+                    self.builder_settings.get('tikz_jobs', 0) or default_jobs()),
+                "externalizing {0} figures...".format(len(missing))
+            )
+            generated = self.recorded_files()[1]
+            failed = []
+            for name, key in missing:
+                figure = self.figure_cache.store(key, aux_path, name, generated)
+                if figure is None:
+                    failed.append(name)
+                    continue
+                inputs.update(figure.inputs)
+                state[name] = figure.entry
+                self.figures_updated = True
+            if failed:
+                self.display("failed: {0}.\n".format(u', '.join(failed)))
+            else:
                 self.display("done.\n")
-                self.log_output()
+        self.build_state().set('figures', state)
+        self.figure_inputs = sorted(inputs)
+
+    # The main job does not read what the externalized figures read
+    def recorded_files(self):
+        inputs, outputs = super(BasicBuilder, self).recorded_files()
+        if inputs:
+            inputs += self.figure_inputs
+        return inputs, outputs
+
+    # The files of the externalized figures are written by the figure jobs
+    def generated_file(self, path):
+        if super(BasicBuilder, self).generated_file(path):
+            return True
+        aux_path = self.aux_path()
+        path = os.path.normpath(path)
+        if not path.startswith(aux_path + os.sep):
+            return False
+        name, ext = os.path.splitext(path[len(aux_path) + 1:])
+        return ext in FIGURE_EXTENSIONS and \
+            name in (self.build_state().get('figures') or {})
+
+    # Sharded build, see shardBuild: the frame of the document and every
+    # part it \include's are compiled as jobs of their own, up to
+    # shard_jobs of them at the same time, in rounds until the .aux files
+    # reach a fixed point. The PDFs of the last round are then merged
+    # Needs the .aux files of an earlier build and pypdf; sets
+    # self.sharded if the PDF was built, otherwise the build continues
+    # serially from the .aux files of the shards
+    def sharded_build(self, engine, latex, biber):
+        aux_path = self.aux_path()
+        parts = included_parts(aux_path, self.job_name)
+        if len(parts) < 2 or not all(
+                os.path.exists(os.path.join(aux_path, part + u'.aux'))
+                for part in parts):
+            return
+        if not merge_available():
+            self.display("sharded builds need pypdf, building serially.\n")
+            return
+
+        directory = os.path.join(aux_path, self.job_name + u'.shards')
+        shards = [(os.path.join(directory, u'frame'), None)]
+        shards.extend(
+            (os.path.join(directory, str(index)), part)
+            for index, part in enumerate(parts))
+        frame_directory = shards[0][0]
+        part_directories = [shard_directory for shard_directory, _ in shards[1:]]
+        # the PDFs of the shards are merged, synctex data would not match
+        command = [
+            c for c in latex[:-1] if not c.startswith((
+                u'-synctex=', u'--output-directory=', u'--aux-directory=',
+                u'--jobname='))
+        ]
+        command.append(u'--jobname=' + self.job_name)
+
+        def start(shard_directory, part):
+            return start_command(
+                command + [u'--output-directory=' + shard_directory,
+                           shard_line(self.tex_name, parts, part)],
+                self.tex_dir)
 
-        # Check for changed labels
-        # Do this at the end, so if there are also citations to resolve,
-        # we may save one pdflatex run
-        if "Rerun to get cross-references right." in self.out:
-            yield (latex, "running {0}...".format(engine))
+        def log_path(shard_directory):
+            return os.path.join(shard_directory, self.job_name + u'.log')
+
+        fingerprint = aux_fingerprint(aux_path, self.job_name)
+        converged = False
+        rounds = 0
+        while rounds < self.max_passes and not converged:
+            for shard_directory, _ in shards:
+                seed(aux_path, shard_directory, self.job_name, parts)
+            yield (
+                ConcurrentProcesses(
+                    [partial(start, shard_directory, part)
+                     for shard_directory, part in shards],
+                    self.shard_jobs),
+                "running {0} on {1} shards...".format(engine, len(shards))
+            )
             self.display("done.\n")
             self.log_output()
 
+            frame_markers = read_markers(log_path(frame_directory))
+            pieces = []
+            for index, shard_directory in enumerate(part_directories):
+                markers = read_markers(log_path(shard_directory))
+                if (
+                    str(index) not in frame_markers or
+                    'first' not in markers or 'end' not in markers
+                ):
+                    self.display("pages of the shards not found, building serially.\n")
+                    return
+                pieces.append((
+                    frame_markers[str(index)],
+                    os.path.join(shard_directory, self.job_name + u'.pdf'),
+                    markers['first'], markers['end']
+                ))
+            collect(aux_path, frame_directory, part_directories,
+                    self.job_name, parts)
+
+            for cmd in self.run_bibliography(biber):
+                yield cmd
+            current = aux_fingerprint(aux_path, self.job_name)
+            converged = current == fingerprint
+            fingerprint = current
+            rounds += 1
+
+        if not converged:
+            self.display("shards did not converge, building serially.\n")
+            return
+
+        self.display("merging {0} parts...".format(len(parts)))
+        try:
+            merge(os.path.join(frame_directory, self.job_name + u'.pdf'), pieces,
+                  os.path.join(self.output_path(), self.job_name + u'.pdf'))
+        except MERGE_ERRORS as e:
+            self.display("failed: {0}, building serially.\n".format(e))
+            return
+        self.display("done.\n")
+        self.sharded = True
+
     def log_output(self):
         if self.display_log:
             self.display("\nCommand results:\n")
             self.display(self.out)
             self.display("\n\n")
+        if self.track_log_files:
+            for event in self.log_index.events(BAD_BOX):
+                self.display("{0}:{1}: {2}\n".format(
+                    event.file or self.tex_name, event.line or '', event.message))
 
     def make_directory(self, directory):
         if not os.path.exists(directory):
@@ -195,6 +415,7 @@ class BasicBuilder(PdfBuilder):
                 if not os.path.exists(directory):
                     reraise(*sys.exc_info())
 
+    # Returns the process running bibtex, which is waited for by the caller
     def run_bibtex(self, command=None):
         if command is None:
             command = [self.bibtex]
@@ -218,7 +439,7 @@ class BasicBuilder(PdfBuilder):
             # now we modify cwd to be the output directory
             # NOTE this cwd is not reused by any of the other command
             cwd = output_directory
-        env['PATH'] = get_texpath()
+        env['PATH'] = get_texpath() or os.environ['PATH']
 
         command.append(self.job_name)
         return external_command(
@@ -0,0 +1,332 @@
+from __future__ import print_function
+import hashlib
+import json
+import os
+import tempfile
+from pdf_builders.system import make_dirs
+
+# All persistent builder state (build manifest, fingerprints, ...) lives in a
+# single JSON file stored next to the other auxiliary files of the job
+STATE_SUFFIX = u'.pdfbuilder.json'
+STATE_VERSION = 1
+
+HASH_BLOCK_SIZE = 1 << 16
+
+# Sources which may be named like the job, e.g. its root file
+SOURCE_EXTENSIONS = (
+    u'.tex', u'.ltx', u'.bib', u'.bst', u'.sty', u'.cls', u'.dtx', u'.ins'
+)
+
+
+def hash_file(path):
+    '''
+    Returns the sha1 hex digest of the contents of path or None if the file
+    cannot be read
+    '''
+    digest = hashlib.sha1()
+    try:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                digest.update(block)
+    except (IOError, OSError):
+        return None
+    return digest.hexdigest()
+
+
+def hash_value(value):
+    '''
+    Returns the sha1 hex digest of any JSON serializable value
+    '''
+    data = json.dumps(value, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def file_signature(path):
+    '''
+    Returns the cheap [mtime, size] signature of path or None if it does not
+    exist
+    '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime, st.st_size]
+
+
+def file_entries(paths, previous=None):
+    '''
+    Returns {path: [mtime, size, digest]} for the files among paths,
+    reusing the digest of a previous entry whose signature is unchanged
+    '''
+    previous = previous or {}
+    entries = {}
+    for path in paths:
+        if path in entries:
+            continue
+        signature = file_signature(path)
+        if signature is None or os.path.isdir(path):
+            continue
+        known = previous.get(path)
+        if known is not None and known[:2] == signature:
+            digest = known[2]
+        else:
+            digest = hash_file(path)
+        entries[path] = signature + [digest]
+    return entries
+
+
+def entries_unchanged(entries):
+    '''
+    Returns True if every file of entries, see file_entries(), still has
+    the recorded contents. Files are only hashed if their signature changed
+    '''
+    for path, (mtime, size, digest) in entries.items():
+        signature = file_signature(path)
+        if signature is None:
+            return False
+        if signature != [mtime, size] and hash_file(path) != digest:
+            return False
+    return True
+
+
+def replace_file(src, dst):
+    '''
+    Atomically renames src to dst, overwriting dst if it exists
+    '''
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+def user_cache_directory(name):
+    '''
+    Returns the directory for cached data shared by all jobs of the user
+    '''
+    root = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser(u'~'), u'.cache')
+    return os.path.join(root, u'pdfbuilder', name)
+
+
+def read_fls(path):
+    '''
+    Yields a (kind, path) tuple for every INPUT and OUTPUT line of the .fls
+    file written by the engine when run with -recorder, in the order of the
+    file, with paths made absolute. Yields nothing if the file does not
+    exist
+    '''
+    pwd = os.path.dirname(os.path.abspath(path))
+    try:
+        with open(path, 'rb') as f:
+            lines = f.read().decode('utf-8', 'ignore').splitlines()
+    except (IOError, OSError):
+        return
+
+    for line in lines:
+        kind, _, name = line.partition(u' ')
+        if kind == u'PWD':
+            pwd = name
+        elif kind == u'INPUT' or kind == u'OUTPUT':
+            yield kind, os.path.normpath(os.path.join(pwd, name))
+
+
+def parse_fls(path):
+    '''
+    Parses the .fls file written by the engine when run with -recorder.
+    Returns a tuple (inputs, outputs) of lists of absolute paths, in the order
+    in which they were first recorded. Both lists are empty if the file does
+    not exist
+    '''
+    inputs = []
+    outputs = []
+    seen = (set(), set())
+    for kind, name in read_fls(path):
+        if kind == u'INPUT':
+            target, known = inputs, seen[0]
+        else:
+            target, known = outputs, seen[1]
+        if name not in known:
+            known.add(name)
+            target.append(name)
+
+    return inputs, outputs
+
+
+# ----------------------------------------------------------------
+# BuildState class
+#
+# Lazily loaded JSON dictionary of named sections. Every call to set()
+# writes the whole file back using an atomic rename, so an interrupted
+# build never leaves a corrupted state behind.
+#
+class BuildState(object):
+
+    def __init__(self, path):
+        self.path = path
+        self._data = None
+
+    def _load(self):
+        if self._data is None:
+            self._data = {}
+            try:
+                with open(self.path, 'r') as f:
+                    data = json.load(f)
+                if data.get('version') == STATE_VERSION:
+                    self._data = data
+            except (IOError, OSError, ValueError, AttributeError):
+                pass
+            self._data['version'] = STATE_VERSION
+        return self._data
+
+    def get(self, section, default=None):
+        return self._load().get(section, default)
+
+    def set(self, section, value):
+        self._load()[section] = value
+        self.save()
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            return
+        tmp_path = self.path + u'.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self._load(), f, sort_keys=True)
+            replace_file(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            print(u'Unable to save build state {0}: {1}'.format(self.path, e))
+
+
+# ----------------------------------------------------------------
+# BuildManifest class
+#
+# Records every file the engine read during the last successful build
+# (from the -recorder .fls output) together with the settings used, so
+# that a later build with identical inputs can be skipped entirely.
+#
+# Inputs are compared by [mtime, size] first and only hashed when the
+# cheap signature differs, which keeps a no-op check in the milliseconds.
+#
+class BuildManifest(object):
+
+    def __init__(self, state, key):
+        self.state = state
+        self.key = key
+
+    def is_up_to_date(self, outputs):
+        manifest = self.state.get('manifest')
+        if not manifest or manifest.get('key') != self.key:
+            return False
+
+        if not entries_unchanged(manifest['inputs']):
+            return False
+
+        recorded_outputs = manifest.get('outputs', {})
+        for path in outputs:
+            signature = file_signature(path)
+            if signature is None or recorded_outputs.get(path) != signature:
+                return False
+
+        return True
+
+    def record(self, inputs, outputs, generated=()):
+        '''
+        Stores a new manifest. inputs are the files read by the build,
+        generated the files written by it (which are never treated as
+        inputs) and outputs the final products whose presence is required
+        for the build to be considered up to date
+        '''
+        previous = self.state.get('manifest') or {}
+        generated = set(generated)
+        entries = file_entries(
+            [path for path in inputs if path not in generated],
+            previous.get('inputs'))
+
+        self.state.set('manifest', {
+            'key': self.key,
+            'inputs': entries,
+            'outputs': dict(
+                (path, file_signature(path)) for path in outputs
+                if file_signature(path) is not None
+            )
+        })
+
+    def invalidate(self):
+        self.state.set('manifest', None)
+
+
+# ----------------------------------------------------------------
+# FileCache class
+#
+# Directory of cached files shared by all jobs, capped in size. Entries
+# are evicted least recently used first, with the modification time of an
+# entry, which is bumped on every hit, serving as the clock.
+#
+class FileCache(object):
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+    def get(self, name):
+        '''
+        Returns the path of the entry name and marks it as recently used,
+        or returns None if there is no such entry
+        '''
+        path = os.path.join(self.directory, name)
+        try:
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def temp_directory(self):
+        '''
+        Returns a new directory on the same file system as the cache, for
+        files which are moved into it by put()
+        '''
+        make_dirs(self.directory)
+        return tempfile.mkdtemp(prefix=u'.tmp', dir=self.directory)
+
+    def put(self, name, src):
+        '''
+        Moves the file src into the cache as name, replacing any existing
+        entry, and evicts entries until the cache fits its size again.
+        Returns the path of the entry
+        '''
+        make_dirs(self.directory)
+        path = os.path.join(self.directory, name)
+        replace_file(src, path)
+        os.utime(path, None)
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep=None):
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if not os.path.isfile(path):
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                # removed by a concurrent job
+                pass
+            total -= size
@@ -0,0 +1,349 @@
+# Long-lived build daemon, so that a build requested by an editor or a
+# hook does not pay for starting Python and the toolchain every time.
+#
+# The daemon accepts requests on a Unix socket. A request is one line of
+# JSON listing builds, each described as build.py would create its builder.
+# The reply is a stream of JSON lines holding the output of the builds and
+# finally the result of each one. Processes kept warm between builds, such
+# as warm engines or Ghostscript workers, survive from one request to the
+# next.
+#
+# At most one build of a root (and job name) runs at a time, and builds of
+# different roots share a bounded number of slots. A request for a root
+# which is already building cancels that build. All clients waiting for a
+# root get the result of its next build, so requests arriving in a burst
+# are coalesced into one build.
+from __future__ import print_function
+import json
+import os
+import select
+import signal
+import socket
+import sys
+import threading
+from six.moves import queue
+from pdf_builders.buildCache import user_cache_directory
+
+# How often a client waiting for builds is checked for having gone away
+CLIENT_POLL_INTERVAL = 0.5
+
+
+def default_socket_path():
+    return os.path.join(user_cache_directory(u''), u'daemon.sock')
+
+
+def daemon_available():
+    return hasattr(socket, 'AF_UNIX')
+
+
+def send_message(stream, message):
+    stream.write(json.dumps(message).encode('utf-8') + b'\n')
+    stream.flush()
+
+
+def read_message(stream):
+    '''
+    Returns the next message read from stream, or None at its end
+    '''
+    line = stream.readline()
+    if not line:
+        return None
+    return json.loads(line.decode('utf-8'))
+
+
+def connect(socket_path):
+    '''
+    Returns a socket connected to the daemon listening on socket_path, or
+    None if no daemon is running
+    '''
+    if not daemon_available() or not os.path.exists(socket_path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except (IOError, OSError):
+        sock.close()
+        return None
+    return sock
+
+
+def request_builds(socket_path, builds, output=None):
+    '''
+    Has the daemon listening on socket_path run builds, a list of requests
+    as understood by the builder factory of the daemon, each with at least
+    'tex_root', and passes their output to output as it arrives.
+    Returns the list of roots whose build failed, or None if no daemon is
+    running
+    '''
+    sock = connect(socket_path)
+    if sock is None:
+        return None
+    if output is None:
+        output = PrintOutput()
+    results = {}
+    try:
+        stream = sock.makefile('rwb')
+        send_message(stream, {'builds': builds})
+        while len(results) < len(builds):
+            message = read_message(stream)
+            if message is None:
+                output(u'The build daemon closed the connection.\n')
+                break
+            if 'output' in message:
+                output(message['output'])
+            elif 'result' in message:
+                results[message['index']] = message['result']
+    finally:
+        sock.close()
+    return [build['tex_root'] for index, build in enumerate(builds)
+            if not results.get(index)]
+
+
+class PrintOutput(object):
+    def __call__(self, text):
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
+
+# ----------------------------------------------------------------
+# ThreadOutput class
+#
+# Replacement of sys.stdout which sends what a thread prints to the
+# callable registered for the thread, and everything else to the original
+# stream.
+#
+class ThreadOutput(object):
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def register(self, callback):
+        self.local.callback = callback
+
+    def write(self, text):
+        callback = getattr(self.local, 'callback', None)
+        if callback is None:
+            self.stream.write(text)
+        else:
+            callback(text)
+
+    def flush(self):
+        if getattr(self.local, 'callback', None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+# ----------------------------------------------------------------
+# Client class
+#
+# Connection of a client waiting for builds. Messages are queued by the
+# build threads and written by the thread serving the connection.
+#
+class Client(object):
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.messages = queue.Queue()
+        self.closed = False
+
+    def send(self, message):
+        if not self.closed:
+            self.messages.put(message)
+
+    def next_message(self):
+        '''
+        Returns the next message to write, or None once the client closed
+        the connection
+        '''
+        while True:
+            try:
+                return self.messages.get(timeout=CLIENT_POLL_INTERVAL)
+            except queue.Empty:
+                pass
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            # clients send nothing after their request
+            if readable and not self.sock.recv(1, socket.MSG_PEEK):
+                return None
+
+
+# ----------------------------------------------------------------
+# RootQueue class
+#
+# Builds of one root: the request to build next, the clients waiting for
+# it as (client, index of the build in its request), and those waiting
+# for the running build.
+#
+class RootQueue(object):
+
+    def __init__(self):
+        self.request = None
+        self.waiting = []
+        self.builder = None
+        self.running = []
+        self.active = False
+
+
+# ----------------------------------------------------------------
+# BuildDaemon class
+#
+# make_builder(request) returns the builder of a request, run(builder,
+# local_cwd, force) runs it and returns whether it succeeded, see build.py.
+#
+class BuildDaemon(object):
+
+    def __init__(self, socket_path, jobs, make_builder, run):
+        self.socket_path = socket_path
+        self.make_builder = make_builder
+        self.run = run
+        self.slots = threading.Semaphore(max(jobs, 1))
+        self.lock = threading.Lock()
+        self.roots = {}
+        self.output = None
+
+    def submit(self, request, client, index):
+        '''
+        Queues the build of request for client, cancelling the running
+        build of the same root
+        '''
+        key = (request['tex_root'], request.get('job_name'))
+        with self.lock:
+            root = self.roots.setdefault(key, RootQueue())
+            if root.request is not None:
+                request = dict(request, force=request.get('force') or
+                               root.request.get('force'))
+            root.request = request
+            # the next build answers the clients of the one it supersedes
+            root.waiting = root.running + root.waiting + [(client, index)]
+            root.running = []
+            if root.builder is not None:
+                root.builder.cancel()
+            if root.active:
+                return
+            root.active = True
+        thread = threading.Thread(target=self._work, args=(key, root))
+        thread.daemon = True
+        thread.start()
+
+    def _broadcast(self, root, text):
+        with self.lock:
+            clients = [client for client, _ in root.running]
+        for client in clients:
+            client.send({'output': text})
+
+    def _work(self, key, root):
+        self.output.register(lambda text: self._broadcast(root, text))
+        while True:
+            with self.slots:
+                with self.lock:
+                    request = root.request
+                    if request is None:
+                        root.active = False
+                        return
+                    root.request = None
+                    root.running, root.waiting = root.waiting, []
+                try:
+                    builder = self.make_builder(request)
+                except Exception as e:
+                    print(u'Building {0} failed: {1}'.format(key[0], e))
+                    builder = None
+                with self.lock:
+                    root.builder = builder
+                    # superseded while the builder was made
+                    if builder is not None and root.request is not None:
+                        builder.cancel()
+                try:
+                    succeeded = self.run(
+                        builder, os.path.dirname(key[0]), request.get('force', False))
+                except Exception as e:
+                    print(u'Building {0} failed: {1}'.format(key[0], e))
+                    succeeded = False
+                with self.lock:
+                    root.builder = None
+                    clients, root.running = root.running, []
+            for client, index in clients:
+                client.send({'index': index, 'result': succeeded})
+
+    def cancel_abandoned(self):
+        '''
+        Cancels the builds no connected client is waiting for
+        '''
+        with self.lock:
+            for root in self.roots.values():
+                root.running = [(client, index) for client, index in root.running
+                                if not client.closed]
+                root.waiting = [(client, index) for client, index in root.waiting
+                                if not client.closed]
+                if not root.running and not root.waiting:
+                    root.request = None
+                    if root.builder is not None:
+                        root.builder.cancel()
+
+    def _serve(self, sock):
+        client = Client(sock)
+        try:
+            stream = sock.makefile('rwb')
+            message = read_message(stream)
+            builds = message['builds']
+            for index, request in enumerate(builds):
+                self.submit(request, client, index)
+            results = 0
+            while results < len(builds):
+                message = client.next_message()
+                if message is None:
+                    break
+                send_message(stream, message)
+                if 'result' in message:
+                    results += 1
+        except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+            self.output.stream.write(u'Dropped a client: {0}\n'.format(e))
+        finally:
+            client.closed = True
+            sock.close()
+            self.cancel_abandoned()
+
+    def serve_forever(self):
+        '''
+        Listens on the socket until interrupted or terminated, which
+        cancels all builds
+        '''
+        sock = connect(self.socket_path)
+        if sock is not None:
+            sock.close()
+            raise RuntimeError(u'A build daemon is already listening on ' + self.socket_path)
+        try:
+            os.remove(self.socket_path)
+        except OSError:
+            pass
+        directory = os.path.dirname(self.socket_path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        server.listen(16)
+        self.output = ThreadOutput(sys.stdout)
+        sys.stdout = self.output
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        print(u'Build daemon listening on {0}'.format(self.socket_path))
+        try:
+            while True:
+                sock, _ = server.accept()
+                thread = threading.Thread(target=self._serve, args=(sock,))
+                thread.daemon = True
+                thread.start()
+        finally:
+            server.close()
+            try:
+                os.remove(self.socket_path)
+            except OSError:
+                pass
+            with self.lock:
+                for root in self.roots.values():
+                    root.request = None
+                    if root.builder is not None:
+                        root.builder.cancel()
+            sys.stdout = self.output.stream
@@ -0,0 +1,107 @@
+from __future__ import print_function
+import os
+import time
+from subprocess import CalledProcessError
+from six import string_types
+from pdf_builders.pdfBuilder import start_command
+from pdf_builders.trace import command_category
+
+try:
+    from subprocess import TimeoutExpired
+except ImportError:
+    # Python 2 has no command timeouts, see asyncRunner
+    class TimeoutExpired(Exception):
+        pass
+
+
+def build_steps(pdf_builder, local_cwd, force=False, tracer=None):
+    '''
+    Runs the commands of pdf_builder, unless the build manifest of the
+    previous successful build shows that nothing changed since.
+
+    This is a generator driven by build.run(), which blocks, or by
+    asyncRunner.run_builder(). Every process started is yielded; the
+    driver waits for it, passing its output line by line to
+    pdf_builder.feed_output(), and sends back its output, or throws in
+    the CalledProcessError if it failed or the TimeoutExpired if it took
+    too long. The last value yielded is True or False, whether the build
+    succeeded
+    '''
+    print(local_cwd)
+    lane = os.path.join(pdf_builder.tex_dir, pdf_builder.tex_name)
+    build_start = time.time()
+    if not force and pdf_builder.is_up_to_date():
+        print(u'{0} is up to date.'.format(pdf_builder.tex_name))
+        if tracer is not None:
+            tracer.record(lane, u'up to date check', 'build',
+                          build_start, time.time())
+        yield True
+        return
+    pdf_builder.use_scratch_directory()
+    succeeded = True
+    # whether all commands ran, rather than the driver closing the steps
+    # or throwing in an unexpected error
+    completed = False
+    try:
+        for cmd in pdf_builder.commands():
+            if pdf_builder.cancelled:
+                break
+            process = None
+            start = time.time()
+            try:
+                if isinstance(cmd, tuple):
+                    print(cmd[1])
+                    if hasattr(cmd[0], 'communicate'):
+                        # the builder already started the process
+                        process = cmd[0]
+                    else:
+                        process = start_command(cmd[0], local_cwd)
+                    # registered so that cancel() can kill it
+                    pdf_builder.process = process
+                    if pdf_builder.cancelled:
+                        pdf_builder.cancel()
+                    out = yield process
+                    pdf_builder.set_output(out)
+                    succeeded = True
+                elif isinstance(cmd, string_types):
+                    print(cmd)
+            except CalledProcessError as e:
+                print(e.output)
+                print(e.stderr)
+                # the builder needs to see the output of failed runs too, e.g.
+                # to find missing files
+                pdf_builder.set_output(e.output)
+                succeeded = False
+            except TimeoutExpired as e:
+                print(e)
+                # the command was killed; its output so far was streamed
+                pdf_builder.set_output(e.output or u'')
+                succeeded = False
+            finally:
+                if tracer is not None and process is not None:
+                    command = getattr(process, 'args', None) or cmd[0]
+                    if isinstance(command, string_types):
+                        command = command.split()
+                    tracer.record(lane, cmd[1], command_category(command),
+                                  start, time.time(), process)
+        completed = True
+    finally:
+        pdf_builder.process = None
+        # a cancelled or aborted build leaves the aux directory as it was
+        pdf_builder.leave_scratch_directory(
+            sync=completed and not pdf_builder.cancelled)
+
+    if pdf_builder.cancelled:
+        print(u'Build of {0} cancelled.'.format(pdf_builder.tex_name))
+        if tracer is not None:
+            tracer.record(lane, u'build (cancelled)', 'build',
+                          build_start, time.time())
+        yield False
+        return
+
+    # only the final command decides whether the build succeeded
+    if succeeded:
+        pdf_builder.record_build()
+    if tracer is not None:
+        tracer.record(lane, u'build', 'build', build_start, time.time())
+    yield succeeded
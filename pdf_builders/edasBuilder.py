@@ -1,26 +1,23 @@
 #! Modified from https://github.com/SublimeText/LaTeXTools
 import os
-import re
 import subprocess
 import sys
 from six import string_types, reraise
 # This will work because makePDF.py puts the appropriate
 # builders directory in sys.path
-from pdf_builders.pdfBuilder import PdfBuilder, external_command, get_texpath, get_platform
-from pdf_builders.pdfBuilder import FILE_NOT_FOUND_ERROR_REGEX, TEXLIVEONFLY
+from pdf_builders.pdfBuilder import PdfBuilder, external_command, external_pipeline
+from pdf_builders.pdfBuilder import get_texpath, get_platform, start_command
+from pdf_builders.logParser import FILE_WRITE_ERROR, MISSING_FILE, RERUN
+from pdf_builders.logParser import BAD_BOX
+from pdf_builders.auxFiles import aux_fingerprint
+from pdf_builders.gsWorker import get_pool as get_gs_pool
 from pdf_builders.traditionalBuilder import DEFAULT_COMMAND_WINDOWS_MIKTEX
 
-# Standard LaTeX warning
-CITATIONS_REGEX = re.compile(
-    r"Warning: Citation [`|'].+' (?:on page \d+ )?undefined")
-# Capture which program to run for BibLaTeX
-BIBLATEX_REGEX = re.compile(
-    r"Package biblatex Warning: Please \(re\)run (\S*)")
-# Used to indicate a subdirectory that needs to be made for a file input using
-# \include
-FILE_WRITE_ERROR_REGEX = re.compile(
-    r"! I can't write on file `(.*)/([^/']*)'")
-
+# Options of Ghostscript converting the PostScript file written by dvips
+PS2PDF_OPTIONS = [
+    u'-dPDFSETTINGS=/prepress', u'-dCompatibilityLevel=1.4',
+    u'-dSubsetFonts=true', u'-dEmbedAllFonts=true', u'-sDEVICE=pdfwrite'
+]
 
 # ----------------------------------------------------------------
 # EdasBuilder class
@@ -36,23 +33,44 @@ class EdasBuilder(PdfBuilder):
         self.name = "Edas Builder (dvi->ps->pdf)"
         self.bibtex = self.builder_settings.get('bibtex', 'bibtex')
         self.ps2pdf = self.builder_settings.get('ps2pdf', None)
+        # 'dvips' converts the dvi to PostScript and then to PDF with
+        # Ghostscript, 'dvipdfmx' converts it to PDF directly
+        self.dvi_backend = self.builder_settings.get('dvi_backend', 'dvips')
+        # write the intermediate PostScript file instead of piping it
+        self.keep_ps = self.builder_settings.get('keep_ps', False)
+        # convert it with a Ghostscript process kept running for the
+        # following builds
+        self.gs_worker = self.builder_settings.get('gs_worker', False)
         self.display_log = self.builder_settings.get("display_log", False)
+        # upper bound for the passes run to reach a fixed point
+        self.max_passes = self.builder_settings.get('max_passes', 5)
 
     def commands(self):
         # Print greeting
         self.display("\n\nEdas Builder (dvi->ps->pdf): ")
 
         engine = u'latex'
-        latex = [engine, u"-interaction=nonstopmode", u"-synctex=1"]
-        texliveonfly = [TEXLIVEONFLY, u"-interaction=nonstopmode", u"-synctex=1"]
+        latex = [engine, u"-interaction=nonstopmode", u"-synctex=1",
+                 u"-recorder"]
         biber = [u"biber"]
-        ps2pdf = [self.ps2pdf if self.ps2pdf else
-                  (u'gs' if get_platform() != 'windows' else u'"C:\\Program Files\\gs\\gs9.25\\bin\\gswin64c.exe"'),
-                  u'-dNOPAUSE', u'-dBATCH', u'-dPDFSETTINGS=/prepress', u'-dCompatibilityLevel=1.4',
-                  u'-dSubsetFonts=true', u'-dEmbedAllFonts=true', u'-sDEVICE=pdfwrite',
-                  u'-sOutputFile=\"{tex_name}.pdf\"'.format(tex_name=self.job_name), u'-c', u'save pop', u'-f',
-                  u'\"{tex_name}.ps\"'.format(tex_name=self.job_name)]
-        dvips = [u'dvips', u'{tex_name}.dvi'.format(tex_name=self.job_name)]
+        # the arguments are passed without a shell, so file names are not
+        # quoted; "-" makes dvips write to and gs read from the pipe
+        ps_file = u'{tex_name}.ps'.format(tex_name=self.job_name) if self.keep_ps else u'-'
+        gs = self.ps2pdf if self.ps2pdf else (
+            u'gs' if get_platform() != 'windows' else u'C:\\Program Files\\gs\\gs9.25\\bin\\gswin64c.exe')
+        ps2pdf = [gs, u'-dNOPAUSE', u'-dBATCH'] + PS2PDF_OPTIONS + [
+            u'-sOutputFile={tex_name}.pdf'.format(tex_name=self.job_name), u'-c', u'save pop', u'-f',
+            ps_file]
+        dvi_file = u'{tex_name}.dvi'.format(tex_name=self.job_name)
+        # latex writes it to the aux directory, e.g. a scratch directory
+        if self.aux_path() != os.path.abspath(self.tex_dir):
+            dvi_file = os.path.join(self.aux_path(), dvi_file)
+        dvips = [u'dvips', u'-o', ps_file, dvi_file]
+        # dvipdfmx embeds and subsets all fonts by default; -V 4 matches
+        # the PDF version written by gs
+        dvipdfmx = [u'dvipdfmx', u'-V', u'4',
+                    u'-o', u'{tex_name}.pdf'.format(tex_name=self.job_name),
+                    dvi_file]
 
         if self.aux_directory is not None:
             biber.append(u'--output-directory=' + self.aux_directory)
@@ -77,6 +95,10 @@ class EdasBuilder(PdfBuilder):
 
         latex.append(self.tex_name)
 
+        # Load the preamble from a precompiled format, if enabled
+        for cmd in self.load_preamble_format(engine, latex):
+            yield cmd
+
         # Check if any subfolders need to be created
         # this adds a number of potential runs as LaTeX treats being unable
         # to open output files as fatal errors
@@ -90,103 +112,119 @@ class EdasBuilder(PdfBuilder):
         ):
             self.make_directory(output_directory)
 
-        yield (latex, "running {0}...".format(engine))
+        aux_path = self.aux_path()
+        fingerprint = aux_fingerprint(aux_path, self.job_name)
+        yield (self.engine_command(latex), "running {0}...".format(engine))
         self.display("done.\n")
         self.log_output()
 
         if output_directory is not None:
             while True:
-                start = 0
                 added_directory = False
-                while True:
-                    match = FILE_WRITE_ERROR_REGEX.search(self.out, start)
-                    if match:
-                        self.make_directory(
-                            os.path.normpath(
-                                os.path.join(
-                                    output_directory,
-                                    match.group(1)
-                                )
+                for event in self.log_index.events(FILE_WRITE_ERROR):
+                    self.make_directory(
+                        os.path.normpath(
+                            os.path.join(
+                                output_directory,
+                                event.data
                             )
                         )
-                        start = match.end(1)
-                        added_directory = True
-                    else:
-                        break
+                    )
+                    added_directory = True
                 if added_directory:
-                    yield (latex, "running {0}...".format(engine))
+                    fingerprint = aux_fingerprint(aux_path, self.job_name)
+                    yield (self.engine_command(latex), "running {0}...".format(engine))
                     self.display("done.\n")
                     self.log_output()
                 else:
                     break
 
-        if FILE_NOT_FOUND_ERROR_REGEX.search(self.out):
+        if self.log_index.has(MISSING_FILE):
             if get_platform() != u'windows':
-                texliveonfly.append(u'--jobname=' + self.job_name)
-                texliveonfly.append(self.tex_name)
-                yield(texliveonfly, 'running {0}'.format(u'texliveonfly'))
+                fingerprint = aux_fingerprint(aux_path, self.job_name)
+                yield (self.texliveonfly_command(engine, latex[1:-1]),
+                       'running {0}'.format(u'texliveonfly'))
             else:
                 windows_cmd = DEFAULT_COMMAND_WINDOWS_MIKTEX
                 for i, c in enumerate(windows_cmd):
                     windows_cmd[i] = c.replace(
                         "-%E", "-" + engine if engine != 'pdflatex' else '-pdf'
                     ).replace("%E", engine)
+                fingerprint = aux_fingerprint(aux_path, self.job_name)
                 yield (windows_cmd + [self.tex_name], "Invoking " + windows_cmd[0] + "... ")
-        # Check for citations
-        # We need to run pdflatex twice after bibtex
-        run_bibtex = False
-        use_bibtex = True
-        bibtex = None
-        if CITATIONS_REGEX.search(self.out):
-            run_bibtex = True
-            # are we using biblatex?
-            m = BIBLATEX_REGEX.search(self.out)
-            if m:
-                bibtex = m.group(1).lower()
-                if bibtex == 'biber':
-                    use_bibtex = False
-        # check for natbib as well
-        elif (
-            'Package natbib Warning: There were undefined citations'
-                in self.out):
-            run_bibtex = True
-
-        if run_bibtex:
-            if use_bibtex:
-                yield (
-                    self.run_bibtex(bibtex),
-                    "running {0}...".format(bibtex or 'bibtex')
-                )
-            else:
-                yield (biber + [self.job_name], 'running biber...')
 
-            self.display('done.\n')
-            self.log_output()
+        # remember this before the output is replaced by bibtex's
+        rerun_requested = self.log_index.has(RERUN)
 
-            for i in range(2):
-                yield (latex, "running {0}...".format(engine))
-                self.display("done.\n")
-                self.log_output()
+        for cmd in self.run_bibliography(biber):
+            yield cmd
 
-        # Check for changed labels
-        # Do this at the end, so if there are also citations to resolve,
-        # we may save one pdflatex run
-        if "Rerun to get cross-references right." in self.out:
-            yield (latex, "running {0}...".format(engine))
+        # Rerun until the files read back by the engine reach a fixed point
+        # This covers changed labels as well as a new .bbl, which makes any
+        # rerun request of LaTeX or a package redundant in most cases, but
+        # those are still honored for anything we do not fingerprint
+        passes = 0
+        while passes < self.max_passes:
+            current = aux_fingerprint(aux_path, self.job_name)
+            if current == fingerprint and not rerun_requested:
+                break
+            fingerprint = current
+            yield (self.engine_command(latex), "running {0}...".format(engine))
             self.display("done.\n")
             self.log_output()
+            rerun_requested = self.log_index.has(RERUN)
+            # e.g. page numbers in the index may have changed
+            for cmd in self.run_aux_tools():
+                yield cmd
+            passes += 1
+
+        if self.dvi_backend == 'dvipdfmx':
+            # Run dvipdfmx
+            yield (dvipdfmx, "running dvipdfmx ...")
+        elif self.gs_worker:
+            # Run dvips into the scratch directory of the worker, which is
+            # the only one it may read
+            job = get_gs_pool(gs, PS2PDF_OPTIONS).job(
+                os.path.join(self.tex_dir, self.job_name + u'.pdf'))
+            try:
+                process = start_command(
+                    [u'dvips', u'-o', job.ps_path, dvi_file],
+                    os.path.abspath(self.tex_dir))
+                yield (process, "running dvips ...")
+
+                # Run gs, unless dvips failed, which leaves the build failed
+                # rather than converting a partial PostScript file
+                if process.returncode == 0:
+                    yield (job, "running ps2pdf (worker) ...")
+            finally:
+                # also when the build is cancelled or dvips failed
+                job.remove_files()
+        elif self.keep_ps:
+            # Run dvips
+            yield(dvips, "running dvips ...")
 
-        # Run dvips
-        yield(dvips, "running dvips ...")
+            # Run gs
+            yield(ps2pdf, "running ps2pdf ...")
+        else:
+            # Run dvips and gs at the same time, without writing the
+            # PostScript file to disk
+            yield (external_pipeline([dvips, ps2pdf], cwd=self.tex_dir),
+                   "running dvips | ps2pdf ...")
 
-        # Run gs
-        yield(ps2pdf, "running ps2pdf ...")
+    # gs writes the PDF to the tex directory
+    def output_files(self):
+        return [os.path.join(
+            os.path.abspath(self.tex_dir), self.job_name + u'.pdf')]
 
     def log_output(self):
         if self.display_log:
             self.display("\nCommand results:\n")
             self.display(self.out)
             self.display("\n\n")
+        if self.track_log_files:
+            for event in self.log_index.events(BAD_BOX):
+                self.display("{0}:{1}: {2}\n".format(
+                    event.file or self.tex_name, event.line or '', event.message))
 
     def make_directory(self, directory):
         if not os.path.exists(directory):
@@ -197,6 +235,7 @@ class EdasBuilder(PdfBuilder):
                 if not os.path.exists(directory):
                     reraise(*sys.exc_info())
 
+    # Returns the process running bibtex, which is waited for by the caller
     def run_bibtex(self, command=None):
         if command is None:
             command = [self.bibtex]
@@ -220,7 +259,7 @@ class EdasBuilder(PdfBuilder):
             # now we modify cwd to be the output directory
             # NOTE this cwd is not reused by any of the other command
             cwd = output_directory
-        env['PATH'] = get_texpath()
+        env['PATH'] = get_texpath() or os.environ['PATH']
 
         command.append(self.job_name)
         return external_command(
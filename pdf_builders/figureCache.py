@@ -0,0 +1,206 @@
+# Shared cache of the figures externalized by the TikZ library.
+#
+# The main job only lists the figures, see EXTERNAL_MODE_HOOK; those not
+# found in the cache are compiled by the builder, several at the same time,
+# with the command the library would run itself, see BasicBuilder.
+import json
+import os
+import shutil
+from collections import namedtuple
+from pdf_builders.buildCache import hash_file, hash_value, parse_fls
+from pdf_builders.formatCache import read_preamble
+from pdf_builders.system import make_dirs
+
+# Makes the external library of TikZ list the figures of the document in
+# <job>.figlist instead of compiling them, and write the md5 of the code of
+# every figure to <figure>.md5, see FigureCache. Given before the root file
+# on the line TeX reads; an explicit mode in the document takes precedence
+EXTERNAL_MODE_HOOK = (
+    u'\\AddToHook{file/tikzlibraryexternal.code.tex/after}'
+    u'{\\tikzset{external/mode=list and make}}'
+)
+
+# Files written by a figure job which the main job reads
+FIGURE_EXTENSIONS = (u'.pdf', u'.dpth')
+
+# A figure in the cache: the name of its entry for the current contents of
+# the files it read, their absolute paths and the extensions of its files
+CachedFigure = namedtuple('CachedFigure', ['entry', 'inputs', 'extensions'])
+
+
+def figure_names(aux_path, job_name):
+    '''
+    Returns the names of the externalized figures listed by the last pass
+    '''
+    try:
+        with open(os.path.join(aux_path, job_name + u'.figlist'), 'rb') as f:
+            lines = f.read().decode('utf-8', 'ignore').splitlines()
+    except (IOError, OSError):
+        return []
+    return [line.strip() for line in lines if line.strip()]
+
+
+# ----------------------------------------------------------------
+# FigureCache class
+#
+# Externalized TikZ / pgfplots figures stored in a FileCache shared by all
+# documents. A figure is keyed by the md5 of its code, which the main job
+# writes to <figure>.md5, and by the engine and the preamble of the root
+# file. Like for PreambleFormat, the files read by the figure job (packages,
+# data files, files \input anywhere, ...) are stored in an index under that
+# key, and the files of the figure in an entry named by a hash of the key
+# and their contents.
+#
+# Files below the directory of the root file are recorded relative to it,
+# so checkouts of the same document in other places share the figures.
+#
+class FigureCache(object):
+
+    def __init__(self, cache, engine, tex_dir, tex_name):
+        self.cache = cache
+        self.engine = engine
+        self.tex_dir = tex_dir
+        self.tex_name = tex_name
+        self._preamble = False
+        # digests of the inputs of figures, which most figures share
+        self._digests = {}
+
+    def _local(self, path):
+        if path.startswith(self.tex_dir + os.sep):
+            return os.path.relpath(path, self.tex_dir)
+        return path
+
+    def _digest(self, path):
+        path = os.path.join(self.tex_dir, path)
+        if path not in self._digests:
+            self._digests[path] = hash_file(path)
+        return self._digests[path]
+
+    def preamble(self):
+        if self._preamble is False:
+            self._preamble = read_preamble(
+                os.path.join(self.tex_dir, self.tex_name))
+        return self._preamble
+
+    def figure_key(self, aux_path, name):
+        '''
+        Returns the key of the figure name as the last pass saw it, or None
+        if the main job did not write its md5
+        '''
+        try:
+            with open(os.path.join(aux_path, name + u'.md5'), 'rb') as f:
+                md5 = f.read().decode('utf-8', 'ignore').strip()
+        except (IOError, OSError):
+            return None
+        if not md5 or self.preamble() is None:
+            return None
+        return hash_value([self.engine, self.preamble(), md5])
+
+    def _entry_name(self, key, inputs):
+        return hash_value([key, [self._digest(path) for path in sorted(inputs)]])
+
+    def _absolute(self, inputs):
+        return [os.path.join(self.tex_dir, path) for path in inputs]
+
+    def lookup(self, key):
+        '''
+        Returns the CachedFigure of the figure with key for the current
+        contents of the files it read, or None if the figure was not stored.
+        The entry itself may not be cached, see fetch()
+        '''
+        index = self.cache.get(key + u'.json')
+        if index is None:
+            return None
+        try:
+            with open(index, 'r') as f:
+                data = json.load(f)
+            inputs, extensions = data['inputs'], data['extensions']
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+        return CachedFigure(
+            self._entry_name(key, inputs), self._absolute(inputs), extensions)
+
+    def fetch(self, figure, aux_path, name):
+        '''
+        Copies the files of figure, a CachedFigure, to aux_path as name.
+        Returns False if they are not cached
+        '''
+        paths = [self.cache.get(figure.entry + ext) for ext in figure.extensions]
+        if not paths or None in paths:
+            return False
+        try:
+            make_dirs(os.path.dirname(os.path.join(aux_path, name)))
+            for ext, path in zip(figure.extensions, paths):
+                shutil.copyfile(path, os.path.join(aux_path, name + ext))
+        except (IOError, OSError):
+            return False
+        return True
+
+    def figure_command(self, latex, aux_path, job_name, name):
+        '''
+        Returns the command compiling the figure name to aux_path as the
+        external library would, from the latex command of the main job
+        '''
+        command = [
+            c for c in latex[:-1] if not c.startswith((
+                u'-interaction=', u'-synctex=', u'--output-directory=',
+                u'--aux-directory=', u'--jobname='))
+        ]
+        command.extend([
+            u'-halt-on-error', u'-interaction=batchmode',
+            u'--output-directory=' + aux_path, u'--jobname=' + name,
+            u'\\def\\tikzexternalrealjob{{{0}}}\\input{{{1}}}'.format(
+                job_name, self.tex_name)
+        ])
+        return command
+
+    def prepare(self, aux_path, name):
+        '''
+        Removes what an earlier job left of the figure name, which a failed
+        job would not replace, and creates the directory of its files
+        '''
+        make_dirs(os.path.dirname(os.path.join(aux_path, name)))
+        for ext in FIGURE_EXTENSIONS:
+            try:
+                os.remove(os.path.join(aux_path, name + ext))
+            except OSError:
+                pass
+
+    def store(self, key, aux_path, name, generated=()):
+        '''
+        Stores the figure name compiled by figure_command() in aux_path
+        under key. Files in generated, i.e. those written by the main job,
+        are not recorded as inputs.
+        Returns the CachedFigure, or None if the figure was not compiled
+        '''
+        if not os.path.isfile(os.path.join(aux_path, name + u'.pdf')):
+            return None
+        inputs, outputs = parse_fls(os.path.join(aux_path, name + u'.fls'))
+        skipped = set(outputs)
+        skipped.update(generated)
+        # the md5 of the figure and the preamble stand for the root file;
+        # everything else it read, including files \input by the figure or
+        # the document, may change the figure
+        skipped.add(os.path.join(self.tex_dir, self.tex_name))
+        recorded = sorted(set(
+            self._local(path) for path in inputs
+            if path not in skipped and not os.path.isdir(path)))
+
+        extensions = [ext for ext in FIGURE_EXTENSIONS
+                      if os.path.isfile(os.path.join(aux_path, name + ext))]
+        entry = self._entry_name(key, recorded)
+        work = self.cache.temp_directory()
+        try:
+            for ext in extensions:
+                path = os.path.join(work, entry + ext)
+                shutil.copyfile(os.path.join(aux_path, name + ext), path)
+                self.cache.put(entry + ext, path)
+            index = os.path.join(work, key + u'.json')
+            with open(index, 'w') as f:
+                json.dump({'inputs': recorded, 'extensions': extensions}, f)
+            self.cache.put(key + u'.json', index)
+        except (IOError, OSError):
+            pass
+        finally:
+            shutil.rmtree(work, ignore_errors=True)
+        return CachedFigure(entry, self._absolute(recorded), extensions)
@@ -0,0 +1,153 @@
+import json
+import os
+import re
+import shutil
+from pdf_builders.buildCache import file_signature, hash_file, hash_value
+from pdf_builders.buildCache import parse_fls
+
+# Engines whose state after the preamble can be dumped by mylatexformat.
+# LuaTeX cannot dump the Lua state and the fonts it loaded
+FORMAT_ENGINES = (u'pdflatex', u'xelatex', u'latex')
+FORMAT_SUFFIX = u'.fmt'
+
+# mylatexformat dumps everything up to \begin{document} or \endofdump
+PREAMBLE_END_REGEX = re.compile(
+    r"^[^%\n]*\\(?:begin\s*\{document\}|endofdump|csname\s+endofdump)",
+    re.MULTILINE)
+
+
+def read_preamble(tex_path):
+    '''
+    Returns the preamble of tex_path, i.e. everything before the line with
+    \\begin{document} or \\endofdump, or None if it has none
+    '''
+    try:
+        with open(tex_path, 'rb') as f:
+            text = f.read().decode('utf-8', 'ignore')
+    except (IOError, OSError):
+        return None
+    m = PREAMBLE_END_REGEX.search(text)
+    if m is None:
+        return None
+    return text[:m.start()]
+
+
+def format_name(preamble_key, digests):
+    return hash_value([preamble_key, digests]) + FORMAT_SUFFIX
+
+
+# ----------------------------------------------------------------
+# PreambleFormat class
+#
+# Format file holding the state of the engine after the preamble of a root
+# file, dumped with mylatexformat. Loading it with "&<format>" skips
+# parsing the preamble and loading its packages on every pass.
+#
+# The format is stored in a FileCache under a hash of the preamble and of
+# the contents of every file read while dumping it (classes, packages,
+# the base format, ...). The list of those files is stored next to it
+# under the hash of the preamble alone, so a lookup only has to check
+# whether any of them changed.
+#
+class PreambleFormat(object):
+
+    def __init__(self, cache, engine, tex_dir, tex_name):
+        self.cache = cache
+        self.engine = engine
+        self.tex_dir = tex_dir
+        self.tex_name = tex_name
+        # files read while dumping the format, which the build depends on
+        # without the engine recording them
+        self.inputs = []
+        self._preamble_key = False
+        self._work = None
+
+    def preamble_key(self):
+        if self._preamble_key is False:
+            preamble = read_preamble(os.path.join(self.tex_dir, self.tex_name))
+            self._preamble_key = None if preamble is None else hash_value(
+                [self.engine, self.tex_dir, preamble])
+        return self._preamble_key
+
+    def lookup(self):
+        '''
+        Returns the path of the format, without extension, or None if the
+        preamble or one of the files read with it changed since it was dumped
+        '''
+        key = self.preamble_key()
+        if key is None:
+            return None
+        index = self.cache.get(key + u'.json')
+        if index is None:
+            return None
+        try:
+            with open(index, 'r') as f:
+                inputs = json.load(f)['inputs']
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+
+        digests = []
+        for path in sorted(inputs):
+            mtime, size, digest = inputs[path]
+            signature = file_signature(path)
+            if signature is None:
+                return None
+            if signature != [mtime, size]:
+                digest = hash_file(path)
+            digests.append(digest)
+
+        fmt = self.cache.get(format_name(key, digests))
+        # the format name ends the first line TeX reads
+        if fmt is None or re.search(r'\s', fmt):
+            return None
+        self.inputs = sorted(inputs)
+        return fmt[:-len(FORMAT_SUFFIX)]
+
+    def dump_command(self):
+        '''
+        Returns the command dumping the format into a scratch directory of
+        the cache. Must be followed by a call to store()
+        '''
+        self._work = self.cache.temp_directory()
+        return [self.engine, u'-ini', u'-interaction=nonstopmode',
+                u'-recorder', u'-output-directory=' + self._work,
+                u'-jobname=' + self.preamble_key(), u'&' + self.engine,
+                u'mylatexformat.ltx', self.tex_name]
+
+    def store(self):
+        '''
+        Moves the format dumped by dump_command() into the cache and returns
+        its path, without extension, or None if dumping failed
+        '''
+        work, self._work = self._work, None
+        key = self.preamble_key()
+        fmt = os.path.join(work, key + FORMAT_SUFFIX)
+        try:
+            if not os.path.isfile(fmt):
+                return None
+
+            inputs, outputs = parse_fls(os.path.join(work, key + u'.fls'))
+            main = os.path.normpath(os.path.join(self.tex_dir, self.tex_name))
+            entries = {}
+            for path in inputs:
+                if path == main or path in outputs or os.path.isdir(path):
+                    continue
+                signature = file_signature(path)
+                if signature is not None:
+                    entries[path] = signature + [hash_file(path)]
+
+            index = os.path.join(work, key + u'.json')
+            with open(index, 'w') as f:
+                json.dump({'inputs': entries}, f, sort_keys=True)
+            digests = [entries[path][2] for path in sorted(entries)]
+            fmt = self.cache.put(format_name(key, digests), fmt)
+            self.cache.put(key + u'.json', index)
+        except (IOError, OSError):
+            return None
+        finally:
+            shutil.rmtree(work, ignore_errors=True)
+
+        if re.search(r'\s', fmt):
+            return None
+        self.inputs = sorted(entries)
+        return fmt[:-len(FORMAT_SUFFIX)]
@@ -0,0 +1,357 @@
+import atexit
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+from pdf_builders.pdfBuilder import external_command, get_platform
+
+# Printed by the worker after every job; the job number makes a marker of
+# an earlier job impossible to mistake for the current one
+DONE_MARKER = u'PDFBUILDER-DONE'
+ERROR_MARKER = u'PDFBUILDER-ERROR'
+# Printed if the worker may not switch its output file, e.g. because
+# -dSAFER locked the device parameters
+SWITCH_ERROR_MARKER = u'PDFBUILDER-SWITCH-ERROR'
+
+GS_VERSION_REGEX = re.compile(r'(\d+)\.(\d+)')
+
+
+def ps_string(text):
+    '''
+    Returns text as a PostScript string literal
+    '''
+    return u'(' + re.sub(r'([()\\])', r'\\\1', text) + u')'
+
+
+def gs_version(gs):
+    '''
+    Returns the version of Ghostscript as a tuple, or None if unknown
+    '''
+    try:
+        output = subprocess.check_output([gs, u'--version'])
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    m = GS_VERSION_REGEX.search(output.decode('utf-8', 'ignore'))
+    return (int(m.group(1)), int(m.group(2))) if m else None
+
+
+# ----------------------------------------------------------------
+# GhostscriptWorker class
+#
+# A Ghostscript process running a pdfwrite device which reads jobs from
+# stdin, so font maps and resources are only loaded once for any number
+# of conversions.
+#
+class GhostscriptWorker(object):
+
+    def __init__(self, gs, options, directory):
+        # set as output after every job, so that pdfwrite closes, i.e.
+        # finishes, the PDF of the job
+        self.idle_output = os.path.join(
+            directory, u'idle{0}.pdf'.format(id(self)))
+        command = [gs, u'-q', u'-dNOPAUSE', u'-dSAFER']
+        version = gs_version(gs)
+        # older versions have no file permissions, but do not restrict
+        # access to files unless -dSAFER is given
+        if version is None or version >= (9, 50):
+            command.append(u'--permit-file-all=' + directory + os.sep)
+        else:
+            command[-1] = u'-dNOSAFER'
+        command.extend(options)
+        command.extend([u'-sOutputFile=' + self.idle_output, u'-'])
+        self.process = external_command(
+            command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            preexec_fn=os.setsid if get_platform() != 'windows' else None)
+        self.jobs = 0
+        # whether the output file could not be switched, see convert()
+        self.unsupported = False
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def convert(self, ps_path, pdf_path):
+        '''
+        Converts ps_path to pdf_path. Returns (success, output lines);
+        success is None if the worker died, e.g. because it was killed, or
+        if it may not switch its output file, which sets unsupported
+        '''
+        self.jobs += 1
+        done = u'{0} {1}'.format(DONE_MARKER, self.jobs)
+
+        def report(marker):
+            return (u'{{ ({0} ) print $error /errorname get =only (\\n) print '
+                    u'$error /newerror false put }}').format(marker)
+
+        def switch(path):
+            return u'{{ << /OutputFile {0} >> setpagedevice }} stopped'.format(
+                ps_string(path))
+
+        # every step runs in a stopped context, so that no error makes the
+        # interpreter reading stdin give up
+        program = u'\n'.join([
+            switch(pdf_path),
+            report(SWITCH_ERROR_MARKER),
+            u'{',
+            u'save pop',
+            u'{{ {0} run }} stopped {1} if'.format(
+                ps_string(ps_path), report(ERROR_MARKER)),
+            u'{0} {1} if'.format(
+                switch(self.idle_output), report(SWITCH_ERROR_MARKER)),
+            u'} ifelse',
+            u'({0}\\n) print flush'.format(done),
+            u''
+        ])
+        try:
+            self.process.stdin.write(program.encode('utf-8'))
+            self.process.stdin.flush()
+        except (IOError, OSError):
+            return None, []
+
+        lines = []
+        failed = False
+        for line in iter(self.process.stdout.readline, b''):
+            line = line.decode('utf-8', 'ignore').rstrip(u'\r\n')
+            if line == done:
+                if self.unsupported:
+                    return None, lines
+                return not failed, lines
+            if line.startswith(SWITCH_ERROR_MARKER):
+                self.unsupported = True
+            elif line.startswith(ERROR_MARKER):
+                failed = True
+            lines.append(line)
+        return None, lines
+
+    def close(self):
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+        self.process.wait()
+        if os.path.exists(self.idle_output):
+            os.remove(self.idle_output)
+
+
+# ----------------------------------------------------------------
+# GhostscriptJob class
+#
+# Popen-like conversion of a PostScript file to a PDF by a worker of a
+# GhostscriptPool. dvips writes the PostScript file to ps_path; the
+# conversion runs when the job is waited for, after which the PDF is
+# moved to its destination.
+#
+# If no worker can do the conversion, e.g. because the Ghostscript in use
+# does not let it switch output files, it is done by a Ghostscript process
+# of its own, like without workers.
+#
+class GhostscriptJob(object):
+
+    def __init__(self, pool, pdf_path):
+        self.pool = pool
+        self.args = [pool.gs, u'(worker)', pdf_path]
+        self.pdf_path = pdf_path
+        self.ps_path = pool.scratch_file(u'.ps')
+        self._output = pool.scratch_file(u'.pdf')
+        self.worker = None
+        self.process = None
+        self.stdout = None
+        self.stderr = None
+        self.returncode = None
+        self.output = b''
+        self._killed = False
+
+    def _convert(self):
+        success, lines = None, []
+        # a worker which died is replaced and the job retried once, unless
+        # it was killed because the build was cancelled
+        for _ in range(2):
+            if self._killed or not self.pool.usable:
+                break
+            self.worker = self.pool.acquire()
+            success, lines = self.worker.convert(self.ps_path, self._output)
+            if success is not None:
+                break
+            self.pool.discard(self.worker)
+            if self.worker.unsupported:
+                # no worker of this Ghostscript can do the job
+                self.pool.usable = False
+                lines.append(u'Ghostscript workers cannot switch output files')
+            else:
+                lines.append(u'Ghostscript exited with status {0}'.format(
+                    self.worker.process.returncode))
+            self.worker = None
+        if success is None and not self._killed:
+            # workers which keep dying are not started again either
+            self.pool.usable = False
+            lines.append(u'converting with a Ghostscript process of its own')
+            success, more = self._convert_alone()
+            lines.extend(more)
+        return success, lines
+
+    def _convert_alone(self):
+        self.process = external_command(
+            self.pool.command(self.ps_path, self._output),
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            preexec_fn=os.setsid if get_platform() != 'windows' else None)
+        if self._killed:
+            self.process.kill()
+        output = self.process.communicate()[0] or b''
+        lines = output.decode('utf-8', 'ignore').splitlines()
+        return self.process.returncode == 0, lines
+
+    def _run(self):
+        success = False
+        try:
+            if os.path.getsize(self.ps_path):
+                success, lines = self._convert()
+            else:
+                # dvips failed, the scratch file is still empty
+                lines = [u'No PostScript file to convert']
+
+            if success:
+                shutil.move(self._output, self.pdf_path)
+                self.returncode = 0
+            else:
+                self.returncode = 1
+            self.output = u'\n'.join(lines).encode('utf-8')
+        finally:
+            self.remove_files()
+            if self.worker is not None:
+                # an error may leave the interpreter in any state
+                if success:
+                    self.pool.release(self.worker)
+                else:
+                    self.pool.discard(self.worker)
+                self.worker = None
+
+    def remove_files(self):
+        '''
+        Removes the scratch files of the job, whether it ran or not
+        '''
+        for path in (self.ps_path, self._output):
+            if os.path.exists(path):
+                os.remove(path)
+
+    # the pid of the worker or process running the job, if any
+    @property
+    def pid(self):
+        worker = self.worker
+        if worker is not None:
+            return worker.process.pid
+        process = self.process
+        return None if process is None else process.pid
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        if self.returncode is None:
+            self._run()
+        return self.returncode
+
+    def communicate(self, input=None):
+        self.wait()
+        return self.output, None
+
+    def kill(self):
+        self._killed = True
+        worker = self.worker
+        if worker is not None:
+            worker.process.kill()
+        process = self.process
+        if process is not None and process.poll() is None:
+            process.kill()
+
+
+# ----------------------------------------------------------------
+# GhostscriptPool class
+#
+# Idle workers started with the same options. A job takes a worker out of
+# the pool until it is finished, so concurrent builds each get their own;
+# a worker whose job failed is replaced by a new one.
+#
+# The files of all jobs are kept in the scratch directory of the pool,
+# the only one the workers may access under -dSAFER.
+#
+class GhostscriptPool(object):
+
+    def __init__(self, gs, options):
+        self.gs = gs
+        self.options = options
+        self.directory = tempfile.mkdtemp(prefix=u'pdfbuilder-gs')
+        self._idle = []
+        self._lock = threading.Lock()
+        # False once workers could not convert a file, see GhostscriptJob
+        self.usable = True
+
+    def command(self, ps_path, pdf_path):
+        '''
+        Returns the command converting ps_path to pdf_path without a worker
+        '''
+        return [self.gs, u'-dNOPAUSE', u'-dBATCH'] + self.options + [
+            u'-sOutputFile=' + pdf_path, u'-c', u'save pop', u'-f', ps_path]
+
+    def scratch_file(self, suffix):
+        fd, path = tempfile.mkstemp(suffix=suffix, dir=self.directory)
+        os.close(fd)
+        return path
+
+    def acquire(self):
+        with self._lock:
+            while self._idle:
+                worker = self._idle.pop()
+                if worker.is_alive():
+                    return worker
+                worker.close()
+        return GhostscriptWorker(self.gs, self.options, self.directory)
+
+    def release(self, worker):
+        if not worker.is_alive():
+            worker.close()
+            return
+        with self._lock:
+            self._idle.append(worker)
+
+    def discard(self, worker):
+        worker.close()
+
+    def job(self, pdf_path):
+        '''
+        Returns a GhostscriptJob converting its ps_path to pdf_path
+        '''
+        return GhostscriptJob(self, pdf_path)
+
+    def shutdown(self):
+        with self._lock:
+            for worker in self._idle:
+                worker.close()
+            self._idle = []
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(gs, options):
+    '''
+    Returns the pool of Ghostscript workers for gs started with options,
+    shared by all builds of the process
+    '''
+    key = (gs, tuple(options))
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = GhostscriptPool(gs, list(options))
+        return pool
+
+
+@atexit.register
+def shutdown_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.shutdown()
+        _pools.clear()
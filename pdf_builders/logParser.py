@@ -0,0 +1,291 @@
+import re
+from collections import namedtuple
+
+# This module is also imported by texliveonfly.py when it runs as a script,
+# so it must not depend on anything else in pdf_builders
+
+# ---------------------------------------------------------------
+# Event kinds
+#
+ERROR = 'error'
+# data: name of the missing file
+MISSING_FILE = 'missing_file'
+# data: name of the .tfm file of a missing font
+MISSING_FONT_FILE = 'missing_font_file'
+# data: name of a missing font
+MISSING_FONT = 'missing_font'
+# data: directory which has to be created for an \include'd file
+FILE_WRITE_ERROR = 'file_write_error'
+# data: citation key, or None for the natbib summary warning
+UNDEFINED_CITATION = 'undefined_citation'
+# data: program biblatex asks for (bibtex, biber, ...)
+BIBLIOGRAPHY_PROGRAM = 'bibliography_program'
+RERUN = 'rerun'
+# data: 'Overfull' or 'Underfull'
+BAD_BOX = 'bad_box'
+
+# kind: one of the above
+# message: the log line the event was found on
+# data: kind specific, see above
+# file: the source file being read when the event occurred, if known
+# line: the source line of the event, if reported
+LogEvent = namedtuple('LogEvent', ['kind', 'message', 'data', 'file', 'line'])
+
+# Used by the builders before the log index existed and kept for
+# compatibility
+FILE_NOT_FOUND_ERROR_REGEX = re.compile(
+    r"! LaTeX Error: File `(.*)/([^/']*)'", re.MULTILINE)
+# Explicit requests for another pass from LaTeX, hyperref, longtable,
+# rerunfilecheck, natbib and biblatex
+RERUN_REGEX = re.compile(
+    r"(?:Rerun to get |Rerun LaTeX|Please rerun LaTeX|\(rerunfilecheck\) +Rerun)")
+
+# Finds every line which can hold an event: errors, source lines of errors,
+# warnings, "(package) Rerun ..." continuation lines and bad boxes.
+# Everything else in the log is skipped by the regular expression engine in
+# a single pass
+CANDIDATE_PREFIX = (r"(?:! |l\.\d|LaTeX Warning|Package \S+ Warning|Overfull "
+                    r"|Underfull |\(\w+\) +Rerun)")
+CANDIDATE_LINE_REGEX = re.compile(CANDIDATE_PREFIX)
+# Same for a complete output except its first line. Starting the pattern
+# with the newline lets the engine skip ahead to the next line break
+# instead of trying the alternatives at every position, which is several
+# times faster than an anchored multiline pattern
+CANDIDATE_LINES_REGEX = re.compile(r"\n(" + CANDIDATE_PREFIX + r"[^\n]*)")
+
+MISSING_FILE_REGEX = re.compile(
+    r"^! (?:LaTeX Error: File `([^`']*)' not found|I can't find file `([^`']*)')")
+FILE_WRITE_ERROR_REGEX = re.compile(r"^! I can't write on file `(.*)/([^/']*)'")
+FONT_FILE_REGEX = re.compile(r"^! Font \\[^=]*=(\S*)(?:\s|$)")
+FONT_REGEX = re.compile(r"^! Font (?:.*file:([^:]*):|\\[^/]*/([^/]*)/)")
+SOURCE_LINE_REGEX = re.compile(r"^l\.(\d+)")
+CITATION_REGEX = re.compile(
+    r"Warning: Citation [`|'](.+)' (?:on page \d+ )?undefined"
+    r"(?: on input line (\d+))?")
+NATBIB_CITATIONS = 'Package natbib Warning: There were undefined citations'
+BIBLATEX_REGEX = re.compile(
+    r"Package biblatex Warning: Please \(re\)run (\S*)")
+INPUT_LINE_REGEX = re.compile(r"on input line (\d+)")
+BAD_BOX_LINE_REGEX = re.compile(r" at lines? (\d+)")
+
+# Files opened and closed by the engine, e.g. "(./chapter.tex" and ")".
+# Everything up to the next such parenthesis is consumed by the same match,
+# including parentheses closed on the same line as in "(type pdf)", so that
+# only file boundaries produce matches
+FILE_TOKEN_REGEX = re.compile(
+    r'[^()]*(?:\([^()\n]*\)[^()]*)*(?:\((?:"([^"]*)"|([^\s()]*))|(\)))')
+FILE_NAME_REGEX = re.compile(r'\((?:"[^"]*"|[^\s()]*)|\)')
+
+
+# ---------------------------------------------------------------
+# LogIndex class
+#
+# Index of the events found in the output of a LaTeX run. The output is
+# walked exactly once, either line by line as it is produced (feed()) or
+# as a whole (parse()), and the builders and texliveonfly only query the
+# resulting index.
+#
+# Attributing events to source files is opt-in (track_files) since it
+# costs more than finding the events. parse() defers it further until the
+# events themselves are queried, so has() never pays for it.
+#
+class LogIndex(object):
+
+    def __init__(self, track_files=False):
+        self.track_files = track_files
+        self._events = []
+        self._by_kind = {}
+        self._files = []
+        # indices of the events of the last error, which get the line
+        # number of the following "l.<number>" line
+        self._pending_error = []
+        # output parsed without resolving files yet and the
+        # (index of first event, offset) of every line holding events
+        self._text = None
+        self._unresolved = []
+
+    @classmethod
+    def parse(cls, text, track_files=False):
+        '''
+        Builds the index of a complete output in a single pass
+        '''
+        index = cls(track_files)
+        first_line = text.split(u'\n', 1)[0]
+        if not track_files:
+            if CANDIDATE_LINE_REGEX.match(first_line):
+                index._classify(first_line)
+            for line in CANDIDATE_LINES_REGEX.findall(text):
+                index._classify(line)
+            return index
+
+        index._text = text
+        if CANDIDATE_LINE_REGEX.match(first_line):
+            index._classify_at(first_line, 0)
+        for m in CANDIDATE_LINES_REGEX.finditer(text):
+            index._classify_at(m.group(1), m.start(1))
+        return index
+
+    def feed(self, line):
+        '''
+        Adds one line of output to the index
+        '''
+        if CANDIDATE_LINE_REGEX.match(line):
+            self._classify(line)
+        if self.track_files and (u'(' in line or u')' in line):
+            for token in _file_tokens(line):
+                self._track_file(token)
+
+    def has(self, kind):
+        return kind in self._by_kind
+
+    def events(self, kind=None):
+        self._resolve_files()
+        if kind is None:
+            return list(self._events)
+        return [self._events[i] for i in self._by_kind.get(kind, ())]
+
+    def first(self, kind):
+        indices = self._by_kind.get(kind)
+        if not indices:
+            return None
+        self._resolve_files()
+        return self._events[indices[0]]
+
+    def current_file(self):
+        self._resolve_files()
+        for name in reversed(self._files):
+            if name is not None:
+                return name
+        return None
+
+    def _track_file(self, token):
+        position, name = token
+        if name is None:
+            if self._files:
+                self._files.pop()
+        # parentheses which do not open a file still have to be balanced
+        # by their closing counterpart
+        elif u'.' in name or u'/' in name:
+            self._files.append(name)
+        else:
+            self._files.append(None)
+
+    def _resolve_files(self):
+        # walks the file boundaries of the parsed output in step with the
+        # lines which held events, see parse()
+        if self._text is None:
+            return
+        text = self._text
+        self._text = None
+        unresolved = self._unresolved
+        self._unresolved = []
+        tokens = _file_tokens(text)
+        token = next(tokens, None)
+        ends = [start for start, _ in unresolved[1:]] + [len(self._events)]
+        for (start, offset), end in zip(unresolved, ends):
+            while token is not None and token[0] < offset:
+                self._track_file(token)
+                token = next(tokens, None)
+            name = self.current_file()
+            for i in range(start, end):
+                self._events[i] = self._events[i]._replace(file=name)
+        while token is not None:
+            self._track_file(token)
+            token = next(tokens, None)
+
+    def _classify_at(self, line, offset):
+        start = len(self._events)
+        self._classify(line)
+        if len(self._events) > start:
+            self._unresolved.append((start, offset))
+
+    def _add(self, kind, message, data=None, line=None):
+        self._by_kind.setdefault(kind, []).append(len(self._events))
+        # files of parsed output are resolved later, see _resolve_files()
+        self._events.append(LogEvent(
+            kind, message, data,
+            self.current_file() if self.track_files and self._text is None
+            else None, line))
+
+    def _add_error_detail(self, kind, message, data):
+        self._pending_error.append(len(self._events))
+        self._add(kind, message, data)
+
+    def _classify(self, line):
+        # cheap dispatch on the first character and on substrings, so that
+        # the regular expressions only run on lines which hold an event
+        first = line[0]
+        if first == u'!':
+            self._pending_error = [len(self._events)]
+            self._add(ERROR, line)
+            m = MISSING_FILE_REGEX.match(line)
+            if m:
+                self._add_error_detail(
+                    MISSING_FILE, line, m.group(1) or m.group(2))
+                return
+            m = FILE_WRITE_ERROR_REGEX.match(line)
+            if m:
+                self._add_error_detail(FILE_WRITE_ERROR, line, m.group(1))
+                return
+            if line.startswith(u'! Font '):
+                m = FONT_FILE_REGEX.match(line)
+                if m:
+                    self._add_error_detail(
+                        MISSING_FONT_FILE, line, m.group(1) + u'.tfm')
+                m = FONT_REGEX.match(line)
+                if m:
+                    self._add_error_detail(
+                        MISSING_FONT, line, m.group(1) or m.group(2))
+            return
+
+        if first == u'l':
+            m = SOURCE_LINE_REGEX.match(line)
+            if m:
+                for i in self._pending_error:
+                    self._events[i] = self._events[i]._replace(
+                        line=int(m.group(1)))
+                self._pending_error = []
+            return
+
+        if first == u'O' or first == u'U':
+            m = BAD_BOX_LINE_REGEX.search(line)
+            self._add(BAD_BOX, line,
+                      u'Overfull' if first == u'O' else u'Underfull',
+                      int(m.group(1)) if m else None)
+            return
+
+        if u'Citation' in line:
+            m = CITATION_REGEX.search(line)
+            if m:
+                self._add(UNDEFINED_CITATION, line, m.group(1),
+                          int(m.group(2)) if m.group(2) else None)
+        elif NATBIB_CITATIONS in line:
+            self._add(UNDEFINED_CITATION, line)
+
+        if u'run' in line:
+            m = BIBLATEX_REGEX.search(line)
+            if m:
+                self._add(BIBLIOGRAPHY_PROGRAM, line, m.group(1).lower())
+            elif RERUN_REGEX.search(line):
+                m = INPUT_LINE_REGEX.search(line)
+                self._add(RERUN, line, None, int(m.group(1)) if m else None)
+
+
+def _file_tokens(text):
+    '''
+    Yields a (position, name) tuple for every parenthesis in text which
+    opens or closes a file, with name None for closing ones
+    '''
+    # stopping right after the last parenthesis (and the file name it may
+    # open) keeps the failing matches at the end of text cheap
+    end = max(text.rfind(u'('), text.rfind(u')'))
+    if end < 0:
+        return
+    end = FILE_NAME_REGEX.match(text, end).end()
+    for m in FILE_TOKEN_REGEX.finditer(text, 0, end):
+        if m.group(3) is not None:
+            yield m.start(3), None
+        elif m.group(1) is not None:
+            yield m.start(1) - 2, m.group(1)
+        else:
+            yield m.start(2) - 1, m.group(2)
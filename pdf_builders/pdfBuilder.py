@@ -6,7 +6,28 @@ from shlex import split
 from six import string_types
 import subprocess
 import re
-from pdf_builders.system import which
+import signal
+import threading
+from functools import partial
+from pdf_builders.system import make_dirs, which
+from pdf_builders.buildCache import BuildState, BuildManifest, STATE_SUFFIX
+from pdf_builders.buildCache import SOURCE_EXTENSIONS
+from pdf_builders.buildCache import hash_file, hash_value, parse_fls
+from pdf_builders.buildCache import entries_unchanged, file_entries
+from pdf_builders.buildCache import FileCache, user_cache_directory
+from pdf_builders.formatCache import PreambleFormat, FORMAT_ENGINES
+from pdf_builders.warmEngine import get_pool, preamble_signatures, split_preamble
+from pdf_builders.warmEngine import preamble_inputs
+from pdf_builders.auxFiles import bibliography_sources, citation_fingerprint
+from pdf_builders.auxFiles import included_parts
+from pdf_builders.auxTools import AuxTool, BIBLIOGRAPHY_CONSUMES, BIBLIOGRAPHY_PRODUCES
+from pdf_builders.auxTools import configured_tools, plan
+from pdf_builders.scratchDirectory import ScratchDirectory, scratch_path
+# the regular expressions are defined with the log parser now
+from pdf_builders.logParser import LogIndex
+from pdf_builders.logParser import FILE_NOT_FOUND_ERROR_REGEX, RERUN_REGEX
+from pdf_builders.logParser import BIBLIOGRAPHY_PROGRAM, UNDEFINED_CITATION
+from pdf_builders.trace import wait_process
 from subprocess import Popen, PIPE, STDOUT, CalledProcessError
 if sys.version_info < (3,):
     from pipes import quote
@@ -36,10 +57,13 @@ else:
         old_env.update(new_env)
 
 
-FILE_NOT_FOUND_ERROR_REGEX = re.compile(
-    r"! LaTeX Error: File `(.*)/([^/']*)'", re.MULTILINE)
 
-TEXLIVEONFLY = os.path.normpath(os.path.dirname(os.path.abspath(__file__)) + os.pathsep + u'texliveonfly.py')
+# builder settings which only change what is displayed, never the result
+DISPLAY_SETTINGS = (
+    'display_log', 'display_bad_boxes', 'open_pdf_on_build', 'stream_output'
+)
+
+TEXLIVEONFLY = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), u'texliveonfly.py'))
 DEBUG = False
 
 
@@ -93,6 +117,12 @@ class PdfBuilder(object):
         else:
             self.output_callable = output
         self.out = ""
+        # events found in the output of the last command, see logParser
+        self.log_index = LogIndex()
+        self._streamed_index = None
+        # incremental parsers called with every line of output, see
+        # feed_output()
+        self.output_parsers = []
         self.engine = engine
         if options is None:
             self.options = []
@@ -104,6 +134,32 @@ class PdfBuilder(object):
         self.tex_directives = tex_directives
         self.builder_settings = builder_settings
         self.platform_settings = platform_settings
+        self._build_state = None
+        # files read when dumping the preamble format in use, see
+        # load_preamble_format()
+        self.format_inputs = []
+        # the \include'd files compiled by a draft build and the inputs of
+        # the parts left out, see include_changed_parts()
+        self.draft_parts = None
+        self.draft_inputs = []
+        # the scratch directory the build runs in and the directories it
+        # stands in for, see use_scratch_directory()
+        self.scratch = None
+        self._directories = None
+        # the process of the running command and whether the build was
+        # cancelled, see cancel()
+        self.process = None
+        self.cancelled = False
+        # pass the output of commands to output_callable while they run
+        self.stream_output = self.builder_settings.get('stream_output', False)
+        # attributing events to source files is only needed for display
+        self.track_log_files = self.builder_settings.get(
+            'display_bad_boxes', False)
+        # tools run between passes besides bibtex, see run_aux_tools()
+        self.aux_tools = configured_tools(
+            self.builder_settings.get('aux_tools'))
+        # exit status of the last run of every tool, see run_aux_tools()
+        self.aux_tool_returncodes = {}
 
         # if output_directory and aux_directory can be specified as a path
         # relative to self.tex_dir, we use that instead of the absolute path
@@ -131,12 +187,36 @@ class PdfBuilder(object):
         self.output_callable(data)
         # print(data)
 
+    # Receive one line of output of the running command
+    # The line is added to the log index and handed to all incremental
+    # parsers and, when streaming, to the output callable right away
+    # Usually no need to override
+    def feed_output(self, line):
+        if self._streamed_index is None:
+            self._streamed_index = LogIndex(self.track_log_files)
+        self._streamed_index.feed(line)
+        for parser in self.output_parsers:
+            parser(line)
+        if self.stream_output:
+            self.output_callable(line)
+
     # Save command output
+    # If the output was not streamed through feed_output(), it is indexed
+    # and passed to the incremental parsers here
     # Usually no need to override
     def set_output(self, out):
         if DEBUG:
             print("Setting out")
             print(out)
+        if self._streamed_index is not None:
+            self.log_index = self._streamed_index
+            self._streamed_index = None
+        else:
+            self.log_index = LogIndex.parse(out, self.track_log_files)
+            if self.output_parsers:
+                for line in out.splitlines():
+                    for parser in self.output_parsers:
+                        parser(line)
         self.out = out
 
     # This is where the real work is done. This generator must yield (cmd, msg) tuples,
@@ -158,8 +238,486 @@ class PdfBuilder(object):
     def cleantemps(self):
         return NotImplementedError()
 
+    # Directory holding the auxiliary files (.aux, .log, .fls, ...) of the
+    # job. Relative directories are resolved against the tex directory,
+    # which is where the engine is run from
+    def aux_path(self):
+        tex_dir = os.path.abspath(self.tex_dir)
+        directory = self.aux_directory_full or self.output_directory_full
+        if directory is None:
+            return tex_dir
+        return os.path.normpath(os.path.join(tex_dir, directory))
+
+    # Directory holding the final output of the job
+    def output_path(self):
+        tex_dir = os.path.abspath(self.tex_dir)
+        if self.output_directory_full is None:
+            return tex_dir
+        return os.path.normpath(
+            os.path.join(tex_dir, self.output_directory_full))
+
+    # Final products of the build; a build is never considered up to date
+    # if one of them is missing or was modified
+    # Override if the builder does not produce <job_name>.pdf in the output
+    # directory
+    def output_files(self):
+        return [os.path.join(self.output_path(), self.job_name + u'.pdf')]
+
+    # Persistent state of this job, see buildCache.BuildState
+    def build_state(self):
+        if self._build_state is None:
+            self._build_state = BuildState(
+                os.path.join(self.aux_path(), self.job_name + STATE_SUFFIX))
+        return self._build_state
+
+    # Everything besides the input files that influences the result of
+    # the build
+    def build_key(self):
+        return hash_value({
+            'builder': type(self).__name__,
+            'tex_root': os.path.abspath(self.tex_root),
+            'engine': self.engine,
+            'options': self.options,
+            'job_name': self.job_name,
+            'aux_directory': self.aux_directory,
+            'output_directory': self.output_directory,
+            'builder_settings': dict(
+                (k, v) for k, v in self.builder_settings.items()
+                if k not in DISPLAY_SETTINGS
+            )
+        })
+
+    # Digest of everything bibtex or biber would read for this job, see
+    # auxFiles.citation_fingerprint
+    def citation_fingerprint(self):
+        return citation_fingerprint(
+            self.aux_path(), os.path.abspath(self.tex_dir), self.job_name)
+
+    # Command running texliveonfly.py, which compiles the root file with
+    # the given engine command options and installs all missing packages
+    def texliveonfly_command(self, engine, options):
+        engine = {
+            "pdftex": u"pdflatex",
+            "xetex": u"xelatex",
+            "luatex": u"lualatex"
+        }.get(engine, engine)
+        return [sys.executable, TEXLIVEONFLY, u'-c', engine,
+                u'-a', u' '.join(quote(option) for option in options),
+                self.tex_name]
+
+    # Cached format of the preamble of the root file for engine, see
+    # formatCache.PreambleFormat
+    # Returns None unless the format cache is enabled and engine supported
+    def preamble_format(self, engine):
+        if (
+            not self.builder_settings.get('format_cache', False) or
+            engine not in FORMAT_ENGINES
+        ):
+            return None
+        cache = FileCache(
+            self.builder_settings.get('format_cache_directory') or
+            user_cache_directory(u'formats'),
+            self.builder_settings.get('format_cache_size', 512) * 1024 * 1024)
+        return PreambleFormat(
+            cache, engine, os.path.abspath(self.tex_dir), self.tex_name)
+
+    # Makes the latex command load the preamble from a cached format
+    # Yields the command dumping the format if it is not cached yet. A
+    # preamble which cannot be dumped is remembered and built without format
+    # Usage: for cmd in self.load_preamble_format(engine, latex): yield cmd
+    def load_preamble_format(self, engine, latex):
+        preamble_format = self.preamble_format(engine)
+        if preamble_format is None:
+            return
+        key = preamble_format.preamble_key()
+        fmt = preamble_format.lookup()
+        if fmt is None and key is not None and \
+                self.build_state().get('format_failed') != key:
+            yield (preamble_format.dump_command(),
+                   "dumping preamble format...")
+            fmt = preamble_format.store()
+            if fmt is None:
+                self.display("failed, building without format.\n")
+                self.build_state().set('format_failed', key)
+            else:
+                self.display("done.\n")
+        if fmt is not None:
+            # "&<format>" has to come first on the line TeX reads
+            latex.insert(-1, u'&' + fmt)
+            self.format_inputs = preamble_format.inputs
+
+    # Makes the build run in a scratch directory on a RAM-backed file
+    # system if the scratch_aux setting is on, see scratchDirectory: it is
+    # seeded from the aux directory, and the aux and output directories of
+    # the builder point to it until leave_scratch_directory()
+    # The build state stays in the aux directory
+    def use_scratch_directory(self):
+        if not self.builder_settings.get('scratch_aux', False) or \
+                self.scratch is not None:
+            return
+        state = self.build_state()
+        tex_dir = os.path.abspath(self.tex_dir)
+        self.scratch = ScratchDirectory(
+            scratch_path(self.builder_settings.get('scratch_root'),
+                         os.path.abspath(self.tex_root), self.job_name),
+            self.aux_path(), self.output_path(), self.job_name,
+            shared=self.aux_path() == tex_dir)
+        try:
+            state.set('scratch', self.scratch.seed(state.get('scratch') or {}))
+        except (IOError, OSError) as e:
+            self.display(u'Unable to seed scratch directory {0}: {1}\n'.format(
+                self.scratch.path, e))
+            self.scratch = None
+            return
+        self._directories = (
+            self.aux_directory, self.aux_directory_full,
+            self.output_directory, self.output_directory_full)
+        self.aux_directory = self.aux_directory_full = self.scratch.path
+        self.output_directory = self.output_directory_full = self.scratch.path
+
+    # Points the builder back to its aux and output directories, copying
+    # what the build changed in the scratch directory there if sync is True
+    def leave_scratch_directory(self, sync=True):
+        if self.scratch is None:
+            return
+        (self.aux_directory, self.aux_directory_full,
+         self.output_directory, self.output_directory_full) = self._directories
+        scratch, self.scratch = self.scratch, None
+        if sync:
+            state = self.build_state()
+            state.set('scratch', scratch.sync(state.get('scratch') or {}))
+
+    # Source file of an \include'd part
+    def part_path(self, part):
+        return os.path.normpath(
+            os.path.join(os.path.abspath(self.tex_dir), part + u'.tex'))
+
+    # Makes a draft build: if only some of the files \include'd by the
+    # root file changed since the last build, the latex command is made to
+    # compile just those by prepending \includeonly to the line TeX reads.
+    # The .aux files of the other parts are read as before, so numbering
+    # and cross-references stay in place
+    # Does nothing unless the draft_includeonly setting is on, or if
+    # anything besides the parts changed
+    def include_changed_parts(self, latex):
+        if not self.builder_settings.get('draft_includeonly', False):
+            return
+        state = self.build_state().get('includes')
+        parts = included_parts(self.aux_path(), self.job_name)
+        if (
+            not state or not parts or
+            sorted(parts) != sorted(state['parts']) or
+            not entries_unchanged(state['others'])
+        ):
+            return
+
+        changed = [
+            part for part in parts
+            if hash_file(self.part_path(part)) != state['parts'][part] or
+            not os.path.exists(os.path.join(self.aux_path(), part + u'.aux'))
+        ]
+        if not changed or len(changed) == len(parts):
+            return
+
+        self.draft_parts = changed
+        # the parts left out still decide whether the build is up to date
+        self.draft_inputs = list(state['others']) + [
+            self.part_path(part) for part in parts if part not in changed]
+        latex[-1] = u'\\includeonly{{{0}}}\\input{{{1}}}'.format(
+            u','.join(changed), latex[-1])
+        # the job would be named after the first file read otherwise
+        if not any(c.startswith(u'--jobname=') for c in latex):
+            latex.insert(-1, u'--jobname=' + self.job_name)
+        self.display(u'draft of {0}, '.format(u', '.join(changed)))
+
+    # Records the contents of the \include'd parts compiled by the build
+    # and of everything else it read, see include_changed_parts()
+    def record_parts(self):
+        if not self.builder_settings.get('draft_includeonly', False):
+            return
+        parts = included_parts(self.aux_path(), self.job_name)
+        if not parts:
+            self.build_state().set('includes', None)
+            return
+        state = self.build_state().get('includes') or {}
+        digests = {}
+        compiled = parts
+        if self.draft_parts is not None:
+            digests.update(state.get('parts') or {})
+            compiled = self.draft_parts
+        for part in compiled:
+            digests[part] = hash_file(self.part_path(part))
+
+        # the .aux files of the parts change whenever they are compiled
+        part_files = set()
+        for part in parts:
+            part_files.add(self.part_path(part))
+            part_files.add(os.path.join(self.aux_path(), part + u'.aux'))
+        self.build_state().set('includes', {
+            'parts': digests,
+            'others': file_entries(
+                [path for path in self.dependencies() if path not in part_files],
+                state.get('others'))
+        })
+
+    # Returns what to run for a pass of the latex command: a parked warm
+    # engine, see warmEngine.WarmEnginePool, if the warm_engines setting
+    # is on and one is available, or the command itself otherwise
+    # A replacement engine is started either way, while the pass runs
+    def engine_command(self, latex):
+        size = self.builder_settings.get('warm_engines', 0)
+        # a warm engine reads the root file itself, without anything
+        # prepended to the line TeX reads
+        if not size or latex[-1] != self.tex_name:
+            return latex
+        preamble = split_preamble(self.tex_root)
+        if preamble is None or re.search(r'\s', self.aux_path()):
+            return latex
+
+        # the engine writes to a scratch directory and reads the wrapper
+        # holding the preamble, so those options are replaced
+        command = [
+            c for c in latex[:-1] if not c.startswith((
+                u'&', u'-interaction=', u'--output-directory=',
+                u'--aux-directory=', u'--jobname='))
+        ]
+        command[1:1] = [u'-interaction=scrollmode',
+                        u'--jobname=' + self.job_name]
+        key = hash_value([command, os.path.abspath(self.tex_root), preamble])
+
+        tex_dir = os.path.abspath(self.tex_dir)
+
+        def spawn(command):
+            return external_command(
+                command, cwd=tex_dir, stdin=PIPE, stdout=PIPE, stderr=STDOUT,
+                preexec_fn=os.setsid if get_platform() != 'windows' else None)
+
+        pool = get_pool((self.tex_root, self.job_name), size)
+        engine = pool.acquire(key)
+        aux_path = self.aux_path()
+        make_dirs(aux_path)
+        # every file the last pass read before \begin{document} except
+        # the root file, whose preamble is part of the key, and files
+        # written by the build itself
+        root = os.path.abspath(self.tex_root)
+        inputs = preamble_inputs(
+            os.path.join(aux_path, self.job_name + u'.fls'), self.job_name)
+        pool.fill(key, preamble, command, spawn, aux_path, preamble_signatures(
+            path for path in inputs
+            if path != root and not self.generated_file(path)))
+        if engine is None:
+            return latex
+        engine.resume(self.tex_name, self.job_name, aux_path, self.output_path())
+        return engine
+
+    def build_manifest(self):
+        return BuildManifest(self.build_state(), self.build_key())
+
+    # Returns True if nothing the last successful build depended on has
+    # changed since, in which case no command needs to be run at all
+    def is_up_to_date(self):
+        if not self.builder_settings.get('build_cache', True):
+            return False
+        return self.build_manifest().is_up_to_date(self.output_files())
+
+    # Files read and generated by the last build, as reported by the
+    # -recorder .fls file of the engine
+    # Bibliography files and the files read with the preamble format are
+    # added explicitly since the engine does not record them
+    def recorded_files(self):
+        aux_path = self.aux_path()
+        inputs, outputs = parse_fls(
+            os.path.join(aux_path, self.job_name + u'.fls'))
+        if inputs:
+            inputs += bibliography_sources(
+                aux_path, os.path.abspath(self.tex_dir), self.job_name)
+            inputs += self.format_inputs
+            inputs += self.draft_inputs
+        return inputs, outputs
+
+    # Records the inputs of a successful build
+    def record_build(self):
+        self.record_parts()
+        if not self.builder_settings.get('build_cache', True):
+            return
+        inputs, outputs = self.recorded_files()
+        manifest = self.build_manifest()
+        if not inputs:
+            manifest.invalidate()
+            return
+        manifest.record(inputs, self.output_files(), generated=outputs)
+
+    # Source files whose modification calls for a new build
+    def dependencies(self):
+        inputs, outputs = self.recorded_files()
+        outputs = set(outputs)
+        dependencies = [os.path.abspath(self.tex_root)]
+        dependencies.extend(path for path in inputs if path not in outputs and
+                            not self.generated_file(path))
+        return dependencies
+
+    # Whether path, a file read by the build, is written by the build
+    # itself rather than by the engine during the last pass: files of the
+    # aux and output directories named after the job (e.g. the .bbl), those
+    # produced by the auxiliary tools and the .aux files of parts
+    def generated_file(self, path):
+        path = os.path.normpath(path)
+        produces = set(BIBLIOGRAPHY_PRODUCES)
+        for tool in self.aux_tools:
+            produces.update(tool.produces)
+        for directory in (self.aux_path(), self.output_path()):
+            if not path.startswith(directory + os.sep):
+                continue
+            name = path[len(directory) + 1:]
+            if name.startswith(self.job_name + u'.') and \
+                    not name.endswith(SOURCE_EXTENSIONS):
+                return True
+            if name.endswith(u'.aux') or any(
+                    name == self.job_name + suffix for suffix in produces):
+                return True
+        return False
+
+    # Runs the auxiliary tools (see auxTools) whose inputs changed since
+    # they last ran, together with extra, a list of (name, start) for the
+    # bibliography programs, where start() returns the started process.
+    # Tools which do not depend on each other run at the same time.
+    # Generator of commands like commands()
+    def run_aux_tools(self, extra=()):
+        aux_path = self.aux_path()
+        starters = dict(extra)
+        tools = [AuxTool(name, [], BIBLIOGRAPHY_CONSUMES, BIBLIOGRAPHY_PRODUCES)
+                 for name, _ in extra]
+        tools.extend(self.aux_tools)
+        state = self.build_state().get('aux_tools') or {}
+        path = get_texpath() or os.environ['PATH']
+
+        for layer in plan(tools):
+            runs = []
+            for tool in layer:
+                if tool.name in starters:
+                    runs.append((tool, None, starters[tool.name]))
+                    continue
+                # the inputs of later layers may have just been produced
+                fingerprint = tool.fingerprint(aux_path, self.job_name)
+                if fingerprint is None or (
+                        fingerprint == state.get(tool.name) and
+                        tool.outputs_exist(aux_path, self.job_name)):
+                    continue
+                command = tool.job_command(self.job_name)
+                if which(command[0], path=path) is None:
+                    self.display(u'{0} not found, skipping {1}.\n'.format(
+                        command[0], tool.name))
+                    continue
+                runs.append((tool, fingerprint,
+                             partial(start_command, command, aux_path)))
+            if not runs:
+                continue
+
+            processes = [start() for _, _, start in runs]
+            yield (
+                processes[0] if len(processes) == 1 else ConcurrentProcesses(processes),
+                u'running {0}...'.format(u', '.join(tool.name for tool, _, _ in runs))
+            )
+            self.display('done.\n')
+            for (tool, fingerprint, _), process in zip(runs, processes):
+                self.aux_tool_returncodes[tool.name] = process.returncode
+                if fingerprint is not None and process.returncode == 0:
+                    state[tool.name] = fingerprint
+            self.build_state().set('aux_tools', state)
+
+    # Runs bibtex or biber if citations are undefined or what they read
+    # changed, along with the other auxiliary tools, see run_aux_tools()
+    # biber is the command running biber; the builder provides bibtex,
+    # run_bibtex() and log_output()
+    # Usage: for cmd in self.run_bibliography(biber): yield cmd
+    def run_bibliography(self, biber):
+        # Check for citations
+        run_bibtex = False
+        use_bibtex = True
+        bibtex = None
+        # this includes natbib's summary warning
+        if self.log_index.has(UNDEFINED_CITATION):
+            run_bibtex = True
+            # are we using biblatex?
+            event = self.log_index.first(BIBLIOGRAPHY_PROGRAM)
+            if event is not None:
+                bibtex = event.data
+                if bibtex == 'biber':
+                    use_bibtex = False
+
+        # Compare what bibtex / biber would read with what they read when
+        # the existing .bbl was generated: an unchanged fingerprint means
+        # the .bbl can be reused, a changed one means it is stale even if
+        # no citation is undefined (e.g. an edited .bib entry)
+        bib_fingerprint = self.citation_fingerprint()
+        bib_state = self.build_state().get('bibliography') or {}
+        if bib_fingerprint is not None:
+            if bib_fingerprint == bib_state.get('fingerprint'):
+                if run_bibtex and os.path.exists(
+                        os.path.join(self.aux_path(), self.job_name + u'.bbl')):
+                    self.display('bibliography is up to date.\n')
+                    run_bibtex = False
+            elif not run_bibtex and bib_state.get('program'):
+                run_bibtex = True
+                bibtex = bib_state['program']
+                use_bibtex = bibtex != 'biber'
+
+        # bibtex / biber run along with the other auxiliary tools
+        bibliography = []
+        if run_bibtex:
+            if use_bibtex:
+                bibliography.append(
+                    (bibtex or 'bibtex', partial(self.run_bibtex, bibtex)))
+            else:
+                bibliography.append(('biber', partial(
+                    start_command, biber + [self.job_name], self.tex_dir)))
+        for cmd in self.run_aux_tools(bibliography):
+            yield cmd
+
+        if run_bibtex:
+            self.log_output()
+
+            # bibtex exits with 1 if it only warned, biber with 0; the
+            # fingerprint of a failed run would make the next build reuse
+            # the .bbl it left behind
+            returncode = self.aux_tool_returncodes.get(bibliography[0][0])
+            if bib_fingerprint is not None and returncode is not None and \
+                    0 <= returncode <= (1 if use_bibtex else 0):
+                self.build_state().set('bibliography', {
+                    'fingerprint': bib_fingerprint,
+                    'program': bibtex or self.bibtex if use_bibtex else 'biber'
+                })
+
+    # Stops the build: the running command is killed and no further
+    # command is run. May be called from any thread
+    def cancel(self):
+        self.cancelled = True
+        process = self.process
+        if process is not None:
+            kill_process(process)
+
 
 # utilities
+def kill_process(process):
+    '''
+    Kills process, a Popen-like object started by external_command(),
+    unless it already finished
+    '''
+    if process.poll() is not None:
+        return
+    try:
+        # commands run in their own session, which also holds the
+        # processes they started, e.g. the engine run by texliveonfly
+        if get_platform() == 'windows' or not process.pid:
+            raise OSError()
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        try:
+            process.kill()
+        except OSError:
+            pass
+
+
 def get_texpath():
     """
     Returns the default texpath
@@ -261,10 +819,268 @@ def external_command(command, cwd=None, shell=False, env=None,
     return p
 
 
+# ----------------------------------------------------------------
+# ProcessPipeline class
+#
+# Popen-like object for processes connected like a shell pipeline, the
+# stdout of each one feeding the stdin of the next. stdout is the output
+# of the last process; the stderr of all others is collected in stderr.
+#
+class ProcessPipeline(object):
+
+    def __init__(self, processes, stderr):
+        self.processes = processes
+        self.args = getattr(processes[0], 'args', None)
+        # all processes are in the process group of the first one
+        self.pid = processes[0].pid
+        self.stdout = processes[-1].stdout
+        self.stderr = stderr
+        self.returncode = None
+
+    def _finish(self):
+        # the first failure is the cause of any later one
+        codes = [process.returncode for process in self.processes]
+        self.returncode = next((code for code in codes if code), 0)
+        usages = [getattr(process, 'rusage', None) for process in self.processes]
+        if None not in usages:
+            self.rusage = CombinedUsage(usages)
+
+    def poll(self):
+        if self.returncode is None and all(
+                process.poll() is not None for process in self.processes):
+            self._finish()
+        return self.returncode
+
+    def wait(self):
+        if self.returncode is None:
+            for process in self.processes:
+                wait_process(process)
+            self._finish()
+        return self.returncode
+
+    def communicate(self, input=None):
+        stderr_data = []
+        reader = threading.Thread(
+            target=lambda: stderr_data.append(self.stderr.read()))
+        reader.daemon = True
+        reader.start()
+        stdout = self.stdout.read()
+        self.stdout.close()
+        reader.join()
+        self.stderr.close()
+        self.wait()
+        return stdout, stderr_data[0] if stderr_data else None
+
+    def kill(self):
+        for process in self.processes:
+            try:
+                process.kill()
+            except OSError:
+                pass
+
+
+# Resource usage of processes which run concurrently, so the sum of their
+# peak memory is an upper bound of their joint peak
+class CombinedUsage(object):
+
+    def __init__(self, usages):
+        self.ru_utime = sum(usage.ru_utime for usage in usages)
+        self.ru_stime = sum(usage.ru_stime for usage in usages)
+        self.ru_maxrss = sum(usage.ru_maxrss for usage in usages)
+
+
+# ----------------------------------------------------------------
+# ConcurrentProcesses class
+#
+# Popen-like object for independent processes running at the same time,
+# such as bibtex and makeindex. Their output is read concurrently and
+# joined in order; each keeps its own returncode.
+#
+# Instead of a process, a function starting one may be given, which is
+# called once fewer than jobs processes are running.
+#
+class ConcurrentProcesses(object):
+
+    def __init__(self, processes, jobs=None):
+        self.processes = list(processes)
+        self._slots = threading.Semaphore(jobs or len(self.processes))
+        self._killed = False
+        # the processes run in sessions of their own, see kill()
+        self.pid = None
+        self.stdout = None
+        self.stderr = None
+        self.returncode = None
+        self._outputs = None
+
+    @property
+    def args(self):
+        return getattr(self.processes[0], 'args', None)
+
+    def _finish(self):
+        # processes never started because of kill() count as failed
+        codes = [getattr(process, 'returncode', 1) for process in self.processes]
+        self.returncode = next((code for code in codes if code), 0)
+        usages = [getattr(process, 'rusage', None) for process in self.processes]
+        if None not in usages:
+            self.rusage = CombinedUsage(usages)
+
+    def poll(self):
+        if self.returncode is None and all(
+                hasattr(process, 'poll') and process.poll() is not None
+                for process in self.processes):
+            self._finish()
+        return self.returncode
+
+    def wait(self):
+        self.communicate()
+        return self.returncode
+
+    def communicate(self, input=None):
+        if self._outputs is None:
+            outputs = [None] * len(self.processes)
+
+            def read(index):
+                with self._slots:
+                    if self._killed:
+                        return
+                    if not hasattr(self.processes[index], 'communicate'):
+                        self.processes[index] = self.processes[index]()
+                        # in case kill() ran while it was started
+                        if self._killed:
+                            kill_process(self.processes[index])
+                    outputs[index] = communicate(
+                        self.processes[index], lambda line: None)
+
+            readers = [
+                threading.Thread(target=read, args=(index,))
+                for index in range(len(self.processes))
+            ]
+            for reader in readers:
+                reader.daemon = True
+                reader.start()
+            for reader in readers:
+                reader.join()
+            self._outputs = outputs
+            self._finish()
+        stdout = u'\n'.join(out[0] for out in self._outputs if out and out[0])
+        stderr = u'\n'.join(out[1] for out in self._outputs if out and out[1])
+        return stdout.encode('utf-8'), stderr.encode('utf-8')
+
+    def kill(self):
+        self._killed = True
+        for process in self.processes:
+            if hasattr(process, 'communicate'):
+                kill_process(process)
+
+
+def start_command(command, cwd, env=None):
+    '''
+    Starts a command yielded by a builder as a list, in a session of its
+    own so that it can be killed with everything it started
+    '''
+    return external_command(
+        command, cwd=cwd, env=env, stdout=PIPE, stderr=STDOUT,
+        preexec_fn=os.setsid if get_platform() != 'windows' else None)
+
+
+def external_pipeline(commands, cwd=None, env=None, use_texpath=True):
+    '''
+    Starts commands, a list of commands as taken by external_command, with
+    the stdout of each one piped into the stdin of the next.
+    Returns a ProcessPipeline. The pipeline runs in a process group of its
+    own, like the sessions of the commands started by build.run(), so it
+    can be killed as a whole. Raises OSError if a command is not found
+    '''
+    posix = get_platform() != 'windows'
+    stderr_read, stderr_write = os.pipe()
+    processes = []
+    try:
+        for index, command in enumerate(commands):
+            last = index == len(commands) - 1
+            if not posix:
+                preexec_fn = None
+            elif index == 0:
+                # not a new session, which the other processes could not join
+                preexec_fn = lambda: os.setpgid(0, 0)
+            else:
+                leader = processes[0].pid
+                preexec_fn = lambda: os.setpgid(0, leader)
+            processes.append(external_command(
+                command, cwd=cwd, env=env, use_texpath=use_texpath,
+                stdin=processes[-1].stdout if processes else None,
+                stdout=PIPE, stderr=STDOUT if last else stderr_write,
+                preexec_fn=preexec_fn))
+            if index > 0:
+                # only the next process may read it, so that the previous
+                # one sees a broken pipe if it exits early
+                processes[-2].stdout.close()
+    except OSError:
+        for process in processes:
+            process.kill()
+            process.wait()
+        os.close(stderr_read)
+        raise
+    finally:
+        os.close(stderr_write)
+
+    return ProcessPipeline(processes, os.fdopen(stderr_read, 'rb'))
+
+
+def convert_stream(stream):
+    if stream is None:
+        return u''
+    else:
+        return u'\n'.join(
+            re.split(r'\r?\n', stream.decode('utf-8', 'ignore').rstrip())
+        )
+
+
+def communicate(process, line_callback=None):
+    '''
+    Waits for process to finish, like Popen.communicate().
+    If line_callback is given, stdout is consumed line by line as it is
+    produced and every decoded line (without its line ending) is passed to
+    line_callback before the next one is read. The process is then reaped
+    by wait_process(), which records its resource usage as process.rusage.
+    Returns a tuple consisting of the decoded
+        (stdout, stderr)
+    '''
+    if line_callback is None or process.stdout is None:
+        stdout, stderr = process.communicate()
+        return convert_stream(stdout), convert_stream(stderr)
+
+    # drain a separate stderr pipe concurrently so neither pipe can fill up
+    stderr_data = []
+    reader = None
+    if process.stderr is not None:
+        reader = threading.Thread(
+            target=lambda: stderr_data.append(process.stderr.read()))
+        reader.daemon = True
+        reader.start()
+
+    lines = []
+    for line in iter(process.stdout.readline, b''):
+        line = line.decode('utf-8', 'ignore').rstrip(u'\r\n')
+        lines.append(line)
+        line_callback(line)
+    process.stdout.close()
+
+    if reader is not None:
+        reader.join()
+        process.stderr.close()
+    wait_process(process)
+
+    return (
+        u'\n'.join(lines).rstrip(),
+        convert_stream(stderr_data[0] if stderr_data else None)
+    )
+
+
 def execute_command(command, cwd=None, shell=False, env=None,
                     stdin=__sentinel__, stdout=__sentinel__,
                     stderr=__sentinel__, preexec_fn=None,
-                    use_texpath=True, show_window=False):
+                    use_texpath=True, show_window=False,
+                    line_callback=None):
     '''
     Takes a command to be passed to subprocess.Popen and runs it. This is
     similar to subprocess.call().
@@ -273,16 +1089,10 @@ def execute_command(command, cwd=None, shell=False, env=None,
     By default stderr is redirected to stdout, so stderr will normally be
     blank. This can be changed by calling execute_command with stderr set
     to subprocess.PIPE or any other valid value.
+    If line_callback is given, the output is streamed to it line by line
+    while the command runs, see communicate()
     Raises OSError if the executable is not found
     '''
-    def convert_stream(stream):
-        if stream is None:
-            return u''
-        else:
-            return u'\n'.join(
-                re.split(r'\r?\n', stream.decode('utf-8', 'ignore').rstrip())
-            )
-
     if stdout is __sentinel__:
         stdout = PIPE
 
@@ -302,11 +1112,11 @@ def execute_command(command, cwd=None, shell=False, env=None,
         show_window=show_window
     )
 
-    stdout, stderr = p.communicate()
+    stdout, stderr = communicate(p, line_callback)
     return (
         p.returncode,
-        convert_stream(stdout),
-        convert_stream(stderr)
+        stdout,
+        stderr
     )
 
 
@@ -352,13 +1162,15 @@ def check_call(command, cwd=None, shell=False, env=None,
 def check_output(command, cwd=None, shell=False, env=None,
                  stdin=__sentinel__, stderr=__sentinel__,
                  preexec_fn=None, use_texpath=True,
-                 show_window=False):
+                 show_window=False, line_callback=None):
     """
     Takes a command to be passed to subprocess.Popen.
     Returns the output if the command was successful.
     By default stderr is redirected to stdout, so this will return any output
     to either stream. This can be changed by calling execute_command with
     stderr set to subprocess.PIPE or any other valid value.
+    If line_callback is given, the output is also streamed to it line by
+    line while the command runs.
     Raises CalledProcessError if the command returned a non-zero value
     Raises OSError if the executable is not found
     This is pretty much identical to subprocess.check_output(), but
@@ -373,7 +1185,8 @@ def check_output(command, cwd=None, shell=False, env=None,
         stderr=stderr,
         preexec_fn=preexec_fn,
         use_texpath=use_texpath,
-        show_window=show_window
+        show_window=show_window,
+        line_callback=line_callback
     )
 
     if returncode:
@@ -386,3 +1199,26 @@ def check_output(command, cwd=None, shell=False, env=None,
         raise e
 
     return stdout
+
+
+def check_process(process, line_callback=None):
+    """
+    Takes a process started by external_command, such as the one returned
+    by a builder's run_bibtex(), and waits for it to finish.
+    Returns its output if the process was successful.
+    If line_callback is given, the output is also streamed to it line by
+    line while the process runs.
+    Raises CalledProcessError if the process returned a non-zero value
+    """
+    stdout, stderr = communicate(process, line_callback)
+
+    if process.returncode:
+        e = CalledProcessError(
+            process.returncode,
+            getattr(process, 'args', None)
+        )
+        e.output = stdout
+        e.stderr = stderr
+        raise e
+
+    return stdout
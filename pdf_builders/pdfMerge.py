@@ -0,0 +1,173 @@
+# Merges the PDFs of a sharded build, see shardBuild
+#
+# Needs pypdf, which is optional: merge_available() is False without it,
+# in which case documents are not built in shards.
+from pdf_builders.buildCache import replace_file
+try:
+    from pypdf import PdfReader, PdfWriter
+    from pypdf.generic import ArrayObject, DictionaryObject, Fit, NameObject
+    from pypdf.generic import NumberObject, TextStringObject
+    from pypdf.errors import PyPdfError
+except ImportError:
+    PdfReader = PdfWriter = None
+    PyPdfError = ValueError
+
+# Raised by merge() for missing or broken PDFs
+MERGE_ERRORS = (IOError, OSError, ValueError, KeyError, PyPdfError)
+
+
+def merge_available():
+    return PdfReader is not None
+
+
+def page_labels(reader):
+    '''
+    Returns the page label ranges of reader as a sorted list of
+    (first page index, label dictionary)
+    '''
+    root = reader.trailer['/Root']
+    if '/PageLabels' not in root:
+        return []
+    ranges = []
+    pending = [root['/PageLabels'].get_object()]
+    while pending:
+        node = pending.pop()
+        nums = node.get('/Nums', [])
+        for i in range(0, len(nums) - 1, 2):
+            ranges.append((int(nums[i]), nums[i + 1].get_object()))
+        pending.extend(kid.get_object() for kid in node.get('/Kids', []))
+    return sorted(ranges, key=lambda r: r[0])
+
+
+def label_at(ranges, index):
+    '''
+    Returns the label dictionary of page index, with the start number
+    adjusted as if a range started at the page, or None if unlabeled
+    '''
+    found = None
+    for start, label in ranges:
+        if start > index:
+            break
+        found = (start, label)
+    if found is None:
+        return None
+    start, label = found
+    result = DictionaryObject()
+    for key in ('/S', '/P'):
+        if key in label:
+            result[NameObject(key)] = label[key]
+    result[NameObject('/St')] = NumberObject(
+        int(label.get('/St', 1)) + index - start)
+    return result
+
+
+def outline_items(node):
+    '''
+    Yields (title, destination, children) for the outline items below node
+    '''
+    item = node.get('/First')
+    while item is not None:
+        item = item.get_object()
+        destination = item.get('/Dest')
+        if destination is None and '/A' in item:
+            destination = item['/A'].get_object().get('/D')
+        yield item.get('/Title', u''), destination, item
+        item = item.get('/Next')
+
+
+def merge(frame, parts, output):
+    '''
+    Merges the PDF of the frame of a sharded build, i.e. everything but
+    the \\include'd parts, with the PDFs of the parts, and writes it to
+    output.
+    parts is a list of (position, path, first, end) in document order: the
+    pages first to end (excluded) of the PDF at path are inserted before
+    page position of the frame.
+    Named destinations, and thereby links, as well as the outline and the
+    page labels of the frame are carried over
+    '''
+    frame = PdfReader(frame)
+    segments = []
+    cursor = 0
+    for position, path, first, end in parts:
+        segments.append((frame, cursor, position))
+        segments.append((PdfReader(path), first, end))
+        cursor = position
+    segments.append((frame, cursor, len(frame.pages)))
+
+    writer = PdfWriter()
+    # (reader, page index) of every page copied, by index in the output
+    sources = []
+    index_of = {}
+    for reader, first, end in segments:
+        for index in range(first, end):
+            index_of[(id(reader), index)] = len(sources)
+            sources.append((reader, index))
+            writer.add_page(reader.pages[index])
+
+    # every destination is taken from the PDF its page was copied from
+    destinations = {}
+    readers = []
+    for reader, _, _ in segments:
+        if reader not in readers:
+            readers.append(reader)
+    for reader in readers:
+        for name, destination in reader.named_destinations.items():
+            index = index_of.get(
+                (id(reader), reader.get_destination_page_number(destination)))
+            if index is None or name in destinations:
+                continue
+            array = destination.dest_array
+            destinations[name] = (index, array)
+            writer.add_named_destination_array(
+                TextStringObject(name),
+                ArrayObject([writer.pages[index].indirect_reference] + list(array[1:])))
+
+    labels = dict((id(reader), page_labels(reader)) for reader in readers)
+    if any(labels.values()):
+        nums = ArrayObject()
+        previous = None
+        for index, (reader, source) in enumerate(sources):
+            ranges = labels[id(reader)]
+            if (
+                previous != (id(reader), source - 1) or
+                any(start == source for start, _ in ranges)
+            ):
+                label = label_at(ranges, source)
+                if label is not None:
+                    nums.extend([NumberObject(index), label])
+            previous = (id(reader), source)
+        writer._root_object[NameObject('/PageLabels')] = DictionaryObject(
+            {NameObject('/Nums'): nums})
+
+    frame_pages = dict(
+        (page.indirect_reference.idnum, index)
+        for index, page in enumerate(frame.pages))
+
+    def copy_outline(node, parent):
+        for title, destination, item in outline_items(node):
+            index, array = None, None
+            if isinstance(destination, (str, bytes)):
+                name = destination.decode('latin-1') if isinstance(
+                    destination, bytes) else destination
+                index, array = destinations.get(name, (None, None))
+            elif destination is not None:
+                array = destination.get_object()
+                index = index_of.get(
+                    (id(frame), frame_pages.get(array[0].idnum)))
+            if index is None:
+                continue
+            fit = Fit(array[1], tuple(array[2:])) if len(array) > 1 else Fit.fit()
+            added = writer.add_outline_item(
+                title, index, parent=parent, fit=fit,
+                is_open=int(item.get('/Count', 0)) > 0)
+            copy_outline(item, added)
+
+    if '/Outlines' in frame.trailer['/Root']:
+        copy_outline(frame.trailer['/Root']['/Outlines'].get_object(), None)
+
+    tmp_path = output + u'.tmp'
+    with open(tmp_path, 'wb') as f:
+        writer.write(f)
+    replace_file(tmp_path, output)
+    return len(sources)
@@ -0,0 +1,211 @@
+# Scratch directory on a RAM-backed file system for the auxiliary files of
+# a job, for projects on slow file systems such as network mounts.
+#
+# All passes of a build read and write the scratch directory only. It is
+# seeded from the aux directory of the project, which holds the files of
+# the last build, and once the build completes the files it changed are
+# copied back, each replaced by an atomic rename. What was copied in either
+# direction is recorded in the build state as
+# {relative path: [signature in the aux directory, signature in the
+# scratch directory, digest]}, so files which did not change are copied
+# neither way.
+import os
+import shutil
+import tempfile
+from pdf_builders.buildCache import SOURCE_EXTENSIONS, STATE_SUFFIX
+from pdf_builders.buildCache import file_signature, hash_file, hash_value, replace_file
+from pdf_builders.auxFiles import included_parts
+from pdf_builders.system import make_dirs
+
+# Intermediate files nothing reads after the build
+SCRATCH_EXTENSIONS = (u'.dvi', u'.ps', u'.tmp')
+# Directories of sharded builds, see shardBuild
+SCRATCH_DIRECTORY_SUFFIXES = (u'.shards',)
+
+
+def scratch_root():
+    '''
+    Returns the RAM-backed directory scratch directories are made in by
+    default, or the temporary directory if there is none
+    '''
+    if os.path.isdir(u'/dev/shm'):
+        return u'/dev/shm'
+    return tempfile.gettempdir()
+
+
+def scratch_path(root, tex_root, job_name):
+    '''
+    Returns the scratch directory of the job of tex_root below root, which
+    defaults to scratch_root()
+    '''
+    user = str(os.getuid()) if hasattr(os, 'getuid') else os.environ.get(
+        'USERNAME', u'user')
+    return os.path.join(root or scratch_root(), u'pdfbuilder-' + user,
+                        hash_value([tex_root, job_name])[:16])
+
+
+def list_files(directory, names=None):
+    '''
+    Returns the paths of the files below directory relative to it, or of
+    those directly in it for which names(name) is True
+    '''
+    files = []
+    if names is not None:
+        try:
+            entries = os.listdir(directory)
+        except OSError:
+            return files
+        return [name for name in entries if names(name) and
+                os.path.isfile(os.path.join(directory, name))]
+    for parent, directories, entries in os.walk(directory):
+        directories[:] = [name for name in directories
+                          if not name.endswith(SCRATCH_DIRECTORY_SUFFIXES)]
+        for name in entries:
+            files.append(os.path.relpath(os.path.join(parent, name), directory))
+    return files
+
+
+def list_directories(directory):
+    '''
+    Returns the paths of the directories below directory relative to it,
+    leaving out hidden ones
+    '''
+    found = []
+    for parent, directories, _ in os.walk(directory):
+        directories[:] = [name for name in directories if not (
+            name.startswith(u'.') or name.endswith(SCRATCH_DIRECTORY_SUFFIXES))]
+        for name in directories:
+            found.append(os.path.relpath(os.path.join(parent, name), directory))
+    return found
+
+
+# ----------------------------------------------------------------
+# ScratchDirectory class
+#
+# The scratch directory at path standing in for the aux directory aux_path
+# and the output directory output_path of a job. The final products of the
+# job are copied back to output_path, everything else to aux_path.
+# If the aux directory is the directory of the sources, only the files of
+# the job and the .aux files of its \include'd parts are seeded, and the
+# subdirectories are mirrored so that the engine can write the .aux files
+# of parts in them.
+#
+class ScratchDirectory(object):
+
+    def __init__(self, path, aux_path, output_path, job_name, shared=False):
+        self.path = path
+        self.aux_path = aux_path
+        self.output_path = output_path
+        self.job_name = job_name
+        self.shared = shared
+        self.final = [job_name + ext for ext in (
+            u'.pdf', u'.synctex.gz', u'.synctex')]
+
+    def real_path(self, name):
+        if name in self.final:
+            return os.path.join(self.output_path, name)
+        return os.path.join(self.aux_path, name)
+
+    def _persisted(self, name):
+        return not (
+            name in self.final or name.endswith(SCRATCH_EXTENSIONS) or
+            name == self.job_name + STATE_SUFFIX
+        )
+
+    def _job_file(self, name):
+        return self._persisted(name) and \
+            name.startswith(self.job_name + u'.') and \
+            not name.endswith(SOURCE_EXTENSIONS)
+
+    def _shared_files(self):
+        '''
+        Returns the files of the job in the directory of the sources
+        '''
+        names = list_files(self.aux_path, self._job_file)
+        for part in included_parts(self.aux_path, self.job_name):
+            name = os.path.normpath(part + u'.aux')
+            if os.path.isfile(os.path.join(self.aux_path, name)) and \
+                    name not in names:
+                names.append(name)
+        return names
+
+    def seed(self, records):
+        '''
+        Makes the scratch directory hold the files of the aux directory.
+        Returns the updated records
+        '''
+        make_dirs(self.path)
+        if self.shared:
+            names = self._shared_files()
+            for directory in list_directories(self.aux_path):
+                make_dirs(os.path.join(self.path, directory))
+        else:
+            names = [name for name in list_files(self.aux_path)
+                     if self._persisted(name)]
+        records = dict(records)
+        for name in names:
+            real = os.path.join(self.aux_path, name)
+            scratch = os.path.join(self.path, name)
+            record = records.get(name)
+            if record is not None and record[0] == file_signature(real) and \
+                    record[1] == file_signature(scratch):
+                continue
+            make_dirs(os.path.dirname(scratch))
+            shutil.copy2(real, scratch)
+            records[name] = [file_signature(real), file_signature(scratch),
+                             hash_file(scratch)]
+
+        # e.g. files of a cancelled build or removed from the aux directory
+        names = set(names)
+        for name in list_files(self.path):
+            if name not in names:
+                os.remove(os.path.join(self.path, name))
+                records.pop(name, None)
+        return records
+
+    def _rewrite_fls(self, path):
+        '''
+        Replaces the paths in the scratch directory in the .fls file at
+        path with those the files are copied to
+        '''
+        prefix = self.path + os.sep
+        with open(path, 'rb') as f:
+            lines = f.read().decode('utf-8', 'ignore').splitlines()
+        rewritten = []
+        for line in lines:
+            kind, _, name = line.partition(u' ')
+            if kind != u'PWD' and name.startswith(prefix):
+                line = u'{0} {1}'.format(
+                    kind, self.real_path(name[len(prefix):]))
+            rewritten.append(line + u'\n')
+        with open(path, 'wb') as f:
+            f.write(u''.join(rewritten).encode('utf-8'))
+
+    def sync(self, records):
+        '''
+        Copies the files the build changed in the scratch directory back.
+        Returns the updated records
+        '''
+        records = dict(records)
+        for name in list_files(self.path):
+            if name.endswith(SCRATCH_EXTENSIONS):
+                continue
+            scratch = os.path.join(self.path, name)
+            record = records.get(name)
+            if record is not None and record[1] == file_signature(scratch):
+                continue
+            if name.endswith(u'.fls'):
+                self._rewrite_fls(scratch)
+            digest = hash_file(scratch)
+            real = self.real_path(name)
+            if record is not None and record[2] == digest and \
+                    record[0] == file_signature(real):
+                # rewritten with the same contents
+                records[name] = [record[0], file_signature(scratch), digest]
+                continue
+            make_dirs(os.path.dirname(real))
+            tmp_path = real + u'.tmp'
+            shutil.copy2(scratch, tmp_path)
+            replace_file(tmp_path, real)
+            records[name] = [file_signature(real), file_signature(scratch), digest]
+        return records
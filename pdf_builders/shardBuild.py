@@ -0,0 +1,209 @@
+# Sharded builds of documents made of \include'd parts.
+#
+# Every part is compiled by a job of its own with \includeonly, and the
+# frame, i.e. everything but the parts, by another one. Each job runs in a
+# shard directory seeded with the .aux files of the last pass, so page
+# numbers and references are those of the whole document. Hooks given on
+# the command line print how many pages were shipped out before and after
+# every part, which is where its pages are found in the PDF of its job and
+# inserted in the PDF of the frame, see pdfMerge.
+#
+# Files written by the engine in document order, such as the .out file of
+# hyperref, are merged from the frame and the parts. Files which do not
+# merge, e.g. the .toc written from the .aux files of all parts, are
+# taken from the frame; any difference this makes shows in the next round.
+import os
+import re
+import shutil
+from pdf_builders.auxFiles import RERUN_EXTENSIONS
+from pdf_builders.system import make_dirs
+
+MARKER = u'PDFBUILDER-SHARD'
+MARKER_REGEX = re.compile(MARKER + r' (\S+) (\d+)')
+# The page counter at the end of a part, as saved in its .aux file
+PAGE_CHECKPOINT_REGEX = re.compile(br'^\\setcounter\{page\}\{(-?\d+)\}', re.M)
+
+# Files of a job which are not merged after a round
+UNMERGED_EXTENSIONS = (
+    u'.log', u'.pdf', u'.fls', u'.synctex', u'.synctex.gz', u'.fmt'
+)
+
+
+def typeout_hook(hook, key):
+    return (u'\\AddToHook{{{0}}}{{\\typeout{{{1} {2} '
+            u'\\the\\ReadonlyShipoutCounter}}}}').format(hook, MARKER, key)
+
+
+def shard_line(tex_name, parts, part=None):
+    '''
+    Returns the line TeX reads first for the job compiling part, or the
+    frame if part is None. The hooks print the number of pages shipped out
+    where the parts start and end, see read_markers()
+    '''
+    if part is None:
+        hooks = [typeout_hook(u'include/excluded/' + name, index)
+                 for index, name in enumerate(parts)]
+        only = u''
+    else:
+        hooks = [typeout_hook(u'include/before/' + part, u'first'),
+                 typeout_hook(u'include/after/' + part, u'end')]
+        only = part
+    return u''.join(hooks) + u'\\includeonly{{{0}}}\\input{{{1}}}'.format(
+        only, tex_name)
+
+
+def read_markers(log_path):
+    '''
+    Returns the page counts printed by the hooks of shard_line() in the log
+    file of a job, by key
+    '''
+    markers = {}
+    try:
+        with open(log_path, 'rb') as f:
+            lines = f.read().decode('utf-8', 'ignore').splitlines()
+    except (IOError, OSError):
+        return markers
+    for line in lines:
+        m = MARKER_REGEX.search(line)
+        if m:
+            markers[m.group(1)] = int(m.group(2))
+    return markers
+
+
+def write_if_changed(path, data):
+    '''
+    Writes data to path unless the file already has these contents, which
+    keeps the modification time of unchanged files
+    '''
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                return
+    except (IOError, OSError):
+        pass
+    make_dirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def seed(aux_path, directory, job_name, parts):
+    '''
+    Copies the files read back by the engine from aux_path to a shard
+    directory, replacing whatever an earlier round left there
+    '''
+    remove(directory)
+    make_dirs(directory)
+    names = [job_name + ext for ext in RERUN_EXTENSIONS]
+    names.extend(part + u'.aux' for part in parts)
+    for name in names:
+        src = os.path.join(aux_path, name)
+        if os.path.isfile(src):
+            with open(src, 'rb') as f:
+                write_if_changed(os.path.join(directory, name), f.read())
+
+
+def merge_lines(frame, parts):
+    '''
+    Merges the lines of a file written by the frame with the versions of
+    the same file written by the parts, each of which holds the lines of
+    the frame with those of the part inserted where it is included.
+    Returns the lines of the frame if a version of a part does not look
+    like that
+    '''
+    inserts = []
+    for order, lines in enumerate(parts):
+        start = 0
+        while start < min(len(frame), len(lines)) and frame[start] == lines[start]:
+            start += 1
+        end = len(lines) - (len(frame) - start)
+        if end < start or lines[end:] != frame[start:]:
+            return frame
+        inserts.append((start, order, lines[start:end]))
+
+    merged = []
+    cursor = 0
+    for start, _, lines in sorted(inserts):
+        merged.extend(frame[cursor:start])
+        merged.extend(lines)
+        cursor = start
+    merged.extend(frame[cursor:])
+    return merged
+
+
+def checkpoint_page(lines):
+    for line in lines:
+        m = PAGE_CHECKPOINT_REGEX.match(line)
+        if m:
+            return int(m.group(1))
+    return None
+
+
+def read_file_lines(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read().splitlines(True)
+    except (IOError, OSError):
+        return None
+
+
+def collect(aux_path, frame_directory, part_directories, job_name, parts):
+    '''
+    Copies the files written by the jobs of a round back to aux_path: the
+    .aux file of every part from its job, the files of the frame merged
+    with those of the parts, all logs, and the union of the .fls files with
+    the shard directories replaced by aux_path
+    '''
+    # A part whose length changed moves all later parts, which their jobs
+    # only saw if they were compiled again. Their page checkpoints are
+    # moved right away, so the next round starts them on the right page
+    shift = 0
+    for part, directory in zip(parts, part_directories):
+        path = os.path.join(aux_path, part + u'.aux')
+        old = checkpoint_page(read_file_lines(path) or [])
+        data = read_file_lines(os.path.join(directory, part + u'.aux'))
+        if data is None:
+            continue
+        new = checkpoint_page(data)
+        data = b''.join(data)
+        if old is not None and new is not None:
+            page = u'\\setcounter{{page}}{{{0}}}'.format(new + shift)
+            data = PAGE_CHECKPOINT_REGEX.sub(
+                lambda m: page.encode('ascii'), data)
+            shift += new - old
+        write_if_changed(path, data)
+
+    for name in sorted(os.listdir(frame_directory)):
+        if not name.startswith(job_name + u'.') or name.endswith(UNMERGED_EXTENSIONS):
+            continue
+        frame = read_file_lines(os.path.join(frame_directory, name))
+        versions = [read_file_lines(os.path.join(directory, name))
+                    for directory in part_directories]
+        merged = merge_lines(frame, [lines for lines in versions if lines is not None])
+        write_if_changed(os.path.join(aux_path, name), b''.join(merged))
+
+    # errors and warnings are looked up in the log of the job
+    log = []
+    for directory in [frame_directory] + part_directories:
+        log.extend(read_file_lines(os.path.join(directory, job_name + u'.log')) or [])
+    write_if_changed(os.path.join(aux_path, job_name + u'.log'), b''.join(log))
+
+    fls = []
+    for directory in [frame_directory] + part_directories:
+        prefix = os.path.abspath(directory) + os.sep
+        pwd = None
+        for line in read_file_lines(os.path.join(directory, job_name + u'.fls')) or []:
+            line = line.decode('utf-8', 'ignore').rstrip(u'\r\n')
+            kind, _, name = line.partition(u' ')
+            if kind == u'PWD':
+                pwd = name
+                continue
+            name = os.path.normpath(os.path.join(pwd or directory, name))
+            if name.startswith(prefix):
+                name = os.path.join(aux_path, name[len(prefix):])
+            fls.append(u'{0} {1}\n'.format(kind, name))
+    write_if_changed(os.path.join(aux_path, job_name + u'.fls'),
+                     u''.join(fls).encode('utf-8'))
+
+
+def remove(directory):
+    shutil.rmtree(directory, ignore_errors=True)
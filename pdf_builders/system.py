@@ -1,4 +1,5 @@
 #! Copied from https://github.com/SublimeText/LaTeXTools
+import multiprocessing
 import os
 import sys
 
@@ -78,3 +79,37 @@ if sys.version_info < (3, 3):
         return None
 else:
     from shutil import which
+
+
+def available_memory():
+    '''
+    Returns the memory available for new processes in bytes, or None if it
+    cannot be determined on this platform
+    '''
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def default_jobs(job_memory=None):
+    '''
+    Returns the number of jobs which can run concurrently given the number
+    of cores and, if job_memory (in bytes) is given, the available memory
+    '''
+    try:
+        jobs = multiprocessing.cpu_count()
+    except NotImplementedError:
+        jobs = 1
+    if job_memory:
+        memory = available_memory()
+        if memory is not None:
+            jobs = min(jobs, memory // job_memory)
+    return max(1, int(jobs))
@@ -34,7 +34,17 @@ defaultSpeechSetting = "never"
 # You should have received a copy of the GNU General Public License
 # along with this program; if not, see <http://www.gnu.org/copyleft/gpl.html>.
 
-import re, subprocess, os, time,  optparse, sys, shlex
+import re, subprocess, os, time,  optparse, sys, shlex, shutil, tempfile
+
+#the log parser lives next to this script; it is a plain module when we run as a script
+try:
+    from pdf_builders.logParser import LogIndex, MISSING_FILE, MISSING_FONT_FILE, MISSING_FONT
+except ImportError:
+    from logParser import LogIndex, MISSING_FILE, MISSING_FONT_FILE, MISSING_FONT
+try:
+    from pdf_builders.tlpdbIndex import TlpdbIndex, find_tlpdb
+except ImportError:
+    from tlpdbIndex import TlpdbIndex, find_tlpdb
 
 scriptName = os.path.basename(__file__)     #the name of this script file
 py3 = sys.version_info[0]  >= 3
@@ -174,7 +184,8 @@ def generateSpeakerFuncs(speech_setting):
 
     return (installspeaker, exiter)
 
-def generateTLMGRFuncs(tlmgr, speaker, sudoFunc):
+#index = TlpdbIndex to look up files locally instead of running tlmgr search
+def generateTLMGRFuncs(tlmgr, speaker, sudoFunc, index = None):
     #checks that tlmgr is installed, raises OSError otherwise
     #also checks whether we need to escalate permissions, using fake remove command
     process = subprocess.Popen( [ tlmgr,  "remove" ], stdin=subprocess.PIPE, stdout = subprocess.PIPE,  stderr=subprocess.PIPE  )
@@ -219,12 +230,7 @@ sudo {2}'''.format(scriptName, packagesString, basicCommand)
 
             sudoFunc(basicCommand, bashCommand)
 
-    #strictmatch requires an entire /file match in the search results
-    def getSearchResults(preamble, term, strictMatch):
-        fontOrFile =  "font" if "font" in preamble else "file"
-        speaker("Searching for missing {0}: {1} ".format(fontOrFile, term))
-        print( "{0}: Searching repositories for missing {1} {2}".format(scriptName, fontOrFile,  term) )
-
+    def searchTLMGR(preamble, term, strictMatch):
         process = subprocess.Popen([ tlmgr, "search", "--global", "--file", term], stdin=subprocess.PIPE, stdout = subprocess.PIPE, stderr=subprocess.PIPE )
         ( output ,  stderrdata ) = process.communicateStr()
         outList = output.split("\n")
@@ -242,6 +248,19 @@ sudo {2}'''.format(scriptName, packagesString, basicCommand)
 
         results = list(set(results))    #removes duplicates
         results.remove("latex")     #removes most common fake result
+        return results
+
+    #strictmatch requires an entire /file match in the search results
+    def getSearchResults(preamble, term, strictMatch):
+        fontOrFile =  "font" if "font" in preamble else "file"
+        speaker("Searching for missing {0}: {1} ".format(fontOrFile, term))
+        print( "{0}: Searching repositories for missing {1} {2}".format(scriptName, fontOrFile,  term) )
+
+        if index is not None:
+            #the index knows the real package names, no need to guess from paths
+            results = index.lookup(term) if strictMatch else index.lookup_prefix(term)
+        else:
+            results = searchTLMGR(preamble, term, strictMatch)
 
         if len(results) == 0:
             speaker("File not found.")
@@ -264,16 +283,45 @@ sudo {2}'''.format(scriptName, packagesString, basicCommand)
         else:
             return results
 
-    def searchAndInstall(searcher,  entry):
-        installPackages(searcher(entry))
-        return entry    #returns the entry just installed
+    #all missing files and fonts of a pass are searched first and then installed together
+    return (searchFilePackage, searchFontPackage, installPackages)
 
-    return ( lambda entry : searchAndInstall(searchFilePackage,  entry),  lambda entry : searchAndInstall(searchFontPackage,  entry) )
+#answers to LaTeX's prompts for missing files; an empty line skips the file, so
+#that a single pass reports every missing package instead of only the first one
+recoveryAnswers = 200
 
 def generateCompiler(compiler, arguments, texDoc, exiter):
+    #scrollmode lets LaTeX prompt for missing files (nonstopmode aborts instead);
+    #-recorder keeps the .fls of the final pass for the builder
+    compilerArgs = [ arg for arg in shlex.split(arguments) if not re.match(r"--?interaction=", arg) ]
+    compilerArgs.insert(0, "-interaction=scrollmode")
+    if not any(re.match(r"--?recorder$", arg) for arg in compilerArgs):
+        compilerArgs.append("-recorder")
+
+    #passes which only look for missing packages: no output is written (-draftmode, where the engine
+    #supports it), the run ends at \begin{document} and everything goes to a scratch directory, so the
+    #files of the real job are left alone
+    scanArgs = [ arg for arg in compilerArgs if not re.match(r"--?(output|aux)-directory=", arg) ]
+    if re.search(r"pdf|lua", os.path.basename(compiler)) or os.path.basename(compiler) == "latex":
+        scanArgs.append("-draftmode")
+    stopAtDocument = "\\AtBeginDocument{\\csname @@end\\endcsname}\\input{" + texDoc + "}"
+
     def compileTexDoc():
+        return runCompiler( [compiler] + compilerArgs + [texDoc] )
+
+    def scanPreamble():
+        scratch = tempfile.mkdtemp(prefix = "texliveonfly")
         try:
-            process = subprocess.Popen( [compiler] + shlex.split(arguments) + [texDoc], stdin=sys.stdin, stdout = subprocess.PIPE )
+            return runCompiler( [compiler] + scanArgs + ["-output-directory=" + scratch, stopAtDocument] )
+        finally:
+            shutil.rmtree(scratch, ignore_errors = True)
+
+    def runCompiler(command):
+        try:
+            process = subprocess.Popen( command, stdin=subprocess.PIPE, stdout = subprocess.PIPE )
+            #any read beyond the answers hits end of file, which aborts the run
+            process.stdin.write(tobytesifpy3("\n" * recoveryAnswers))
+            process.stdin.close()
             return readFromProcess(process)
         except OSError:
             print( "{0}: Unable to start {1}; are you sure it is installed?{2}".format(scriptName, compiler,
@@ -281,23 +329,32 @@ def generateCompiler(compiler, arguments, texDoc, exiter):
                 )
             exiter(1)
 
+    #every line is shown and indexed as it arrives; only the events found are kept in memory,
+    #the complete output is in the .log written by the compiler
     def readFromProcess(process):
-        getProcessLine = lambda : frombytesifpy3(process.stdout.readline())
-
-        output = ""
-        line = getProcessLine()
-        while line != '':
-            output += line
+        index = LogIndex(track_files = False)
+        for line in iter(process.stdout.readline, b''):
+            line = line.decode("UTF-8", "replace") if py3 else line
             sys.stdout.write(line)
-            line = getProcessLine()
+            index.feed(line.rstrip("\r\n"))
+        process.stdout.close()
 
-        returnCode = None
-        while returnCode == None:
-            returnCode = process.poll()
+        #blocks until the compiler has exited
+        returnCode = process.wait()
+        return (index, returnCode)
 
-        return (output, returnCode)
+    return (compileTexDoc, scanPreamble)
 
-    return compileTexDoc
+#the index is built once per tlpdb and reused until the tlpdb changes; returns None to fall back to tlmgr search
+def openIndex(tlpdb, texlive_bin):
+    tlpdb = tlpdb or find_tlpdb(texlive_bin)
+    if not tlpdb:
+        return None
+    try:
+        return TlpdbIndex.open(tlpdb)
+    except Exception as e:
+        print("{0}: Unable to use the package index of {1} ({2}); searching with tlmgr instead.".format(scriptName, tlpdb, e))
+        return None
 
 ### MAIN PROGRAM ###
 
@@ -323,6 +380,9 @@ if __name__ == '__main__':
         help="Forces us to assume we can run only in this terminal.  Permission escalators will appear here rather than graphically or in a new terminal.")
     parser.add_option('-s',  '--speech_when' , dest='speech_setting', metavar="OPTION",  default=defaultSpeechSetting ,
         help='Toggles speech-synthesized notifications (where supported).  OPTION can be "always", "never", "installing", "failed", or some combination.')
+    parser.add_option('--tlpdb', dest='tlpdb', metavar='TLPDB',
+        help="texlive.tlpdb (path or mirror URL) to look up missing files in, instead of running tlmgr search for each; " +
+            "defaults to the repository copy kept by tlmgr, if any", default="")
     parser.add_option('-f', '--fail_silently', action = "store_true" , dest='fail_silently',
         help="If tlmgr cannot be found, compile document anyway.", default=False)
 
@@ -335,50 +395,93 @@ if __name__ == '__main__':
     compiler_path = os.path.join( options.texlive_bin, options.compiler)
 
     (installSpeaker, exitScript) = generateSpeakerFuncs(options.speech_setting)
-    compileTex = generateCompiler( compiler_path, options.arguments, texDoc, exitScript)
+    (compileTex, scanPreamble) = generateCompiler( compiler_path, options.arguments, texDoc, exitScript)
 
     #initializes tlmgr, responds if the program not found
     try:
         tlmgr_path = os.path.join(options.texlive_bin, "tlmgr")
-        (installFile,  installFont) = generateTLMGRFuncs(tlmgr_path,  installSpeaker,  generateSudoer(options.terminal_only))
+        (searchFile,  searchFont,  installPackages) = generateTLMGRFuncs(tlmgr_path,  installSpeaker,  generateSudoer(options.terminal_only),  openIndex(options.tlpdb, options.texlive_bin))
     except OSError:
         if options.fail_silently:
-            (output, returnCode)  = compileTex()
+            (index, returnCode)  = compileTex()
             exitScript(returnCode)
         else:
             parser.error( "{0}: It appears {1} is not installed.  {2}".format(scriptName, tlmgr_path,
                 "Are you sure you have TeX Live 2010 or later?" if tlmgr_path == "tlmgr" else "" ) )
 
-    #loop constraints
-    done = False
-    previousFile = ""
-    previousFontFile = ""
-    previousFont =""
+    #everything searched for so far, so that files which cannot be installed end the loop
+    searched = set()
 
-    #keeps running until all missing font/file errors are gone, or the same ones persist in all categories
-    while not done:
-        (output, returnCode)  = compileTex()
+    #time spent in each step of every pass, printed as the passes complete
+    def reportTiming(iteration, steps):
+        print("{0}: pass {1}: {2}".format(scriptName, iteration,
+            ", ".join("{0} {1:.2f}s".format(name, seconds) for (name, seconds) in steps)))
 
+    #returns the packages providing the missing files and fonts of a pass not searched for before
+    def resolve(index):
         #most reliable: searches for missing file
-        filesSearch = re.findall(r"! LaTeX Error: File `([^`']*)' not found" , output) + re.findall(r"! I can't find file `([^`']*)'." , output)
+        filesSearch = [ event.data for event in index.events(MISSING_FILE) ]
         filesSearch = [ name for name in filesSearch if name != texDoc ]  #strips our .tex doc from list of files
         #next most reliable: infers filename from font error
-        fontsFileSearch = [ name + ".tfm" for name in re.findall(r"! Font \\[^=]*=([^\s]*)\s", output) ]
+        fontsFileSearch = [ event.data for event in index.events(MISSING_FONT_FILE) ]
         #brute force search for font name in files
-        fontsSearch =  re.findall(r"! Font [^\n]*file\:([^\:\n]*)\:", output) + re.findall(r"! Font \\[^/]*/([^/]*)/", output)
+        fontsSearch = [ event.data for event in index.events(MISSING_FONT) ]
+
+        packages = set()
+        for name in filesSearch + fontsFileSearch:
+            if name not in searched:
+                searched.add(name)
+                packages.update(searchFile(name))
+        #font names are only searched if no font file gave a result
+        if not packages:
+            for name in fontsSearch:
+                if name not in searched:
+                    searched.add(name)
+                    packages.update(searchFont(name))
+        return packages
+
+    iteration = 0
+
+    #Each iteration first scans the preamble, where nearly all packages are loaded, which is much
+    #cheaper than a full compile. Only once the preamble is complete does a full compile produce the
+    #output, and look for files and fonts missing in the document body.
+    #Keeps running until all missing font/file errors are gone, or no new ones turn up
+    while True:
+        iteration += 1
+        steps = []
+        start = time.time()
+        #the output was indexed while it was read; all searches below only query the index
+        (index, returnCode) = scanPreamble()
+        steps.append(("preamble", time.time() - start))
+        start = time.time()
+        packages = resolve(index)
+        steps.append(("search", time.time() - start))
+
+        if not packages:
+            start = time.time()
+            (index, returnCode)  = compileTex()
+            steps.append(("compile", time.time() - start))
+            start = time.time()
+            packages = resolve(index)
+            steps.append(("search", time.time() - start))
+            if not packages:
+                reportTiming(iteration, steps)
+                break
 
         try:
-            if len(filesSearch) > 0 and filesSearch[0] != previousFile:
-                previousFile = installFile(filesSearch[0] )
-            elif len(fontsFileSearch) > 0 and fontsFileSearch[0] != previousFontFile:
-                previousFontFile = installFile(fontsFileSearch[0])
-            elif len(fontsSearch) > 0 and fontsSearch[0] != previousFont:
-                previousFont = installFont(fontsSearch[0])
-            else:
-                done = True
+            #a single tlmgr transaction for everything missing in this pass
+            start = time.time()
+            installPackages(sorted(packages))
+            steps.append(("install", time.time() - start))
+            reportTiming(iteration, steps)
         except OSError:
             print("\n{0}: Unable to update; all privilege escalation attempts have failed!".format(scriptName) )
-            print("We've already compiled the .tex document, so there's nothing else to do.\n  Exiting..")
+            if steps[-1][0] == "search" and steps[-2][0] == "preamble":
+                print("Compiling the .tex document with what is installed.\n")
+                (index, returnCode)  = compileTex()
+            else:
+                print("We've already compiled the .tex document, so there's nothing else to do.")
+            print("  Exiting..")
             exitScript(returnCode)
 
     exitScript(returnCode)
@@ -0,0 +1,243 @@
+import glob
+import hashlib
+import json
+import mmap
+import os
+import subprocess
+import sys
+import tempfile
+
+# This module is also imported by texliveonfly.py when it runs as a script,
+# so it must not depend on anything else in pdf_builders
+
+if sys.version_info < (3,):
+    from urllib2 import urlopen, Request, HTTPError
+else:
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError
+
+INDEX_VERSION = 1
+
+
+def cache_directory():
+    '''
+    Returns the directory the index and downloaded tlpdbs are stored in
+    '''
+    root = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(root, 'pdfbuilder', 'tlpdb')
+
+
+def find_tlpdb(texlive_bin=''):
+    '''
+    Returns the newest copy of a repository tlpdb kept by tlmgr in the local
+    installation, or None. The texlive.tlpdb of the installation itself only
+    lists installed packages and cannot be used to find missing ones
+    '''
+    try:
+        process = subprocess.Popen(
+            [os.path.join(texlive_bin, 'kpsewhich'), '-var-value=TEXMFROOT'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        root = process.communicate()[0].decode('utf-8', 'ignore').strip()
+    except OSError:
+        return None
+    if not root:
+        return None
+    copies = glob.glob(os.path.join(root, 'tlpkg', 'texlive.tlpdb.main.*'))
+    copies = [path for path in copies if not path.endswith('.xz')]
+    if not copies:
+        return None
+    return max(copies, key=os.path.getmtime)
+
+
+def _signature(path):
+    st = os.stat(path)
+    return [st.st_mtime, st.st_size]
+
+
+def _replace(src, dst):
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+def download(url, directory):
+    '''
+    Keeps a local copy of the tlpdb at url in directory and returns its path.
+    The copy is only downloaded again if the server reports a modification
+    '''
+    name = hashlib.sha1(url.encode('utf-8')).hexdigest() + '.tlpdb'
+    path = os.path.join(directory, name)
+    request = Request(url)
+    if os.path.exists(path):
+        request.add_header('If-Modified-Since', _http_date(os.path.getmtime(path)))
+    try:
+        response = urlopen(request, timeout=60)
+    except HTTPError as e:
+        if e.code == 304:
+            return path
+        raise
+
+    data = response.read()
+    if url.endswith('.xz'):
+        import lzma
+        data = lzma.decompress(data)
+    fd, tmp_path = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    _replace(tmp_path, path)
+    return path
+
+
+def _http_date(timestamp):
+    import email.utils
+    return email.utils.formatdate(timestamp, usegmt=True)
+
+
+def parse_tlpdb(path):
+    '''
+    Yields (file name, package) for every runfile listed in the tlpdb at
+    path. Architecture specific and infrastructure packages are skipped
+    '''
+    package = None
+    in_runfiles = False
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.startswith(b' '):
+                if in_runfiles and package is not None:
+                    name = line.split(None, 1)[0].decode('utf-8', 'ignore')
+                    yield name.rsplit('/', 1)[-1], package
+                continue
+            in_runfiles = line.startswith(b'runfiles')
+            if line.startswith(b'name '):
+                package = line[5:].strip().decode('utf-8', 'ignore')
+                if '.' in package or package.startswith('00texlive'):
+                    package = None
+
+
+# ----------------------------------------------------------------
+# TlpdbIndex class
+#
+# Compact index mapping file names to the TeX Live packages providing
+# them, built from a texlive.tlpdb and stored as a sorted text file of
+# "file name<TAB>package,package" lines.
+#
+# Lookups binary search the memory-mapped file, so nothing but the pages
+# touched is ever loaded. The index is rebuilt only when the tlpdb it was
+# built from changed.
+#
+class TlpdbIndex(object):
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # an empty index cannot be mapped
+            self._map = b''
+
+    @classmethod
+    def open(cls, tlpdb, directory=None):
+        '''
+        Returns the index for the tlpdb at tlpdb (a path or an URL),
+        building it first if it is missing or out of date
+        '''
+        directory = directory or cache_directory()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if '://' in tlpdb:
+            tlpdb = download(tlpdb, directory)
+        tlpdb = os.path.abspath(tlpdb)
+
+        name = hashlib.sha1(tlpdb.encode('utf-8')).hexdigest()
+        path = os.path.join(directory, name + '.idx')
+        meta_path = path + '.json'
+        meta = {'version': INDEX_VERSION, 'tlpdb': tlpdb,
+                'signature': _signature(tlpdb)}
+        try:
+            with open(meta_path, 'r') as f:
+                up_to_date = json.load(f) == meta and os.path.exists(path)
+        except (IOError, OSError, ValueError):
+            up_to_date = False
+
+        if not up_to_date:
+            cls.build(tlpdb, path)
+            with open(meta_path, 'w') as f:
+                json.dump(meta, f)
+        return cls(path)
+
+    @staticmethod
+    def build(tlpdb, path):
+        packages = {}
+        for name, package in parse_tlpdb(tlpdb):
+            packages.setdefault(name, set()).add(package)
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            for name in sorted(packages, key=lambda n: n.encode('utf-8')):
+                f.write(u'{0}\t{1}\n'.format(
+                    name, u','.join(sorted(packages[name]))).encode('utf-8'))
+        _replace(tmp_path, path)
+
+    def _lower_bound(self, key):
+        # position of the first line whose file name is not less than key
+        data = self._map
+        lo, hi = 0, len(data)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = data.rfind(b'\n', 0, mid) + 1
+            if start < lo:
+                start = lo
+            end = data.find(b'\n', start)
+            if end < 0:
+                end = len(data)
+            if data[start:end].split(b'\t', 1)[0] < key:
+                lo = end + 1
+            else:
+                hi = start
+        return lo
+
+    def _lines_from(self, position):
+        data = self._map
+        while position < len(data):
+            end = data.find(b'\n', position)
+            if end < 0:
+                end = len(data)
+            name, _, packages = data[position:end].partition(b'\t')
+            yield name, packages
+            position = end + 1
+
+    def lookup(self, name):
+        '''
+        Returns the packages providing a file called name
+        '''
+        key = name.encode('utf-8')
+        for found, packages in self._lines_from(self._lower_bound(key)):
+            if found == key:
+                return packages.decode('utf-8').split(u',')
+            return []
+        return []
+
+    def lookup_prefix(self, prefix, limit=50):
+        '''
+        Returns the packages providing files whose name starts with prefix,
+        e.g. the metric and type 1 files of a font
+        '''
+        key = prefix.encode('utf-8')
+        results = []
+        for found, packages in self._lines_from(self._lower_bound(key)):
+            if not found.startswith(key) or len(results) >= limit:
+                break
+            for package in packages.decode('utf-8').split(u','):
+                if package not in results:
+                    results.append(package)
+        return results
+
+    def close(self):
+        if not isinstance(self._map, bytes):
+            self._map.close()
+        self._file.close()
@@ -0,0 +1,158 @@
+from __future__ import print_function
+import errno
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+# Commands are grouped by what they spend their time on
+CATEGORIES = (
+    ('engine', (u'pdflatex', u'xelatex', u'lualatex', u'latex', u'pdftex',
+                u'xetex', u'luatex', u'latexmk', u'texify')),
+    ('bibliography', (u'bibtex', u'bibtex8', u'biber')),
+    ('index', (u'makeindex', u'makeglossaries', u'xindy', u'texindy')),
+    ('texliveonfly', (u'texliveonfly.py',)),
+    ('dvips', (u'dvips',)),
+    ('dvipdfmx', (u'dvipdfmx', u'xdvipdfmx')),
+    ('ghostscript', (u'gs', u'gswin64c', u'gswin32c', u'ps2pdf')),
+)
+
+
+def command_category(command):
+    '''
+    Returns the category of a command given as a list of arguments
+    '''
+    for argument in command[:2]:
+        name = os.path.basename(argument).lower()
+        if name.endswith(u'.exe'):
+            name = name[:-4]
+        for category, names in CATEGORIES:
+            if name in names:
+                return category
+    return 'other'
+
+
+def wait_process(process):
+    '''
+    Waits for process to finish like Popen.wait(). Where os.wait4 is
+    available, the resource usage of the process (and of the processes it
+    waited for) is stored as process.rusage
+    '''
+    if (
+        getattr(process, 'returncode', None) is not None or
+        not hasattr(os, 'wait4') or
+        not isinstance(process, subprocess.Popen)
+    ):
+        return process.wait()
+
+    while True:
+        try:
+            _, status, rusage = os.wait4(process.pid, 0)
+            break
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            # already reaped, e.g. by a concurrent poll()
+            return process.wait()
+
+    process.rusage = rusage
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return process.returncode
+
+
+def peak_rss(rusage):
+    '''
+    Returns the peak resident set size in bytes from a resource usage
+    '''
+    # ru_maxrss is in bytes on OS X and in kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return rusage.ru_maxrss
+    return rusage.ru_maxrss * 1024
+
+
+# ----------------------------------------------------------------
+# Tracer class
+#
+# Collects a span for every command run by build.run(), with its wall
+# time, CPU time and peak memory, and exports them as a Chrome trace
+# (chrome://tracing, https://ui.perfetto.dev) and as a summary table.
+# Every root file gets its own lane. Safe to use from several threads.
+#
+class Tracer(object):
+
+    def __init__(self):
+        self.events = []
+        self.origin = time.time()
+        self._lanes = {}
+        self._lock = threading.Lock()
+
+    def _lane(self, name):
+        lane = self._lanes.get(name)
+        if lane is None:
+            lane = self._lanes[name] = len(self._lanes) + 1
+            self.events.append({
+                'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': lane,
+                'args': {'name': name}
+            })
+        return lane
+
+    def record(self, lane, name, category, start, end, process=None):
+        '''
+        Adds a span from start to end (time.time() values) to lane. The
+        return code and resource usage of process are added if known
+        '''
+        args = {}
+        returncode = getattr(process, 'returncode', None)
+        if returncode is not None:
+            args['returncode'] = returncode
+        rusage = getattr(process, 'rusage', None)
+        if rusage is not None:
+            args['user_cpu_s'] = round(rusage.ru_utime, 3)
+            args['system_cpu_s'] = round(rusage.ru_stime, 3)
+            args['peak_rss_mb'] = round(peak_rss(rusage) / 1048576.0, 1)
+
+        with self._lock:
+            self.events.append({
+                'name': name, 'cat': category, 'ph': 'X', 'pid': 1,
+                'tid': self._lane(lane),
+                'ts': int((start - self.origin) * 1e6),
+                'dur': int((end - start) * 1e6),
+                'args': args
+            })
+
+    def write_chrome_trace(self, path):
+        with self._lock:
+            data = {'traceEvents': list(self.events), 'displayTimeUnit': 'ms'}
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=1)
+
+    def summary(self):
+        '''
+        Returns a table of the time and resources spent per category
+        '''
+        totals = {}
+        with self._lock:
+            for event in self.events:
+                if event['ph'] != 'X':
+                    continue
+                total = totals.setdefault(
+                    event['cat'], [0, 0.0, 0.0, 0.0, 0.0])
+                args = event['args']
+                total[0] += 1
+                total[1] += event['dur'] / 1e6
+                total[2] += args.get('user_cpu_s', 0.0)
+                total[3] += args.get('system_cpu_s', 0.0)
+                total[4] = max(total[4], args.get('peak_rss_mb', 0.0))
+
+        lines = [u'{0:<14}{1:>6}{2:>10}{3:>10}{4:>10}{5:>12}'.format(
+            u'step', u'runs', u'wall s', u'user s', u'sys s', u'peak MB')]
+        for category in sorted(totals, key=lambda c: -totals[c][1]):
+            runs, wall, user, system, rss = totals[category]
+            lines.append(u'{0:<14}{1:>6}{2:>10.2f}{3:>10.2f}{4:>10.2f}{5:>12.1f}'.format(
+                category, runs, wall, user, system, rss))
+        return u'\n'.join(lines)
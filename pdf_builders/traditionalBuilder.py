@@ -6,7 +6,7 @@ from six import string_types, reraise
 
 # builders directory in sys.path
 from pdf_builders.pdfBuilder import PdfBuilder, get_platform
-from pdf_builders.pdfBuilder import FILE_NOT_FOUND_ERROR_REGEX, TEXLIVEONFLY
+from pdf_builders.logParser import MISSING_FILE
 import shlex
 
 DEBUG = False
@@ -70,7 +70,6 @@ class TraditionalBuilder(PdfBuilder):
 
         texify = cmd[0] == 'texify'
         latexmk = cmd[0] == 'latexmk'
-        texliveonfly = [TEXLIVEONFLY, u"-interaction=nonstopmode", u"-synctex=1"]
 
         if not engine_used:
             self.display("Your custom command does not allow the engine to be selected\n\n")
@@ -133,10 +132,13 @@ class TraditionalBuilder(PdfBuilder):
         yield (cmd + [self.tex_name], "Invoking " + cmd[0] + "... ")
         self.display("done.\n")
 
-        if get_platform() != u'windows' and FILE_NOT_FOUND_ERROR_REGEX.search(self.out):
-            texliveonfly.append(u'--jobname=' + self.job_name)
-            texliveonfly.append(self.tex_name)
-            yield(texliveonfly, 'running {0}'.format(u'texliveonfly'))
+        if get_platform() != u'windows' and self.log_index.has(MISSING_FILE):
+            options = [u"-interaction=nonstopmode", u"-synctex=1"]
+            if self.output_directory is not None:
+                options.append(u"--output-directory=" + self.output_directory)
+            options.append(u'--jobname=' + self.job_name)
+            yield (self.texliveonfly_command(self.engine, options),
+                   'running {0}'.format(u'texliveonfly'))
 
         # This is for debugging purposes
         if self.display_log:
@@ -0,0 +1,290 @@
+import atexit
+import os
+import re
+import shutil
+import tempfile
+import threading
+from pdf_builders.auxFiles import AUX_INPUT_REGEX, RERUN_EXTENSIONS, read_lines
+from pdf_builders.buildCache import file_signature, read_fls
+
+# Only \begin{document} ends the preamble of a warm engine; a preamble
+# ending at mylatexformat's \endofdump is not supported
+BEGIN_DOCUMENT_REGEX = re.compile(r"^[^%\n]*\\begin\s*\{document\}", re.MULTILINE)
+
+# Written to the directory of the final output rather than the aux directory
+OUTPUT_EXTENSIONS = (u'.pdf', u'.dvi', u'.synctex.gz', u'.synctex')
+
+# Appended to the preamble read by a warm engine. When the engine is
+# resumed it reads the root file again, skipping everything up to
+# \begin{document}. Only letters are used in the macro names so that the
+# catcodes left behind by the preamble do not matter
+SKIP_PREAMBLE = r'''
+\expandafter\let\expandafter\PdfBuilderInput\csname @@input\endcsname
+\def\PdfBuilderDocument{document}
+\def\PdfBuilderBegin{\begin{document}}
+\long\def\PdfBuilderSkip#1\begin#2{%
+  \def\PdfBuilderName{#2}%
+  \ifx\PdfBuilderName\PdfBuilderDocument
+    \expandafter\PdfBuilderBegin
+  \else
+    \expandafter\PdfBuilderSkip
+  \fi}
+'''
+
+
+def split_preamble(tex_path):
+    '''
+    Returns the preamble of tex_path, i.e. everything before the line with
+    \\begin{document}, or None if there is no such line
+    '''
+    try:
+        with open(tex_path, 'rb') as f:
+            text = f.read().decode('utf-8', 'ignore')
+    except (IOError, OSError):
+        return None
+    m = BEGIN_DOCUMENT_REGEX.search(text)
+    if m is None:
+        return None
+    return text[:m.start()]
+
+
+def preamble_inputs(fls_path, job_name):
+    '''
+    Returns the files read before \\begin{document} according to the .fls
+    file of the last pass, i.e. those recorded before the .aux file of
+    job_name, which LaTeX opens at \\begin{document}. If it never got
+    there, all the inputs of the pass are returned
+    '''
+    aux_name = job_name + u'.aux'
+    inputs = []
+    for kind, path in read_fls(fls_path):
+        name = os.path.basename(path)
+        if name == aux_name:
+            break
+        if kind == u'INPUT' and name != WarmEnginePool.WRAPPER and path not in inputs:
+            inputs.append(path)
+    return inputs
+
+
+def preamble_signatures(paths):
+    '''
+    Returns the signatures of paths, the files read by the preamble, any
+    change of which makes a parked engine stale
+    '''
+    return dict((path, file_signature(path)) for path in paths)
+
+
+def copy_aux_files(aux_path, job_name, directory):
+    '''
+    Copies the auxiliary files of job_name which the next pass reads back,
+    including the .aux files of \\include'd files, to directory
+    '''
+    names = [job_name + ext for ext in RERUN_EXTENSIONS]
+    for line in read_lines(os.path.join(aux_path, job_name + u'.aux')):
+        m = AUX_INPUT_REGEX.match(line)
+        if m:
+            names.append(m.group(1))
+    for name in names:
+        src = os.path.join(aux_path, name)
+        if not os.path.isfile(src):
+            continue
+        dst = os.path.join(directory, name)
+        if not os.path.isdir(os.path.dirname(dst)):
+            os.makedirs(os.path.dirname(dst))
+        shutil.copy2(src, dst)
+
+
+# ----------------------------------------------------------------
+# WarmEngine class
+#
+# An engine process which has already read the preamble of the document
+# and waits on stdin at the terminal prompt. It writes to a scratch
+# directory of its own, so it can be started while another pass of the
+# same job is running.
+#
+# Once resumed it behaves like the Popen object of a normal pass; when it
+# exits, its output files are moved to the aux and output directories.
+#
+class WarmEngine(object):
+
+    def __init__(self, process, directory, key, signatures):
+        self._process = process
+        self.directory = directory
+        self.key = key
+        self.signatures = signatures
+        self.args = getattr(process, 'args', None)
+        self.pid = process.pid
+        self.stdout = process.stdout
+        self.stderr = process.stderr
+        self.returncode = None
+        self._destination = None
+        self._finished = False
+
+    def is_valid(self, key):
+        if key != self.key or self._process.poll() is not None:
+            return False
+        return all(
+            file_signature(path) == signature
+            for path, signature in self.signatures.items()
+        )
+
+    def resume(self, tex_name, job_name, aux_path, output_path):
+        '''
+        Feeds the body of tex_name to the engine, which runs the rest of the
+        pass with the auxiliary files currently in aux_path
+        '''
+        self._destination = (job_name, aux_path, output_path)
+        copy_aux_files(aux_path, job_name, self.directory)
+        # any further read from the terminal, e.g. LaTeX asking for a
+        # missing file, ends the pass instead of waiting forever
+        line = u'\\nonstopmode\\expandafter\\PdfBuilderSkip\\PdfBuilderInput "{0}"\n'.format(tex_name)
+        try:
+            self._process.stdin.write(line.encode('utf-8'))
+            self._process.stdin.close()
+        except (IOError, OSError):
+            pass
+
+    def poll(self):
+        if self._process.poll() is not None:
+            self._finish()
+        return self.returncode
+
+    def wait(self):
+        self._process.wait()
+        self._finish()
+        return self.returncode
+
+    def communicate(self, input=None):
+        stdout, stderr = self._process.communicate()
+        self._finish()
+        return stdout, stderr
+
+    def kill(self):
+        self._process.kill()
+
+    def discard(self):
+        try:
+            self._process.kill()
+        except OSError:
+            pass
+        self._process.wait()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _finish(self):
+        if self._finished:
+            return
+        self._finished = True
+        self.returncode = self._process.returncode
+        try:
+            if self._destination is not None:
+                self._move_outputs()
+        finally:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _move_outputs(self):
+        job_name, aux_path, output_path = self._destination
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                src = os.path.join(root, name)
+                relative = os.path.relpath(src, self.directory)
+                if relative == WarmEnginePool.WRAPPER:
+                    continue
+                if name.startswith(job_name) and name.endswith(OUTPUT_EXTENSIONS):
+                    dst = os.path.join(output_path, relative)
+                else:
+                    dst = os.path.join(aux_path, relative)
+                if name == job_name + u'.fls':
+                    # the recorded paths have to point to the final files
+                    with open(src, 'rb') as f:
+                        data = f.read().decode('utf-8', 'ignore')
+                    with open(src, 'wb') as f:
+                        f.write(data.replace(self.directory, aux_path).encode('utf-8'))
+                if not os.path.isdir(os.path.dirname(dst)):
+                    os.makedirs(os.path.dirname(dst))
+                shutil.move(src, dst)
+
+
+# ----------------------------------------------------------------
+# WarmEnginePool class
+#
+# Parked WarmEngines of one job. An engine taken from the pool is replaced
+# right away, so the next pass (or, when watching, the next build) finds
+# an engine which has already paid for process startup, kpathsea
+# initialization and loading the preamble.
+#
+class WarmEnginePool(object):
+
+    WRAPPER = u'pdfbuilder-preamble.tex'
+
+    def __init__(self, size):
+        self.size = size
+        self._engines = []
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        '''
+        Returns a parked engine started for key or None. Engines started
+        for another key, or whose preamble files changed, are discarded
+        '''
+        with self._lock:
+            engines, self._engines = self._engines, []
+            engine = None
+            for candidate in engines:
+                if engine is None and candidate.is_valid(key):
+                    engine = candidate
+                elif candidate.is_valid(key):
+                    self._engines.append(candidate)
+                else:
+                    candidate.discard()
+            return engine
+
+    def fill(self, key, preamble, command, spawn, scratch, signatures):
+        '''
+        Starts engines for key until the pool is full. command is the
+        engine command without the file to read, which is appended;
+        spawn(command, stdin) starts a process and scratch is where the
+        scratch directories are created
+        '''
+        with self._lock:
+            while len(self._engines) < self.size:
+                directory = tempfile.mkdtemp(
+                    prefix=u'pdfbuilder-warm', dir=scratch)
+                wrapper = os.path.join(directory, self.WRAPPER)
+                with open(wrapper, 'wb') as f:
+                    f.write((preamble + SKIP_PREAMBLE).encode('utf-8'))
+                process = spawn(
+                    command + [u'--output-directory=' + directory,
+                               u'\\input{' + wrapper + u'}'])
+                self._engines.append(
+                    WarmEngine(process, directory, key, signatures))
+
+    def shutdown(self):
+        with self._lock:
+            for engine in self._engines:
+                engine.discard()
+            self._engines = []
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(name, size):
+    '''
+    Returns the pool of warm engines for name, shared by all builds of the
+    process, e.g. the rebuilds of build.py --watch
+    '''
+    with _pools_lock:
+        pool = _pools.get(name)
+        if pool is None:
+            pool = _pools[name] = WarmEnginePool(size)
+        pool.size = size
+        return pool
+
+
+@atexit.register
+def shutdown_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.shutdown()
+        _pools.clear()
@@ -0,0 +1,171 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+from pdf_builders.buildCache import file_signature
+
+# inotify(7) constants
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ONLYDIR = 0x01000000
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct('iIII')
+
+# Directories rather than files are watched, so that files replaced by an
+# editor (write to a temporary file and rename) are still seen
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+POLL_INTERVAL = 0.25
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(
+            ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+    except (OSError, AttributeError):
+        return None
+    libc.inotify_add_watch.argtypes = [
+        ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+
+def make_watcher():
+    '''
+    Returns an InotifyWatcher if the platform supports inotify and a
+    PollingWatcher otherwise
+    '''
+    libc = _load_libc()
+    if libc is not None:
+        fd = libc.inotify_init1(IN_CLOEXEC)
+        if fd >= 0:
+            return InotifyWatcher(libc, fd)
+    return PollingWatcher()
+
+
+# ----------------------------------------------------------------
+# InotifyWatcher class
+#
+# Reports modifications of a set of files using inotify, without polling.
+#
+class InotifyWatcher(object):
+
+    def __init__(self, libc, fd):
+        self.libc = libc
+        self.fd = fd
+        self.paths = set()
+        # watch descriptor -> directory and back
+        self._directories = {}
+        self._descriptors = {}
+
+    def watch(self, paths):
+        '''
+        Replaces the set of watched files
+        '''
+        self.paths = set(os.path.abspath(path) for path in paths)
+        directories = set(os.path.dirname(path) for path in self.paths)
+
+        for directory in list(self._descriptors):
+            if directory not in directories:
+                wd = self._descriptors.pop(directory)
+                del self._directories[wd]
+                self.libc.inotify_rm_watch(self.fd, wd)
+        for directory in directories:
+            if directory in self._descriptors:
+                continue
+            wd = self.libc.inotify_add_watch(
+                self.fd, directory.encode('utf-8'), WATCH_MASK)
+            if wd >= 0:
+                self._descriptors[directory] = wd
+                self._directories[wd] = directory
+
+    def wait(self, timeout=None):
+        '''
+        Waits up to timeout seconds (forever if None) for any of the watched
+        files to change. Returns the set of changed files, which is empty
+        if the timeout expired
+        '''
+        changed = set()
+        deadline = None if timeout is None else time.time() + timeout
+        while not changed:
+            remaining = None
+            if deadline is not None:
+                remaining = max(0, deadline - time.time())
+            try:
+                ready, _, _ = select.select([self.fd], [], [], remaining)
+            except (OSError, select.error) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not ready:
+                break
+            changed = self._read_events()
+        return changed
+
+    def _read_events(self):
+        changed = set()
+        data = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # events were lost
+                return set(self.paths)
+            directory = self._directories.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name.decode('utf-8', 'ignore'))
+            if path in self.paths:
+                changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+# ----------------------------------------------------------------
+# PollingWatcher class
+#
+# Fallback for platforms without inotify, comparing the [mtime, size]
+# signatures of the watched files every POLL_INTERVAL seconds.
+#
+class PollingWatcher(object):
+
+    def __init__(self):
+        self.signatures = {}
+
+    def watch(self, paths):
+        paths = set(os.path.abspath(path) for path in paths)
+        self.signatures = dict(
+            (path, self.signatures[path] if path in self.signatures
+             else file_signature(path))
+            for path in paths
+        )
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            changed = set()
+            for path, signature in self.signatures.items():
+                current = file_signature(path)
+                if current != signature:
+                    self.signatures[path] = current
+                    changed.add(path)
+            if changed:
+                return changed
+            if deadline is not None and time.time() >= deadline:
+                return changed
+            time.sleep(POLL_INTERVAL if deadline is None else
+                       max(0, min(POLL_INTERVAL, deadline - time.time())))
+
+    def close(self):
+        pass
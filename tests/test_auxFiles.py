@@ -0,0 +1,113 @@
+import os
+import shutil
+import tempfile
+import unittest
+from pdf_builders.auxFiles import aux_fingerprint, citation_fingerprint
+
+
+class AuxFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, text):
+        path = os.path.join(self.directory, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(text.encode('utf-8'))
+
+
+class AuxFingerprintTest(AuxFilesTest):
+
+    def fingerprint(self):
+        return aux_fingerprint(self.directory, u'main')
+
+    def test_stable(self):
+        self.write(u'main.aux', u'\\relax\n\\newlabel{a}{{1}{1}}\n')
+        self.write(u'main.toc', u'\\contentsline {section}{A}{1}\n')
+        self.assertEqual(self.fingerprint(), self.fingerprint())
+
+    def test_changes_with_read_back_files(self):
+        self.write(u'main.aux', u'\\relax\n')
+        fingerprint = self.fingerprint()
+        self.write(u'main.toc', u'\\contentsline {section}{A}{1}\n')
+        self.assertNotEqual(self.fingerprint(), fingerprint)
+        fingerprint = self.fingerprint()
+        self.write(u'main.aux', u'\\relax\n\\newlabel{a}{{1}{1}}\n')
+        self.assertNotEqual(self.fingerprint(), fingerprint)
+
+    def test_ignores_other_files(self):
+        self.write(u'main.aux', u'\\relax\n')
+        fingerprint = self.fingerprint()
+        self.write(u'main.log', u'This is pdfTeX\n')
+        self.write(u'other.toc', u'\\contentsline {section}{B}{2}\n')
+        self.assertEqual(self.fingerprint(), fingerprint)
+
+    def test_included_aux_files(self):
+        self.write(u'main.aux', u'\\relax\n\\@input{chapters/one.aux}\n')
+        self.write(u'chapters/one.aux', u'\\newlabel{a}{{1}{1}}\n')
+        fingerprint = self.fingerprint()
+        self.write(u'chapters/one.aux', u'\\newlabel{a}{{2}{3}}\n')
+        self.assertNotEqual(self.fingerprint(), fingerprint)
+
+
+class CitationFingerprintTest(AuxFilesTest):
+
+    def setUp(self):
+        super(CitationFingerprintTest, self).setUp()
+        self.aux_directory = os.path.join(self.directory, u'aux')
+        self.write(u'aux/main.aux',
+                   u'\\relax\n\\citation{knuth}\n\\bibstyle{plain}\n'
+                   u'\\bibdata{refs}\n\\newlabel{a}{{1}{1}}\n')
+        self.write(u'refs.bib', u'@book{knuth, title={TAOCP}}\n')
+
+    def fingerprint(self):
+        return citation_fingerprint(self.aux_directory, self.directory, u'main')
+
+    def test_no_bibliography(self):
+        self.write(u'aux/main.aux', u'\\relax\n\\newlabel{a}{{1}{1}}\n')
+        self.assertIsNone(self.fingerprint())
+
+    def test_ignores_labels(self):
+        fingerprint = self.fingerprint()
+        self.write(u'aux/main.aux',
+                   u'\\relax\n\\citation{knuth}\n\\bibstyle{plain}\n'
+                   u'\\bibdata{refs}\n\\newlabel{a}{{2}{5}}\n')
+        self.assertEqual(self.fingerprint(), fingerprint)
+
+    def test_changes_with_citations(self):
+        fingerprint = self.fingerprint()
+        self.write(u'aux/main.aux',
+                   u'\\relax\n\\citation{knuth}\n\\citation{lamport}\n'
+                   u'\\bibstyle{plain}\n\\bibdata{refs}\n')
+        self.assertNotEqual(self.fingerprint(), fingerprint)
+
+    def test_changes_with_included_citations(self):
+        self.write(u'aux/main.aux',
+                   u'\\relax\n\\@input{one.aux}\n\\bibstyle{plain}\n'
+                   u'\\bibdata{refs}\n')
+        self.write(u'aux/one.aux', u'\\citation{knuth}\n')
+        fingerprint = self.fingerprint()
+        self.write(u'aux/one.aux', u'\\citation{lamport}\n')
+        self.assertNotEqual(self.fingerprint(), fingerprint)
+
+    def test_changes_with_local_bib_file(self):
+        fingerprint = self.fingerprint()
+        self.write(u'refs.bib', u'@book{knuth, title={TeXbook}}\n')
+        self.assertNotEqual(self.fingerprint(), fingerprint)
+
+    def test_biblatex_control_file(self):
+        self.write(u'aux/main.aux', u'\\relax\n')
+        self.write(u'aux/main.bcf', u'<bcf:controlfile/>\n')
+        fingerprint = self.fingerprint()
+        self.assertIsNotNone(fingerprint)
+        self.write(u'aux/main.bcf', u'<bcf:controlfile version="3.7"/>\n')
+        self.assertNotEqual(self.fingerprint(), fingerprint)
+
+
+if __name__ == '__main__':
+    unittest.main()
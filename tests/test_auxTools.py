@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+import unittest
+from pdf_builders.auxTools import AUX_TOOLS, AuxTool, plan
+
+
+def tool(name, consumes, produces):
+    return AuxTool(name, [name], consumes, produces)
+
+
+def names(layers):
+    return [sorted(t.name for t in layer) for layer in layers]
+
+
+class PlanTest(unittest.TestCase):
+
+    def test_independent_tools_share_a_layer(self):
+        tools = [tool(u'a', [u'.idx'], [u'.ind']),
+                 tool(u'b', [u'.nlo'], [u'.nls'])]
+        self.assertEqual(names(plan(tools)), [[u'a', u'b']])
+
+    def test_consumer_follows_producer(self):
+        tools = [tool(u'c', [u'.ind', u'.nls'], [u'.out']),
+                 tool(u'a', [u'.idx'], [u'.ind']),
+                 tool(u'b', [u'.nlo'], [u'.nls'])]
+        self.assertEqual(names(plan(tools)), [[u'a', u'b'], [u'c']])
+
+    def test_tool_consuming_its_own_output(self):
+        tools = [tool(u'a', [u'.idx', u'.ind'], [u'.ind'])]
+        self.assertEqual(names(plan(tools)), [[u'a']])
+
+    def test_cycle(self):
+        tools = [tool(u'a', [u'.x'], [u'.y']), tool(u'b', [u'.y'], [u'.x'])]
+        self.assertRaises(ValueError, plan, tools)
+
+    def test_builtin_tools(self):
+        self.assertEqual(len(plan(AUX_TOOLS)), 1)
+
+
+class GlossariesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.tool = dict((t.name, t) for t in AUX_TOOLS)[u'glossaries']
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, text):
+        with open(os.path.join(self.directory, name), 'w') as f:
+            f.write(text)
+
+    def test_unused(self):
+        self.assertIsNone(self.tool.fingerprint(self.directory, u'main'))
+        self.assertTrue(self.tool.outputs_exist(self.directory, u'main'))
+
+    def test_outputs_of_present_inputs(self):
+        self.write(u'main.glo', u'entry')
+        self.assertFalse(self.tool.outputs_exist(self.directory, u'main'))
+        self.write(u'main.gls', u'list')
+        self.assertTrue(self.tool.outputs_exist(self.directory, u'main'))
+        self.write(u'main.acn', u'acronym')
+        self.assertFalse(self.tool.outputs_exist(self.directory, u'main'))
+        self.write(u'main.acr', u'list')
+        self.assertTrue(self.tool.outputs_exist(self.directory, u'main'))
+
+    def test_fingerprint_covers_style_file(self):
+        self.write(u'main.glo', u'entry')
+        self.write(u'main.aux', u'\\relax\n\\@istfilename{main.ist}\n')
+        self.write(u'main.ist', u'style')
+        fingerprint = self.tool.fingerprint(self.directory, u'main')
+        self.write(u'main.ist', u'other style')
+        self.assertNotEqual(
+            self.tool.fingerprint(self.directory, u'main'), fingerprint)
+
+
+if __name__ == '__main__':
+    unittest.main()
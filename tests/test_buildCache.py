@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+import unittest
+from pdf_builders.buildCache import parse_fls
+
+
+class ParseFlsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def parse(self, lines):
+        path = os.path.join(self.directory, u'main.fls')
+        with open(path, 'wb') as f:
+            f.write(u'\n'.join(lines).encode('utf-8'))
+        return parse_fls(path)
+
+    def test_missing_file(self):
+        self.assertEqual(
+            parse_fls(os.path.join(self.directory, u'none.fls')), ([], []))
+
+    def test_paths_relative_to_pwd(self):
+        inputs, outputs = self.parse([
+            u'PWD /home/user/doc',
+            u'INPUT /usr/share/texmf/tex/latex/base/article.cls',
+            u'INPUT main.tex',
+            u'INPUT ./chapters/../main.aux',
+            u'OUTPUT main.aux',
+            u'OUTPUT out/main.pdf',
+        ])
+        self.assertEqual(inputs, [
+            u'/usr/share/texmf/tex/latex/base/article.cls',
+            u'/home/user/doc/main.tex',
+            u'/home/user/doc/main.aux',
+        ])
+        self.assertEqual(outputs, [
+            u'/home/user/doc/main.aux', u'/home/user/doc/out/main.pdf'])
+
+    def test_first_occurrence_order(self):
+        inputs, outputs = self.parse([
+            u'PWD /doc',
+            u'INPUT b.tex',
+            u'INPUT a.tex',
+            u'INPUT ./b.tex',
+            u'OUTPUT main.log',
+            u'OUTPUT main.log',
+        ])
+        self.assertEqual(inputs, [u'/doc/b.tex', u'/doc/a.tex'])
+        self.assertEqual(outputs, [u'/doc/main.log'])
+
+    def test_without_pwd(self):
+        # relative to the directory of the .fls file
+        inputs, _ = self.parse([u'INPUT main.tex', u'garbage line', u''])
+        self.assertEqual(inputs, [os.path.join(self.directory, u'main.tex')])
+
+
+if __name__ == '__main__':
+    unittest.main()
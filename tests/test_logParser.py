@@ -0,0 +1,96 @@
+import unittest
+from pdf_builders.logParser import (
+    BAD_BOX, BIBLIOGRAPHY_PROGRAM, ERROR, FILE_WRITE_ERROR, MISSING_FILE,
+    MISSING_FONT, MISSING_FONT_FILE, RERUN, UNDEFINED_CITATION, LogIndex)
+
+LOG = u'''! LaTeX Error: File `first.sty' not found.
+This is pdfTeX, Version 3.14159265-2.6-1.40.20 (TeX Live 2019)
+(./main.tex
+LaTeX2e <2018-12-01>
+(/usr/share/texmf/tex/latex/base/article.cls
+Document Class: article 2018/09/03 v1.4i Standard LaTeX document class
+(/usr/share/texmf/tex/latex/base/size10.clo
+File: size10.clo 2018/09/03 v1.4i Standard LaTeX file (size option)
+))
+(./chapters/one.tex
+<figures/a.pdf, id=1, 345.0pt x 200.0pt>
+File: figures/a.pdf Graphic file (type pdf)
+Overfull \\hbox (1.5pt too wide) in paragraph at lines 12--14
+[]\\T1/cmr/m/n/10 Some text
+Underfull \\vbox (badness 10000) has occurred while \\output is active []
+LaTeX Warning: Citation `knuth' on page 1 undefined on input line 20.
+LaTeX Warning: Reference `sec:a' on page 1 undefined on input line 21.
+ [1 <./figures/a.pdf>])
+("./chapters/two words.tex"
+! Undefined control sequence.
+l.7 \\foo
+! I can't write on file `chapters/out/two.aux'.
+! Font \\T1/foo/m/n/10=foo10 at 10.0pt not loadable: Metric (TFM) file not found.
+l.9 \\bar
+)
+Package natbib Warning: There were undefined citations.
+Package biblatex Warning: Please (re)run Biber on the file:
+(biblatex)                main
+LaTeX Warning: Label(s) may have changed. Rerun to get cross-references right.
+(rerunfilecheck)                Rerun to get outlines right
+! LaTeX Error: File `missing.sty' not found.
+! I can't find file `other.tex'.
+)'''
+
+
+class LogIndexTest(unittest.TestCase):
+
+    def test_parse_equals_feed(self):
+        for track_files in (False, True):
+            parsed = LogIndex.parse(LOG, track_files)
+            fed = LogIndex(track_files)
+            for line in LOG.splitlines():
+                fed.feed(line)
+            self.assertEqual(parsed.events(), fed.events())
+            self.assertEqual(parsed.current_file(), fed.current_file())
+
+    def test_events(self):
+        index = LogIndex.parse(LOG)
+        self.assertEqual([e.data for e in index.events(MISSING_FILE)],
+                         [u'first.sty', u'missing.sty', u'other.tex'])
+        self.assertEqual([e.data for e in index.events(FILE_WRITE_ERROR)],
+                         [u'chapters/out'])
+        self.assertEqual([e.data for e in index.events(MISSING_FONT_FILE)],
+                         [u'foo10.tfm'])
+        self.assertEqual([e.data for e in index.events(MISSING_FONT)],
+                         [u'foo'])
+        self.assertEqual([e.data for e in index.events(UNDEFINED_CITATION)],
+                         [u'knuth', None])
+        self.assertEqual(index.first(BIBLIOGRAPHY_PROGRAM).data, u'biber')
+        self.assertEqual(len(index.events(RERUN)), 2)
+        self.assertEqual([(e.data, e.line) for e in index.events(BAD_BOX)],
+                         [(u'Overfull', 12), (u'Underfull', None)])
+        self.assertEqual(len(index.events(ERROR)), 6)
+        self.assertIsNone(index.first(BAD_BOX).file)
+
+    def test_error_lines(self):
+        index = LogIndex.parse(LOG)
+        errors = index.events(ERROR)
+        self.assertEqual([e.line for e in errors[1:4]], [7, None, 9])
+        self.assertEqual(index.first(MISSING_FONT).line, 9)
+        self.assertIsNone(index.first(MISSING_FILE).line)
+
+    def test_files(self):
+        index = LogIndex.parse(LOG, track_files=True)
+        self.assertEqual(index.first(BAD_BOX).file, u'./chapters/one.tex')
+        self.assertEqual(index.first(UNDEFINED_CITATION).file,
+                         u'./chapters/one.tex')
+        self.assertEqual(index.first(FILE_WRITE_ERROR).file,
+                         u'./chapters/two words.tex')
+        self.assertIsNone(index.events(MISSING_FILE)[0].file)
+        self.assertEqual(index.events(MISSING_FILE)[1].file, u'./main.tex')
+        self.assertIsNone(index.current_file())
+
+    def test_has_with_files(self):
+        index = LogIndex.parse(LOG, track_files=True)
+        self.assertTrue(index.has(RERUN))
+        self.assertFalse(index.has(u'unknown'))
+
+
+if __name__ == '__main__':
+    unittest.main()
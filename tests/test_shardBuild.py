@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+import unittest
+from pdf_builders.shardBuild import collect
+
+
+class CollectTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.aux_path = self.path(u'aux')
+        self.frame = self.path(u'frame')
+        self.parts = [self.path(u'one'), self.path(u'two')]
+        self.write(u'aux/one.aux', u'\\relax\n\\setcounter{page}{3}\n')
+        self.write(u'aux/two.aux', u'\\relax\n\\setcounter{page}{5}\n')
+
+        self.write(u'frame/main.aux', u'\\relax\n\\@input{one.aux}\n\\@input{two.aux}\n')
+        self.write(u'frame/main.out', u'A\nC\n')
+        self.write(u'frame/main.log', u'frame log\n')
+        self.write(u'frame/main.pdf', u'%PDF frame')
+        self.write(u'frame/main.fls', u'PWD {0}\nINPUT main.tex\nOUTPUT {1}/main.pdf\n'.format(
+            self.path(u'doc'), self.frame))
+
+        # the first part got one page longer
+        self.write(u'one/one.aux', u'\\relax\n\\setcounter{page}{4}\n')
+        self.write(u'one/main.out', u'A\nB\nC\n')
+        self.write(u'one/main.log', u'one log\n')
+        self.write(u'one/main.fls', u'PWD {0}\nINPUT one.tex\nOUTPUT {1}/one.aux\n'.format(
+            self.path(u'doc'), self.parts[0]))
+
+        self.write(u'two/two.aux', u'\\relax\n\\setcounter{page}{5}\n')
+        self.write(u'two/main.out', u'A\nC\nD\n')
+        self.write(u'two/main.log', u'two log\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def write(self, name, text):
+        path = self.path(name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(text.encode('utf-8'))
+
+    def read(self, name):
+        with open(self.path(name), 'rb') as f:
+            return f.read().decode('utf-8')
+
+    def collect(self):
+        collect(self.aux_path, self.frame, self.parts, u'main', [u'one', u'two'])
+
+    def test_part_aux_files_with_shifted_pages(self):
+        self.collect()
+        self.assertEqual(self.read(u'aux/one.aux'), u'\\relax\n\\setcounter{page}{4}\n')
+        # compiled before the first part grew, so moved by one page
+        self.assertEqual(self.read(u'aux/two.aux'), u'\\relax\n\\setcounter{page}{6}\n')
+
+    def test_part_without_aux_file(self):
+        os.remove(self.path(u'two/two.aux'))
+        self.collect()
+        self.assertEqual(self.read(u'aux/two.aux'), u'\\relax\n\\setcounter{page}{5}\n')
+
+    def test_merged_files(self):
+        self.collect()
+        self.assertEqual(self.read(u'aux/main.out'), u'A\nB\nC\nD\n')
+        self.assertEqual(self.read(u'aux/main.aux'),
+                         u'\\relax\n\\@input{one.aux}\n\\@input{two.aux}\n')
+        self.assertFalse(os.path.exists(self.path(u'aux/main.pdf')))
+
+    def test_unmergeable_version_keeps_frame(self):
+        self.write(u'two/main.out', u'X\n')
+        self.collect()
+        self.assertEqual(self.read(u'aux/main.out'), u'A\nC\n')
+
+    def test_logs_are_joined(self):
+        self.collect()
+        self.assertEqual(self.read(u'aux/main.log'), u'frame log\none log\ntwo log\n')
+
+    def test_fls_points_to_aux_path(self):
+        self.collect()
+        self.assertEqual(self.read(u'aux/main.fls').splitlines(), [
+            u'INPUT ' + self.path(u'doc/main.tex'),
+            u'OUTPUT ' + os.path.join(self.aux_path, u'main.pdf'),
+            u'INPUT ' + self.path(u'doc/one.tex'),
+            u'OUTPUT ' + os.path.join(self.aux_path, u'one.aux'),
+        ])
+
+    def test_unchanged_files_are_not_written(self):
+        self.collect()
+        os.utime(self.path(u'aux/main.out'), (0, 0))
+        self.collect()
+        self.assertEqual(os.path.getmtime(self.path(u'aux/main.out')), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import unittest
+from pdf_builders.tlpdbIndex import TlpdbIndex
+
+TLPDB = u'''name 00texlive.config
+runfiles size=1
+ texmf-dist/tex/latex/config/skipped.sty
+
+name amsmath
+category Package
+runfiles size=4
+ texmf-dist/tex/latex/amsmath/amsmath.sty
+ texmf-dist/tex/latex/amsmath/amstext.sty
+docfiles size=1
+ texmf-dist/doc/latex/amsmath/amsdoc.pdf
+
+name lm
+category Package
+runfiles size=3
+ texmf-dist/fonts/tfm/public/lm/rm-lmr10.tfm
+ texmf-dist/fonts/type1/public/lm/lmr10.pfb
+ texmf-dist/tex/latex/lm/lmodern.sty
+
+name lm-math
+category Package
+runfiles size=1
+ texmf-dist/fonts/tfm/public/lm/rm-lmr12.tfm
+
+name dvips.x86_64-linux
+category Package
+runfiles size=1
+ bin/x86_64-linux/amstext.sty
+'''
+
+
+class TlpdbIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        tlpdb = os.path.join(self.directory, u'texlive.tlpdb')
+        with open(tlpdb, 'wb') as f:
+            f.write(TLPDB.encode('utf-8'))
+        self.index = TlpdbIndex.open(tlpdb, self.directory)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.directory)
+
+    def test_lookup(self):
+        self.assertEqual(self.index.lookup(u'lmodern.sty'), [u'lm'])
+        self.assertEqual(self.index.lookup(u'lmr10.pfb'), [u'lm'])
+
+    def test_lookup_first_and_last(self):
+        self.assertEqual(self.index.lookup(u'amsmath.sty'), [u'amsmath'])
+        self.assertEqual(self.index.lookup(u'rm-lmr12.tfm'), [u'lm-math'])
+
+    def test_lookup_missing(self):
+        self.assertEqual(self.index.lookup(u'missing.sty'), [])
+        self.assertEqual(self.index.lookup(u'amsmath'), [])
+        self.assertEqual(self.index.lookup(u'zzz.sty'), [])
+
+    def test_skipped_packages(self):
+        # documentation, infrastructure and architecture specific packages
+        self.assertEqual(self.index.lookup(u'amsdoc.pdf'), [])
+        self.assertEqual(self.index.lookup(u'skipped.sty'), [])
+        self.assertEqual(self.index.lookup(u'amstext.sty'), [u'amsmath'])
+
+    def test_lookup_prefix(self):
+        self.assertEqual(self.index.lookup_prefix(u'rm-lmr'), [u'lm', u'lm-math'])
+        self.assertEqual(self.index.lookup_prefix(u'rm-lmr', limit=1), [u'lm'])
+        self.assertEqual(self.index.lookup_prefix(u'ams'), [u'amsmath'])
+        self.assertEqual(self.index.lookup_prefix(u'nothing'), [])
+
+    def test_reopen_uses_index(self):
+        tlpdb = os.path.join(self.directory, u'texlive.tlpdb')
+        index = TlpdbIndex.open(tlpdb, self.directory)
+        try:
+            self.assertEqual(index.path, self.index.path)
+            self.assertEqual(index.lookup(u'lmr10.pfb'), [u'lm'])
+        finally:
+            index.close()
+
+    def test_empty_index(self):
+        tlpdb = os.path.join(self.directory, u'empty.tlpdb')
+        with open(tlpdb, 'wb'):
+            pass
+        index = TlpdbIndex.open(tlpdb, self.directory)
+        try:
+            self.assertEqual(index.lookup(u'amsmath.sty'), [])
+            self.assertEqual(index.lookup_prefix(u'ams'), [])
+        finally:
+            index.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
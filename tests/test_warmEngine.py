@@ -0,0 +1,102 @@
+import os
+import shutil
+import tempfile
+import unittest
+from pdf_builders.warmEngine import (
+    WarmEnginePool, preamble_inputs, preamble_signatures)
+
+
+class FakeProcess(object):
+    pid = 0
+    stdin = stdout = stderr = None
+
+    def __init__(self):
+        self.returncode = None
+
+    def poll(self):
+        return self.returncode
+
+    def kill(self):
+        self.returncode = -9
+
+    def wait(self):
+        return self.returncode
+
+
+class PreambleInputsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.write(u'main.tex',
+                   u'\\documentclass{article}\n\\input{macros}\n'
+                   u'\\begin{document}\n\\input{chapter}\n\\end{document}\n')
+        self.write(u'macros.tex', u'\\newcommand{\\x}{x}\n')
+        self.write(u'chapter.tex', u'Text\n')
+        self.write(u'main.fls', u'\n'.join([
+            u'PWD ' + self.directory,
+            u'INPUT /texmf/tex/latex/base/article.cls',
+            u'INPUT main.tex',
+            u'INPUT ./macros.tex',
+            u'INPUT ' + WarmEnginePool.WRAPPER,
+            u'INPUT ./main.aux',
+            u'OUTPUT main.aux',
+            u'INPUT ./chapter.tex',
+            u'OUTPUT main.pdf',
+        ]))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def write(self, name, text):
+        with open(self.path(name), 'wb') as f:
+            f.write(text.encode('utf-8'))
+
+    def test_inputs_before_begin_document(self):
+        self.assertEqual(
+            preamble_inputs(self.path(u'main.fls'), u'main'),
+            [u'/texmf/tex/latex/base/article.cls', self.path(u'main.tex'),
+             self.path(u'macros.tex')])
+
+    def test_all_inputs_without_aux(self):
+        self.assertEqual(
+            preamble_inputs(self.path(u'main.fls'), u'other')[-1],
+            self.path(u'chapter.tex'))
+
+    def test_missing_fls(self):
+        self.assertEqual(preamble_inputs(self.path(u'none.fls'), u'main'), [])
+
+    def acquire_after(self, name, text):
+        pool = WarmEnginePool(1)
+        processes = []
+
+        def spawn(command):
+            processes.append(FakeProcess())
+            return processes[-1]
+
+        inputs = preamble_inputs(self.path(u'main.fls'), u'main')
+        pool.fill(u'key', u'', [u'pdflatex'], spawn, self.directory,
+                  preamble_signatures(inputs))
+        # signatures compare modification times and sizes
+        self.write(name, text)
+        os.utime(self.path(name), (0, 0))
+        engine = pool.acquire(u'key')
+        pool.shutdown()
+        return engine, processes[0]
+
+    def test_edited_preamble_input_discards_engine(self):
+        engine, process = self.acquire_after(
+            u'macros.tex', u'\\newcommand{\\x}{y}\n')
+        self.assertIsNone(engine)
+        self.assertIsNotNone(process.returncode)
+
+    def test_edited_body_keeps_engine(self):
+        engine, process = self.acquire_after(u'chapter.tex', u'Other text\n')
+        self.assertIsNotNone(engine)
+        self.assertIsNone(process.returncode)
+
+
+if __name__ == '__main__':
+    unittest.main()